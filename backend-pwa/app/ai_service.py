@@ -1,26 +1,55 @@
 """
 AI service functions for the application
 """
+import os
+import json
+import time
+import asyncio
+import hashlib
 import httpx
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from fastapi import HTTPException
 
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage
 
-from .config import OPENAI_API_KEY, ModelConfig
+from .config import (
+    ModelConfig,
+    CLASSIFIER_LOCAL_ENABLED,
+    CLASSIFIER_CONFIDENCE,
+    CLASSIFIER_MODEL_PATH,
+    CLASSIFIER_LOG_PATH,
+    CLASSIFICATION_CACHE_BACKEND,
+    CLASSIFICATION_CACHE_PATH,
+    CLASSIFICATION_CACHE_SIZE,
+    CLASSIFICATION_CACHE_TTL,
+    CONTEXT_SUMMARY_MAX_TOKENS,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_TYPES,
+    RESPONSE_CACHE_MAX_TEMPERATURE,
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_SEARCH_TTL,
+    RESPONSE_CACHE_SEMANTIC_ENABLED,
+    RESPONSE_CACHE_SIMILARITY,
+    RESPONSE_CACHE_VECTORS,
+    RESPONSE_CACHE_EMBEDDING_DIMENSIONS
+)
 from .models import Message
+from .llm_clients import get_llm_clients
+from .image_client import get_image_client, iter_b64_json, read_json, ImageQueueFull
+from .image_store import StoredBlob, store_base64_stream
+from .classifier import ClassificationPipeline, RuleClassifier, HashedNgramClassifier
+from .cache import create_cache
+from .response_cache import ResponseCache, VectorIndex
 
 # AI-based prompt classifier
 async def classify_prompt_with_ai(prompt: str, conversation_context: Optional[List[Message]] = None) -> str:
     """
     Use OpenAI to classify the prompt type instead of regex patterns
     """
-    classifier = ChatOpenAI(
-        model_name=ModelConfig.MODEL_CLASSIFIER,
-        openai_api_key=OPENAI_API_KEY,
-        temperature=0.1,
-    )
+    classifier = get_llm_clients().get(ModelConfig.MODEL_CLASSIFIER, temperature=0.1)
 
     # Create context from previous messages if available
     context_text = ""
@@ -63,46 +92,245 @@ async def classify_prompt_with_ai(prompt: str, conversation_context: Optional[Li
         print(f"Classification error: {str(e)}")
         return "chat"  # Default to chat if classification fails
 
+# Classification pipeline: local rules and model first, remote classifier on low confidence
+_classification_pipeline: Optional[ClassificationPipeline] = None
+
+def build_classification_pipeline() -> ClassificationPipeline:
+    """Assemble the configured local stages and result cache in front of the remote classifier"""
+    stages = []
+    if CLASSIFIER_LOCAL_ENABLED:
+        stages.append(RuleClassifier())
+        if os.path.exists(CLASSIFIER_MODEL_PATH):
+            stages.append(HashedNgramClassifier.load(CLASSIFIER_MODEL_PATH))
+    cache = create_cache(
+        CLASSIFICATION_CACHE_BACKEND,
+        max_entries=CLASSIFICATION_CACHE_SIZE,
+        ttl=CLASSIFICATION_CACHE_TTL,
+        path=CLASSIFICATION_CACHE_PATH,
+        table="classifications"
+    )
+    return ClassificationPipeline(stages, classify_prompt_with_ai, CLASSIFIER_CONFIDENCE, CLASSIFIER_LOG_PATH, cache)
+
+def get_classification_pipeline() -> ClassificationPipeline:
+    global _classification_pipeline
+    if _classification_pipeline is None:
+        _classification_pipeline = build_classification_pipeline()
+    return _classification_pipeline
+
+async def classify_prompt(prompt: str, conversation_context: Optional[List[Message]] = None) -> str:
+    """Classify a prompt, skipping the remote classifier when a local stage is confident"""
+    return await get_classification_pipeline().classify(prompt, conversation_context)
+
+# Speculative execution: classification outcomes that can use the default chat answer
+SPECULATION_KEEP_TYPES = {"chat", "mini"}
+
+speculation_stats = {
+    "started": 0,
+    "kept": 0,
+    "cancelled": 0,
+    "failed": 0,
+    "saved_seconds": 0.0,
+    "wasted_seconds": 0.0
+}
+
+async def classify_with_speculation(
+    prompt: str,
+    conversation_context: Optional[List[Message]],
+    speculate: Callable[[], Awaitable[Any]]
+) -> Tuple[str, Optional[Any]]:
+    """
+    Classify a prompt while speculatively running the default chat generation.
+
+    Returns the prompt type and the speculative result, which is None when
+    the result cannot be used. Prompts the local stages or the cache can
+    answer are not speculated on. If classification picks image or search,
+    the speculative call is cancelled, which closes its upstream request.
+    """
+    pipeline = get_classification_pipeline()
+    prompt_type = await pipeline.lookup(prompt, conversation_context)
+    if prompt_type is not None:
+        return prompt_type, None
+
+    started = time.monotonic()
+    finished = {}
+
+    async def run_speculation():
+        try:
+            return await speculate()
+        finally:
+            finished["at"] = time.monotonic()
+
+    speculation_stats["started"] += 1
+    speculative = asyncio.create_task(run_speculation())
+    try:
+        prompt_type = await pipeline.classify_remote(prompt, conversation_context)
+    except BaseException:
+        speculative.cancel()
+        raise
+    classified = time.monotonic()
+
+    if prompt_type not in SPECULATION_KEEP_TYPES:
+        speculative.cancel()
+        speculation_stats["cancelled"] += 1
+        speculation_stats["wasted_seconds"] += finished.get("at", classified) - started
+        return prompt_type, None
+
+    try:
+        result = await speculative
+    except Exception as e:
+        print(f"Speculative generation error: {str(e)}")
+        speculation_stats["failed"] += 1
+        return prompt_type, None
+
+    # Run sequentially, the turn would have taken classification + generation
+    speculation_stats["kept"] += 1
+    speculation_stats["saved_seconds"] += min(classified - started, finished["at"] - started)
+    return prompt_type, result
+
+# Request coalescing: identical calls in flight at once share one upstream call
+class _Flight:
+    def __init__(self, task: asyncio.Task, keep_running: bool):
+        self.task = task
+        self.keep_running = keep_running
+        self.waiters = 0
+
+class SingleFlight:
+    """Run fn once per key at a time; callers arriving meanwhile await the same result.
+
+    The call runs as its own task and finishes even if every caller goes
+    away, so a client that retries after giving up joins it rather than
+    starting another. Callers passing keep_running=False (e.g. speculative
+    generations) don't need that: a call only they wait on is cancelled
+    once they have all been cancelled.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Flight] = {}
+        self.stats = {"calls": 0, "coalesced": 0, "in_flight": 0, "abandoned": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], keep_running: bool = True) -> Any:
+        flight = self._calls.get(key)
+        if flight is None:
+            self.stats["calls"] += 1
+            flight = _Flight(asyncio.get_running_loop().create_task(fn()), keep_running)
+            self._calls[key] = flight
+            self.stats["in_flight"] = len(self._calls)
+            flight.task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.stats["coalesced"] += 1
+            flight.keep_running = flight.keep_running or keep_running
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.keep_running and not flight.task.done():
+                self.stats["abandoned"] += 1
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, key: str, task: asyncio.Task):
+        flight = self._calls.get(key)
+        if flight is not None and flight.task is task:
+            del self._calls[key]
+        self.stats["in_flight"] = len(self._calls)
+        if not task.cancelled():
+            # Retrieved here so a failure nobody waited for is not reported as unhandled
+            task.exception()
+
+def flight_key(*parts: Any) -> str:
+    """Key of a call from everything that determines its result"""
+    return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+
+# Chat completions and image generations
+model_calls = SingleFlight()
+
+# Rolling summaries of older conversation history
+async def summarize_messages(previous_summary: Optional[str], messages: List[Message]) -> str:
+    """
+    Fold messages into a running summary of the conversation
+    """
+    summarizer = get_llm_clients().get(ModelConfig.SUMMARY_MODEL, temperature=0.2)
+
+    transcript = "\n".join([f"{msg.role}: {msg.content}" for msg in messages])
+    summary_prompt = f"""
+    Update the summary of a conversation between a user and an AI assistant.
+
+    Current summary:
+    {previous_summary or "(none)"}
+
+    New messages:
+    {transcript}
+
+    Write a concise summary that keeps names, facts, decisions, open questions
+    and anything the user asked the assistant to remember. Return only the summary.
+    """
+
+    response = await summarizer.bind(max_tokens=CONTEXT_SUMMARY_MAX_TOKENS).ainvoke([HumanMessage(content=summary_prompt)])
+    return response.content.strip()
+
 # Factory for creating LangChain models based on type
-def get_langchain_model(model_type: str, model_override: Optional[str] = None, temperature: float = 0.7):
+def get_langchain_model(model_type: str, model_override: Optional[str] = None, temperature: float = 0.7, max_tokens: Optional[int] = None):
     """
     Factory function to get the appropriate LangChain model
+
+    Models are shared per model name and reuse one connection pool; temperature
+    and max_tokens are bound to each call.
     """
+    clients = get_llm_clients()
     if model_type == "chat":
         model_name = model_override or ModelConfig.CHAT_MODEL
-        return ChatOpenAI(
-            model_name=model_name,
-            openai_api_key=OPENAI_API_KEY,
-            temperature=temperature,
-        )
     elif model_type == "search":
         model_name = model_override or ModelConfig.SEARCH_MODEL
-        return ChatOpenAI(
-            model_name=model_name,
-            openai_api_key=OPENAI_API_KEY,
-            temperature=temperature,
-        )
     elif model_type == "mini":
         model_name = model_override or ModelConfig.MINI_MODEL
-        return ChatOpenAI(
-            model_name=model_name,
-            openai_api_key=OPENAI_API_KEY,
-            temperature=temperature,
-        )
     elif model_type == "image":
-        return ChatOpenAI(
-            model_name=ModelConfig.IMAGE_MODEL,
-            openai_api_key=OPENAI_API_KEY,
-            temperature=temperature,
-        )
+        model_name = ModelConfig.IMAGE_MODEL
     else:
         raise ValueError(f"Unknown model type: {model_type}")
 
-# Enhanced image generation with OpenAI
-async def generate_dalle_image(prompt, image_to_modify=None, size="1024x1024", quality="standard", style="vivid"):
-    """Generate image with DALL-E using OpenAI client, with optional image modification"""
+    model = clients.get(model_name, temperature)
+    if max_tokens:
+        return model.bind(max_tokens=max_tokens)
+    return model
 
-    api_data = {
+# Cache of text answers for repeated prompts, None unless enabled
+_response_cache: Optional[ResponseCache] = None
+
+def build_response_cache() -> ResponseCache:
+    """Assemble the configured response cache, with the semantic tier if enabled"""
+    ttls = {
+        prompt_type: RESPONSE_CACHE_SEARCH_TTL if prompt_type == "search" else RESPONSE_CACHE_TTL
+        for prompt_type in RESPONSE_CACHE_TYPES
+        if prompt_type != "image"
+    }
+    cache = create_cache(
+        RESPONSE_CACHE_BACKEND,
+        max_entries=RESPONSE_CACHE_SIZE,
+        ttl=RESPONSE_CACHE_TTL,
+        path=RESPONSE_CACHE_PATH,
+        table="responses"
+    )
+    index = embed = None
+    if RESPONSE_CACHE_SEMANTIC_ENABLED:
+        index = VectorIndex(RESPONSE_CACHE_VECTORS, RESPONSE_CACHE_EMBEDDING_DIMENSIONS)
+
+        async def embed(text: str) -> List[float]:
+            return await get_llm_clients().embed(text, ModelConfig.EMBEDDING_MODEL, RESPONSE_CACHE_EMBEDDING_DIMENSIONS)
+
+    return ResponseCache(cache, ttls, RESPONSE_CACHE_MAX_TEMPERATURE, index, embed, RESPONSE_CACHE_SIMILARITY)
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _response_cache
+    if _response_cache is None and RESPONSE_CACHE_ENABLED:
+        _response_cache = build_response_cache()
+    return _response_cache
+
+# Enhanced image generation with OpenAI
+def _dalle_request(prompt, size, quality, style) -> dict:
+    return {
         "model": "dall-e-3",
         "prompt": prompt,
         "size": size,
@@ -112,27 +340,25 @@ async def generate_dalle_image(prompt, image_to_modify=None, size="1024x1024", q
         "response_format": "b64_json"
     }
 
-    # If we have an image to modify, add it to the request
-    if image_to_modify:
-        # For DALL-E-3, we don't have direct image editing, so we enhance the prompt
-        # and use standard image generation with the enhanced prompt
-        endpoint = "https://api.openai.com/v1/images/generations"
-    else:
-        endpoint = "https://api.openai.com/v1/images/generations"
+async def _generate_with_image_client(api_data: dict, handle=read_json):
+    try:
+        return await get_image_client().generate(api_data, handle)
+    except ImageQueueFull as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Image generation is busy, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                endpoint,
-                headers={
-                    "Authorization": f"Bearer {OPENAI_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json=api_data,
-                timeout=120.0
-            )
-            response.raise_for_status()
-            response_data = response.json()
-            return response_data["data"][0]["b64_json"]
-        except httpx.HTTPError as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+async def generate_dalle_image_to_store(prompt, size="1024x1024", quality="standard", style="vivid") -> StoredBlob:
+    """Generate an image with DALL-E and stream it straight into the image store.
+
+    The base64 payload is decoded and written as it arrives instead of being
+    parsed as one JSON document first.
+    """
+    return await _generate_with_image_client(
+        _dalle_request(prompt, size, quality, style),
+        lambda response: store_base64_stream(iter_b64_json(response))
+    )
@@ -0,0 +1,231 @@
+"""
+Small caches with LRU eviction, TTLs and hit/miss counters
+
+Both caches have the same interface. Code on the event loop uses aget/aset,
+which for SQLiteCache run the file I/O on a worker thread.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+class LRUCache:
+    """In-process LRU cache with optional per-entry TTL.
+
+    With size_of, entries are also evicted to keep their total estimated
+    size under max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        size_of: Optional[Callable[[Any], int]] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.bytes -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        size = self.size_of(value) if self.size_of else 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Would evict everything else and still not fit
+                return
+            self._entries[key] = (value, expires_at, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted[2]
+                self.evictions += 1
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return self.get(key)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float] = None):
+        self.set(key, value, ttl)
+
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions
+        }
+
+class SQLiteCache:
+    """LRU cache in a SQLite file, shared by every worker process on the host.
+
+    Values must be JSON-serializable. Hit/miss counters are per process.
+    Expired and least recently used entries are trimmed every trim_every
+    writes rather than on each one, so the table may briefly hold that many
+    entries over max_entries. The entry count in stats() is kept as writes go
+    and recounted at each trim, so /metrics never queries the file; between
+    trims it can run ahead by the keys that were overwritten.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 1024,
+        ttl: Optional[float] = None,
+        table: str = "cache",
+        trim_every: Optional[int] = None
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self.trim_every = trim_every or max(1, max_entries // 20)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._connection() as db:
+            db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, last_used REAL NOT NULL)"
+            )
+            db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_last_used ON {table}(last_used)")
+        self.entries = len(self)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections may not be shared across threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[Any]:
+        db = self._connection()
+        now = time.time()
+        row = db.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            self.misses += 1
+            return None
+        db.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        db = self._connection()
+        db.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl if ttl else None, now)
+        )
+        with self._lock:
+            self._writes += 1
+            self.entries += 1
+            trim = self._writes % self.trim_every == 0
+        if trim:
+            self.trim()
+
+    def trim(self):
+        """Drop expired entries, then the least recently used beyond max_entries"""
+        db = self._connection()
+        db.execute(f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        # Walks the last_used index past the entries that stay; no COUNT(*) needed
+        evicted = db.execute(
+            f"DELETE FROM {self.table} WHERE key IN "
+            f"(SELECT key FROM {self.table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        ).rowcount
+        self.evictions += max(evicted, 0)
+        # Also picks up other workers' writes to the shared file
+        self.entries = len(self)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float] = None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    def delete(self, key: str):
+        deleted = self._connection().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,)).rowcount
+        with self._lock:
+            self.entries = max(0, self.entries - max(deleted, 0))
+
+    def clear(self):
+        self._connection().execute(f"DELETE FROM {self.table}")
+        self.entries = 0
+
+    def __len__(self) -> int:
+        return self._connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions
+        }
+
+def create_cache(backend: str, max_entries: int, ttl: Optional[float], path: Optional[str] = None, table: str = "cache"):
+    """Build the configured cache backend ("memory" or "sqlite")"""
+    if backend == "sqlite":
+        return SQLiteCache(path, max_entries=max_entries, ttl=ttl, table=table)
+    if backend == "memory":
+        return LRUCache(max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
@@ -0,0 +1,238 @@
+"""
+Prompt classification pipeline
+
+Cheap local stages answer when they are confident; anything else falls
+through to the remote LLM classifier, whose answers are cached. Remote
+decisions can be logged and used to train the local hashed n-gram model
+(see train_classifier.py).
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import zlib
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .models import Message
+
+PROMPT_TYPES = ["image", "search", "mini", "chat"]
+
+# (label, confidence)
+Classification = Tuple[str, float]
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase and collapse whitespace"""
+    return " ".join(prompt.lower().split())
+
+def classification_cache_key(prompt: str, context: Optional[List[Message]] = None) -> str:
+    """Normalized prompt plus a hash of the last 3 context messages the remote classifier sees"""
+    context_text = "\n".join(f"{msg.role}: {msg.content}" for msg in (context or [])[-3:])
+    context_hash = hashlib.sha1(context_text.encode("utf-8")).hexdigest()
+    return f"{normalize_prompt(prompt)}|{context_hash}"
+
+class RuleClassifier:
+    """Keyword and regex rules for the unambiguous cases.
+
+    A rule only answers when the whole prompt fits it; anything looser
+    (a prompt that merely mentions "photo" or "news", a "yes" that answers
+    the previous message) is left to the later stages.
+    """
+
+    GREETING = re.compile(
+        r"^(hi+|hello|hey|yo|thanks?( you)?( so much)?|thx|ty|cool|great|nice|awesome|perfect|bye|goodbye|"
+        r"good (morning|afternoon|evening|night)|lol|wow|see you)( there)?[!.?\s]*$"
+    )
+    # Replies to the previous message: only small talk when there is none
+    ACKNOWLEDGEMENT = re.compile(r"^(ok(ay)?|yes|no|yep|nope|yeah|sure|got it)[!.?\s]*$")
+    IMAGE_REQUEST = re.compile(
+        r"^(please |can you |could you |would you |i want you to |i'd like you to )?"
+        r"(draw|paint|sketch|illustrate|render|generate|create|make|design|produce)( me)? "
+        r"(an?|one|some|\d+) ([\w-]+ ){0,3}"
+        r"(image|picture|photo|drawing|painting|illustration|logo|icon|portrait|wallpaper|artwork|poster|sketch)(es|s)?\b"
+        # The noun ends the request ("a logo for ...", not "a logo strategy")
+        r"(?=$|[,.!?]| (of|for|with|in|on|at|that|showing|where|and)\b)"
+    )
+    IMAGE_NOUN = re.compile(r"^(an? )?(image|picture|photo|drawing|painting|illustration|portrait|sketch) of\b")
+    IMAGE_FOLLOW_UP = re.compile(r"^(make (it|them)|try again|another one|same but|(add|remove|change) (a|an|the))\b")
+    # Asks for writing or explanation about a topic, whatever the topic is
+    TASK = re.compile(r"^(write|draft|compose|explain|describe|summarize|translate|define)\b")
+    SEARCH = re.compile(
+        r"\b((weather|forecast) (in|for|today|tomorrow|this)|(stock|share) price(?! index)|exchange rate|who won|score of|"
+        r"(latest|today's|breaking) (news|headlines)|news (about|on)|latest (version|release|update) of|what time is it in)\b"
+    )
+
+    def classify(self, prompt: str, context: Optional[List[Message]] = None) -> Optional[Classification]:
+        text = normalize_prompt(prompt)
+        if self.GREETING.match(text) or (not context and self.ACKNOWLEDGEMENT.match(text)):
+            return "mini", 0.95
+        if self.IMAGE_REQUEST.match(text) or self.IMAGE_NOUN.match(text):
+            return "image", 0.9
+        if (context and context[-1].content_type == "image" and len(text.split()) <= 12
+                and self.IMAGE_FOLLOW_UP.match(text)):
+            return "image", 0.9
+        if not self.TASK.match(text) and self.SEARCH.search(text):
+            return "search", 0.9
+        return None
+
+class HashedNgramClassifier:
+    """Multinomial logistic regression over hashed word and character n-grams"""
+
+    def __init__(self, labels: Iterable[str] = PROMPT_TYPES, buckets: int = 2 ** 18):
+        self.labels = list(labels)
+        self.buckets = buckets
+        self.weights: Dict[str, Dict[int, float]] = {label: {} for label in self.labels}
+        self.bias: Dict[str, float] = {label: 0.0 for label in self.labels}
+
+    def features(self, prompt: str) -> Dict[int, float]:
+        """Hashed word unigrams/bigrams and character trigrams, L2-normalized"""
+        text = normalize_prompt(prompt)
+        words = text.split()
+        grams = [f"w:{w}" for w in words]
+        grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        padded = f" {text} "
+        grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+
+        counts: Dict[int, float] = {}
+        for gram in grams:
+            bucket = zlib.crc32(gram.encode("utf-8")) % self.buckets
+            counts[bucket] = counts.get(bucket, 0.0) + 1.0
+        norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+        return {k: v / norm for k, v in counts.items()}
+
+    def _probabilities(self, features: Dict[int, float]) -> Dict[str, float]:
+        scores = {
+            label: self.bias[label] + sum(self.weights[label].get(k, 0.0) * v for k, v in features.items())
+            for label in self.labels
+        }
+        top = max(scores.values())
+        exp = {label: math.exp(score - top) for label, score in scores.items()}
+        total = sum(exp.values())
+        return {label: value / total for label, value in exp.items()}
+
+    def classify(self, prompt: str, context: Optional[List[Message]] = None) -> Optional[Classification]:
+        probabilities = self._probabilities(self.features(prompt))
+        label = max(probabilities, key=probabilities.get)
+        return label, probabilities[label]
+
+    def train(self, examples: List[Tuple[str, str]], epochs: int = 15, learning_rate: float = 0.5, l2: float = 1e-5, seed: int = 0):
+        """Fit on (prompt, label) pairs with plain SGD"""
+        rng = random.Random(seed)
+        data = [(self.features(prompt), label) for prompt, label in examples if label in self.weights]
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for features, label in data:
+                probabilities = self._probabilities(features)
+                for candidate in self.labels:
+                    gradient = probabilities[candidate] - (1.0 if candidate == label else 0.0)
+                    weights = self.weights[candidate]
+                    for k, v in features.items():
+                        weight = weights.get(k, 0.0)
+                        weights[k] = weight - learning_rate * (gradient * v + l2 * weight)
+                    self.bias[candidate] -= learning_rate * gradient
+        return self
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as model_file:
+            json.dump({
+                "labels": self.labels,
+                "buckets": self.buckets,
+                "bias": self.bias,
+                "weights": {label: {str(k): round(w, 6) for k, w in weights.items() if abs(w) > 1e-6}
+                            for label, weights in self.weights.items()}
+            }, model_file)
+
+    @classmethod
+    def load(cls, path: str) -> "HashedNgramClassifier":
+        with open(path) as model_file:
+            data = json.load(model_file)
+        model = cls(data["labels"], data["buckets"])
+        model.bias = data["bias"]
+        model.weights = {label: {int(k): w for k, w in weights.items()} for label, weights in data["weights"].items()}
+        return model
+
+def load_decisions(path: str) -> List[Tuple[str, str]]:
+    """Read (prompt, label) pairs from a decision log"""
+    examples = []
+    with open(path) as log_file:
+        for line in log_file:
+            if line.strip():
+                record = json.loads(line)
+                examples.append((record["prompt"], record["label"]))
+    return examples
+
+class ClassificationPipeline:
+    """Run local stages in order and fall back to the remote classifier on low confidence"""
+
+    def __init__(
+        self,
+        local_stages: List,
+        remote: Callable[[str, Optional[List[Message]]], Awaitable[str]],
+        threshold: float = 0.85,
+        decision_log_path: Optional[str] = None,
+        cache=None
+    ):
+        self.local_stages = local_stages
+        self.remote = remote
+        self.threshold = threshold
+        self.decision_log_path = decision_log_path
+        self._log_lock = threading.Lock()
+        # Any object with aget/aset, e.g. cache.LRUCache or cache.SQLiteCache
+        self.cache = cache
+        self.stats = {"local": 0, "cached": 0, "remote": 0}
+
+    def classify_local(self, prompt: str, context: Optional[List[Message]] = None) -> Optional[Classification]:
+        """First confident local answer, or None"""
+        for stage in self.local_stages:
+            result = stage.classify(prompt, context)
+            if result and result[1] >= self.threshold:
+                return result
+        return None
+
+    async def lookup(self, prompt: str, context: Optional[List[Message]] = None) -> Optional[str]:
+        """Answer from the local stages or the cache, without calling the remote classifier"""
+        result = self.classify_local(prompt, context)
+        if result:
+            self.stats["local"] += 1
+            return result[0]
+
+        if self.cache is not None:
+            label = await self.cache.aget(classification_cache_key(prompt, context))
+            if label is not None:
+                self.stats["cached"] += 1
+                return label
+
+        return None
+
+    async def classify_remote(self, prompt: str, context: Optional[List[Message]] = None) -> str:
+        """Ask the remote classifier, then log and cache its answer"""
+        self.stats["remote"] += 1
+        label = await self.remote(prompt, context)
+        await self._log_decision(prompt, label)
+        if self.cache is not None:
+            await self.cache.aset(classification_cache_key(prompt, context), label)
+        return label
+
+    async def classify(self, prompt: str, context: Optional[List[Message]] = None) -> str:
+        label = await self.lookup(prompt, context)
+        if label is not None:
+            return label
+        return await self.classify_remote(prompt, context)
+
+    async def _log_decision(self, prompt: str, label: str):
+        if not self.decision_log_path:
+            return
+        line = json.dumps({"prompt": prompt, "label": label}) + "\n"
+        # File I/O stays off the event loop; the lock keeps lines whole
+        await asyncio.to_thread(self._append_decision, line)
+
+    def _append_decision(self, line: str):
+        try:
+            with self._log_lock, open(self.decision_log_path, "a") as log_file:
+                log_file.write(line)
+        except OSError as e:
+            print(f"Could not log classification decision: {str(e)}")
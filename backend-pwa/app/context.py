@@ -0,0 +1,150 @@
+"""
+Token-budgeted prompt context
+
+Keeps the system prompt and the most recent turns within a token budget
+and replaces older turns with a rolling summary that is cached per
+conversation, so prompt size stays bounded however long the history gets.
+"""
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import tiktoken
+
+from .config import (
+    ModelConfig,
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_RECENT_SHARE
+)
+from .models import Message
+from .ai_service import summarize_messages
+from .database import get_context_summary, save_context_summary
+
+class TokenCounter:
+    """Count tokens locally with tiktoken, estimating from length if no encoding is available"""
+
+    # Per-message framing tokens in the chat format
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, model_name: str = ModelConfig.CHAT_MODEL):
+        try:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Encodings are downloaded on first use; estimate until they can be
+            print(f"Token encoding unavailable, estimating token counts: {str(e)}")
+            self._encoding = None
+
+    def count_text(self, text: str) -> int:
+        if self._encoding is None:
+            return len(text) // 4 + 1
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: Message) -> int:
+        return self.count_text(message.content) + self.MESSAGE_OVERHEAD
+
+    def count_messages(self, messages: List[Message]) -> int:
+        return sum(self.count_message(message) for message in messages)
+
+def split_recent(counter: TokenCounter, messages: List[Message], limit: int) -> int:
+    """Index where the newest messages that fit in limit tokens start; the last message is always kept"""
+    tokens = 0
+    index = len(messages)
+    while index > 0:
+        message_tokens = counter.count_message(messages[index - 1])
+        if tokens + message_tokens > limit and index < len(messages):
+            break
+        tokens += message_tokens
+        index -= 1
+    return index
+
+def summary_message(summary: str) -> Message:
+    return Message(role="system", content=f"Summary of the earlier conversation:\n{summary}")
+
+class ContextBuilder:
+    """Build the message list sent to the model for one turn"""
+
+    def __init__(
+        self,
+        summarize: Callable[[Optional[str], List[Message]], Awaitable[str]],
+        load_summary: Callable[[str], Awaitable[Optional[Dict]]],
+        store_summary: Callable[[str, int, str, int], Awaitable[None]],
+        budget: int = CONTEXT_TOKEN_BUDGET,
+        recent_share: float = CONTEXT_RECENT_SHARE,
+        counter: Optional[TokenCounter] = None
+    ):
+        self.summarize = summarize
+        self.load_summary = load_summary
+        self.store_summary = store_summary
+        self.budget = budget
+        self.recent_share = recent_share
+        self.counter = counter or TokenCounter()
+
+    async def build(self, conversation_id: Optional[str], messages: List[Message]) -> List[Message]:
+        """
+        Fit messages into the budget.
+
+        System messages are always kept. If the rest does not fit, the oldest
+        messages are replaced with a summary. The summary is only regenerated
+        once the turns after it outgrow the budget again. conversation_id is
+        None for conversations that are not stored yet; their summaries are
+        not cached.
+        """
+        system = [message for message in messages if message.role == "system"]
+        history = [message for message in messages if message.role != "system"]
+        available = self.budget - self.counter.count_messages(system)
+
+        if self._fits(history, available):
+            return messages
+
+        # Reuse the cached summary while the turns after it still fit
+        cached = await self.load_summary(conversation_id) if conversation_id else None
+        if cached and cached["covered_messages"] <= len(history):
+            covered = cached["covered_messages"]
+            summary_tokens = cached["token_count"] + TokenCounter.MESSAGE_OVERHEAD
+            if self._fits(history[covered:], available - summary_tokens):
+                return system + [summary_message(cached["summary"])] + history[covered:]
+
+        # Summarize everything except the newest share of the budget
+        cut = split_recent(self.counter, history, int(available * self.recent_share))
+        previous_summary, summarized_from = None, 0
+        if cached and cached["covered_messages"] <= cut:
+            previous_summary, summarized_from = cached["summary"], cached["covered_messages"]
+
+        # Only the newest part of a very long unsummarized span fits in one summarizer call
+        to_summarize = history[summarized_from:cut]
+        skip = split_recent(self.counter, to_summarize, self.budget)
+        to_summarize = to_summarize[skip:]
+
+        try:
+            summary = await self.summarize(previous_summary, to_summarize)
+        except Exception as e:
+            print(f"Context summary error: {str(e)}")
+            start = split_recent(self.counter, history, available)
+            return system + history[start:]
+
+        if conversation_id:
+            await self.store_summary(conversation_id, cut, summary, self.counter.count_text(summary))
+        return system + [summary_message(summary)] + history[cut:]
+
+    def _fits(self, messages: List[Message], limit: int) -> bool:
+        """Whether messages fit in limit tokens, counting no further than needed"""
+        tokens = 0
+        for message in reversed(messages):
+            tokens += self.counter.count_message(message)
+            if tokens > limit:
+                return False
+        return True
+
+# Process-wide builder
+_builder: Optional[ContextBuilder] = None
+
+def get_context_builder() -> ContextBuilder:
+    global _builder
+    if _builder is None:
+        _builder = ContextBuilder(summarize_messages, get_context_summary, save_context_summary)
+    return _builder
+
+async def build_prompt_context(conversation_id: Optional[str], messages: List[Message]) -> List[Message]:
+    """Messages for the model, trimmed to the token budget"""
+    return await get_context_builder().build(conversation_id, messages)
@@ -4,85 +4,524 @@ Database operations for the application
 This module provides a compatibility layer between the old JSON-based storage
 and the new PostgreSQL database. It imports and uses the new database operations
 but maintains the same function signatures for backward compatibility.
+
+The operations are awaitable: each one runs the synchronous CRUD code on a
+bounded thread pool, so queries never block the event loop. Each call holds
+a pooled connection only while it runs and commits on its own; inside a
+request (see RequestDbQueueMiddleware) a request's calls also run one at a
+time. Recently
+used conversations are cached in process and kept current by the writes made
+through this module.
 """
 import os
 import json
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 from fastapi import Depends
 from sqlalchemy.orm import Session
 
 # from .config import DB_PATH, DATABASE_URL
-from .models import Message, Conversation, User, UserResponse
-from .db.database import get_db
+from .config import (
+    DB_EXECUTOR_WORKERS,
+    CONVERSATION_CACHE_SIZE,
+    CONVERSATION_CACHE_MAX_BYTES,
+    CONVERSATION_CACHE_INVALIDATION,
+    CONVERSATION_CACHE_CHANNEL,
+    IMAGE_INDEX_CACHE_SIZE,
+    IMAGE_CONTEXT_CACHE_SIZE,
+    IDEMPOTENCY_KEY_TTL
+)
+from .cache import LRUCache
+from .models import Message, Conversation, ConversationSummary, MessageSearchResult, User, UserResponse
+from .db.database import SessionLocal, connect, pool_metrics
+from .db.notify import NotificationListener, notify
 from .db.crud import (
     get_conversation_title as db_get_conversation_title,
     create_or_update_user,
     get_user_by_id,
     get_user_conversations_count as db_get_user_conversations_count,
-    create_conversation,
+    bulk_create_conversations,
     update_conversation,
     get_conversation_by_id,
     get_user_conversations as db_get_user_conversations,
-    delete_conversation
+    get_user_conversation_summaries as db_get_user_conversation_summaries,
+    search_messages,
+    delete_conversation,
+    get_context_summary as db_get_context_summary,
+    save_context_summary as db_save_context_summary,
+    append_messages,
+    create_image,
+    get_image_blob as db_get_image_blob,
+    get_latest_image,
+    claim_idempotency_key as db_claim_idempotency_key,
+    complete_idempotency_key,
+    release_idempotency_key as db_release_idempotency_key,
+    stored_prefix_unchanged,
+    mark_persisted,
+    decode_export_cursor
 )
+from .export import export_archive, export_lines
 
-# Initialize database tables
-from .db.database import Base, engine
-Base.metadata.create_all(bind=engine)
+T = TypeVar("T")
 
-# Get a database session
+# Create or upgrade the database schema
+from .db.database import engine
+from .db.migrations import migrate
+migrate(engine)
+
+# Get a database session for synchronous code; it is closed when the block exits
+@contextmanager
 def get_session():
-    return next(get_db())
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Blocking database work runs here, never on the event loop
+_db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def _in_executor(fn: Callable[..., T], *args) -> T:
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
+def _call_with_new_session(fn: Callable[..., T], *args) -> T:
+    connection = connect()
+    db = SessionLocal(bind=connection)
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+        connection.close()
+
+def _call_in_transaction(fn: Callable[..., T], *args) -> T:
+    """fn(db, *args) on a connection checked out for this call only, committed before it is returned"""
+    connection = connect()
+    db = SessionLocal(bind=connection)
+    try:
+        result = fn(db, *args)
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+        connection.close()
+
+class RequestDbQueue:
+    """A request's database calls, run one after another.
+
+    Every call is a transaction of its own: it checks a connection out,
+    commits or rolls back, and returns the connection to the pool before the
+    request goes back to waiting on the model or a stream. A connection is
+    therefore held only while a query runs, never for a whole request.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        async with self._lock:
+            return await _in_executor(_call_in_transaction, fn, *args)
+
+_request_queue: ContextVar[Optional[RequestDbQueue]] = ContextVar("request_db_queue", default=None)
+
+@asynccontextmanager
+async def request_db_queue():
+    """Run the database calls made inside the block one after another"""
+    queue = RequestDbQueue()
+    token = _request_queue.set(queue)
+    try:
+        yield queue
+    finally:
+        _request_queue.reset(token)
+
+class RequestDbQueueMiddleware:
+    """Queue the database calls of every HTTP request, including streamed responses, one after another"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        async with request_db_queue():
+            await self.app(scope, receive, send)
+
+async def run_db(fn: Callable[..., T], *args) -> T:
+    """Run fn(db, *args) on the database thread pool, in its own transaction.
+
+    Inside a request the call waits for the request's earlier calls to finish.
+    """
+    queue = _request_queue.get()
+    if queue is not None:
+        return await queue.run(fn, *args)
+    return await _in_executor(_call_with_new_session, fn, *args)
+
+def _next_batch(items: Iterator[T], size: int) -> List[T]:
+    return list(islice(items, size))
+
+def _close_iteration(items: Iterator, db: Session, connection):
+    try:
+        items.close()
+        db.close()
+    finally:
+        connection.close()
+
+async def iterate_db(fn: Callable[..., Iterator[T]], *args, batch_size: int = 16) -> AsyncIterator[T]:
+    """Items of the generator fn(db, *args), pulled batch_size at a time on the database thread pool.
+
+    The generator gets a session and connection of its own, outside the
+    request's queue of calls, which it keeps until it is exhausted or the
+    caller stops iterating (e.g. a client disconnects mid-stream). A
+    server-side cursor can therefore stay open between batches.
+    """
+    connection = await _in_executor(connect)
+    db = SessionLocal(bind=connection)
+    items = fn(db, *args)
+    try:
+        while True:
+            batch = await _in_executor(_next_batch, items, batch_size)
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        await _in_executor(_close_iteration, items, db, connection)
+
+def database_pool_metrics() -> Dict[str, Any]:
+    """Connection pool usage and checkout wait times"""
+    return pool_metrics.snapshot()
 
 def get_conversation_title(messages: List[Message]) -> str:
     """Extract title from the first user message in conversation"""
     return db_get_conversation_title(messages)
 
 # User database operations
-def save_user(user: Dict[str, Any]):
+async def save_user(user: Dict[str, Any]):
     """Save a user to the database"""
-    db = get_session()
     user_schema = User(**user)
-    return create_or_update_user(db, user_schema)
+    return await run_db(create_or_update_user, user_schema)
 
-def get_user(user_id: str) -> Optional[Dict[str, Any]]:
+async def get_user(user_id: str) -> Optional[Dict[str, Any]]:
     """Get a user from the database"""
-    db = get_session()
-    return get_user_by_id(db, user_id)
+    return await run_db(get_user_by_id, user_id)
 
-def get_user_conversations_count(user_id: str) -> int:
+async def get_user_conversations_count(user_id: str) -> int:
     """Get the number of conversations for a user"""
-    db = get_session()
-    return db_get_user_conversations_count(db, user_id)
+    return await run_db(db_get_user_conversations_count, user_id)
+
+# Recently used conversations. Entries hold the stored fields, not the
+# Conversation objects handed out, since callers modify those.
+def _cached_size(entry: tuple) -> int:
+    """Rough size of an entry in bytes"""
+    return 512 + sum(200 + len(fields[1]) + len(fields[4] or "") for fields in entry[4])
+
+_conversation_cache = LRUCache(
+    max_entries=CONVERSATION_CACHE_SIZE,
+    max_bytes=CONVERSATION_CACHE_MAX_BYTES,
+    size_of=_cached_size
+)
+# Bumped by every write, so a read that raced with one is not cached
+_cache_generation = 0
+
+def _cache_conversation(conversation: Conversation):
+    """Cache a conversation whose messages were just read or written"""
+    _conversation_cache.set(conversation.id, (
+        conversation.user_id,
+        conversation.title,
+        conversation.created_at,
+        conversation.updated_at,
+        tuple(conversation._persisted)
+    ))
+
+def _cached_conversation(conversation_id: str) -> Optional[Conversation]:
+    entry = _conversation_cache.get(conversation_id)
+    if entry is None:
+        return None
+    user_id, title, created_at, updated_at, messages = entry
+    conversation = Conversation(
+        id=conversation_id,
+        user_id=user_id,
+        title=title,
+        messages=[
+            Message(role=role, content=content, name=name, content_type=content_type, image_url=image_url)
+            for role, content, name, content_type, image_url in messages
+        ],
+        created_at=created_at,
+        updated_at=updated_at
+    )
+    conversation._persisted = list(messages)
+    return conversation
+
+# Cross-worker invalidation: other workers drop their copy when one writes
+_worker_id = uuid.uuid4().hex
+_invalidation_listener: Optional[NotificationListener] = None
+invalidations_received = 0
+
+def _publish_invalidation(db: Session, conversation_id: str):
+    if _invalidation_listener is None:
+        return
+    notify(db, CONVERSATION_CACHE_CHANNEL, f"{_worker_id}:{conversation_id}")
+    db.commit()
+
+def _on_invalidation(payload: str):
+    global invalidations_received
+    worker_id, _, conversation_id = payload.partition(":")
+    if worker_id != _worker_id:
+        invalidations_received += 1
+        _conversation_cache.delete(conversation_id)
+        _image_context_cache.delete(conversation_id)
+
+def _clear_caches():
+    _conversation_cache.clear()
+    _image_context_cache.clear()
+
+def start_cache_invalidation():
+    """Start listening for writes made by other workers, if configured"""
+    global _invalidation_listener
+    if CONVERSATION_CACHE_INVALIDATION == "none" or _invalidation_listener is not None:
+        return
+    if CONVERSATION_CACHE_INVALIDATION != "postgres":
+        raise ValueError(f"Unknown cache invalidation mode: {CONVERSATION_CACHE_INVALIDATION}")
+    _invalidation_listener = NotificationListener(
+        engine,
+        CONVERSATION_CACHE_CHANNEL,
+        _on_invalidation,
+        # Notifications may have been missed while disconnected
+        on_reconnect=_clear_caches
+    )
+    _invalidation_listener.start()
+
+def stop_cache_invalidation():
+    global _invalidation_listener
+    if _invalidation_listener is not None:
+        _invalidation_listener.stop()
+        _invalidation_listener = None
+
+def conversation_cache_metrics() -> Dict[str, Any]:
+    """Hit rate and memory use of the conversation cache"""
+    stats = _conversation_cache.stats()
+    stats.update(invalidation=CONVERSATION_CACHE_INVALIDATION, invalidations_received=invalidations_received)
+    return stats
 
 # Conversation database operations
-def save_conversation(conversation: Conversation):
+async def save_conversation(conversation: Conversation):
     """Save a conversation to the database"""
-    db = get_session()
+    global _cache_generation
+    _cache_generation += 1
+    try:
+        await run_db(_save_conversation, conversation)
+    except Exception:
+        # The stored state is unknown now
+        _conversation_cache.delete(conversation.id)
+        raise
+    _cache_conversation(conversation)
 
+def _save_conversation(db: Session, conversation: Conversation):
     # Set the conversation title based on first message if not set
     if conversation.title == "New Conversation" and conversation.messages:
         conversation.title = get_conversation_title(conversation.messages)
 
-    # Check if conversation exists
-    existing = get_conversation_by_id(db, conversation.id)
-    if existing:
-        update_conversation(db, conversation)
+    # If the stored messages are an untouched prefix, only append the new ones
+    if stored_prefix_unchanged(conversation):
+        stored_count = len(conversation._persisted)
+        append_messages(db, conversation, stored_count)
+        mark_persisted(conversation, stored_count)
     else:
-        create_conversation(db, conversation)
+        # Earlier messages changed (or nothing is known): diff against
+        # storage, creating the conversation if it does not exist yet
+        update_conversation(db, conversation)
+        mark_persisted(conversation)
+    _publish_invalidation(db, conversation.id)
 
-def get_conversation(conversation_id: str) -> Optional[Conversation]:
-    """Get a conversation from the database"""
-    db = get_session()
-    return get_conversation_by_id(db, conversation_id)
+async def import_conversations(conversations: List[Conversation]) -> List[str]:
+    """Create the conversations whose ids are not taken yet, in one transaction; returns the ids created"""
+    return await run_db(bulk_create_conversations, conversations)
 
-def get_user_conversations(user_id: str, skip: int = 0, limit: int = 10) -> List[Conversation]:
-    """Get all conversations for a user"""
-    db = get_session()
-    return db_get_user_conversations(db, user_id, skip, limit)
+def export_user_conversations(
+    user_id: str, cursor: Optional[str] = None, limit: Optional[int] = None, images: bool = False
+) -> AsyncIterator[bytes]:
+    """The user's export as a byte stream (see export.py).
 
-def delete_user_conversation(conversation_id: str, user_id: str) -> bool:
+    A malformed cursor raises ValueError here, before anything is read.
+    """
+    if cursor:
+        decode_export_cursor(cursor)
+    return iterate_db(export_archive if images else export_lines, user_id, cursor, limit)
+
+async def get_conversation(conversation_id: str) -> Optional[Conversation]:
+    """Get a conversation, from the cache if it was used recently"""
+    conversation = _cached_conversation(conversation_id)
+    if conversation is None:
+        generation = _cache_generation
+        conversation = await run_db(get_conversation_by_id, conversation_id)
+        if conversation is not None and generation == _cache_generation:
+            _cache_conversation(conversation)
+    return conversation
+
+async def get_user_conversations(
+    user_id: str, skip: int = 0, limit: int = 10, cursor: Optional[str] = None
+) -> Tuple[List[Conversation], Optional[str]]:
+    """Get a page of a user's conversations with their messages, plus the cursor of the next page"""
+    return await run_db(db_get_user_conversations, user_id, skip, limit, cursor)
+
+async def get_user_conversation_summaries(
+    user_id: str, skip: int = 0, limit: int = 10, cursor: Optional[str] = None
+) -> Tuple[List[ConversationSummary], Optional[str]]:
+    """Get conversation summaries for a user, plus the cursor of the next page"""
+    return await run_db(db_get_user_conversation_summaries, user_id, skip, limit, cursor)
+
+async def search_user_messages(
+    user_id: str, query: str, limit: int = 20, cursor: Optional[str] = None
+) -> Tuple[List[MessageSearchResult], Optional[str]]:
+    """Full-text search over a user's messages, plus the cursor of the next page"""
+    return await run_db(search_messages, user_id, query, limit, cursor)
+
+async def delete_user_conversation(conversation_id: str, user_id: str) -> bool:
     """Delete a conversation"""
-    db = get_session()
-    return delete_conversation(db, conversation_id, user_id)
+    global _cache_generation
+    _cache_generation += 1
+    _conversation_cache.delete(conversation_id)
+    deleted = await run_db(_delete_conversation, conversation_id, user_id)
+    # Its images went with it
+    _forget_image_context(conversation_id, user_id)
+    return deleted
+
+def _delete_conversation(db: Session, conversation_id: str, user_id: str) -> bool:
+    deleted = delete_conversation(db, conversation_id, user_id)
+    if deleted:
+        _publish_invalidation(db, conversation_id)
+        _publish_invalidation(db, _user_image_key(user_id))
+    return deleted
+
+# Rolling context summary operations
+async def get_context_summary(conversation_id: str) -> Optional[Dict[str, Any]]:
+    """Get the cached summary of a conversation's older messages"""
+    return await run_db(_get_context_summary, conversation_id)
+
+def _get_context_summary(db: Session, conversation_id: str) -> Optional[Dict[str, Any]]:
+    db_summary = db_get_context_summary(db, conversation_id)
+    if not db_summary:
+        return None
+    return {
+        "covered_messages": db_summary.covered_messages,
+        "summary": db_summary.summary,
+        "token_count": db_summary.token_count
+    }
+
+async def save_context_summary(conversation_id: str, covered_messages: int, summary: str, token_count: int):
+    """Store the summary of a conversation's first covered_messages messages"""
+    await run_db(db_save_context_summary, conversation_id, covered_messages, summary, token_count)
+
+# Idempotency keys for retried requests
+async def claim_idempotency_key(user_id: str, key: str, request_hash: str) -> Optional[Dict[str, Any]]:
+    """Claim a key for a new request, or get {"request_hash", "response"} of the request that did"""
+    expires_before = datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+    return await run_db(db_claim_idempotency_key, user_id, key, request_hash, expires_before)
+
+async def save_idempotent_response(user_id: str, key: str, response: str):
+    """Keep the response to a claimed key for replay"""
+    await run_db(complete_idempotency_key, user_id, key, response)
+
+async def release_idempotency_key(user_id: str, key: str):
+    """Free the key of a request that failed"""
+    await run_db(db_release_idempotency_key, user_id, key)
+
+# Image index. Rows are never changed once written, so lookups are cached
+# without invalidation.
+_image_cache = LRUCache(max_entries=IMAGE_INDEX_CACHE_SIZE)
+
+# Latest image ({"id", "prompt", "revision"}) by conversation id and by
+# _user_image_key, kept current by writes here and by other workers' notifications
+_image_context_cache = LRUCache(max_entries=IMAGE_CONTEXT_CACHE_SIZE)
+# Bumped by every image write, so a read that raced with one is not cached
+_image_context_generation = 0
+
+def _user_image_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def _forget_image_context(conversation_id: Optional[str], user_id: str):
+    global _image_context_generation
+    _image_context_generation += 1
+    if conversation_id:
+        _image_context_cache.delete(conversation_id)
+    _image_context_cache.delete(_user_image_key(user_id))
+
+async def save_image_record(
+    image_id: str,
+    user_id: str,
+    prompt: str,
+    image_path: str,
+    content_hash: str,
+    mime_type: str,
+    size_bytes: int,
+    conversation_id: Optional[str] = None,
+    is_modification: bool = False,
+    original_image_id: Optional[str] = None,
+    revision: int = 0
+):
+    """Record which stored blob an image id refers to, and make it the latest image of its conversation"""
+    _forget_image_context(conversation_id, user_id)
+    await run_db(
+        _save_image_record, image_id, user_id, prompt, image_path, content_hash,
+        mime_type, size_bytes, conversation_id, is_modification, original_image_id, revision
+    )
+    _image_cache.set(image_id, (content_hash, mime_type))
+    context = {"id": image_id, "prompt": prompt, "revision": revision}
+    if conversation_id:
+        _image_context_cache.set(conversation_id, context)
+    _image_context_cache.set(_user_image_key(user_id), context)
+
+def _save_image_record(
+    db: Session,
+    image_id: str,
+    user_id: str,
+    prompt: str,
+    image_path: str,
+    content_hash: str,
+    mime_type: str,
+    size_bytes: int,
+    conversation_id: Optional[str],
+    is_modification: bool,
+    original_image_id: Optional[str],
+    revision: int
+):
+    create_image(
+        db, image_id, user_id, prompt, image_path, content_hash, mime_type, size_bytes,
+        conversation_id, is_modification, original_image_id, revision
+    )
+    if conversation_id:
+        _publish_invalidation(db, conversation_id)
+    _publish_invalidation(db, _user_image_key(user_id))
+
+async def get_image_context(conversation_id: Optional[str] = None, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Latest image of a conversation, or of a user's conversations if no conversation is given"""
+    key = conversation_id if conversation_id is not None else _user_image_key(user_id)
+    context = _image_context_cache.get(key)
+    if context is None:
+        generation = _image_context_generation
+        context = await run_db(get_latest_image, conversation_id, user_id)
+        if context is not None and generation == _image_context_generation:
+            _image_context_cache.set(key, context)
+    return context
+
+async def get_image_blob(image_id: str) -> Optional[Tuple[str, str]]:
+    """(content hash, MIME type) of a stored image, or None"""
+    blob = _image_cache.get(image_id)
+    if blob is None:
+        blob = await run_db(db_get_image_blob, image_id)
+        if blob is not None:
+            _image_cache.set(image_id, blob)
+    return blob
+
+def image_cache_metrics() -> Dict[str, Any]:
+    """Hit rates of the image id and latest-image lookups"""
+    return {"index": _image_cache.stats(), "context": _image_context_cache.stats()}
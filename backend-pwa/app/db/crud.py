@@ -1,15 +1,28 @@
 """
 CRUD operations for the database
 """
-from datetime import datetime
-from typing import List, Dict, Any, Optional
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
+import base64
+import html
+import re
+from collections import Counter
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, Query
+from sqlalchemy import bindparam, desc, func, insert, literal, select, text, and_, or_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from . import models
+from ..config import SEARCH_MAX_CANDIDATES
 from ..models import User as UserSchema
 from ..models import Conversation as ConversationSchema
 from ..models import Message as MessageSchema
+from ..models import ConversationSummary as ConversationSummarySchema
+from ..models import MessageSearchResult as MessageSearchResultSchema
+
+# Length of the last-message preview returned in conversation summaries
+PREVIEW_LENGTH = 100
 
 # User operations
 def create_or_update_user(db: Session, user: UserSchema) -> Dict[str, Any]:
@@ -47,6 +60,7 @@ def create_or_update_user(db: Session, user: UserSchema) -> Dict[str, Any]:
         "picture": db_user.picture,
         "given_name": db_user.given_name,
         "family_name": db_user.family_name,
+        "conversations_count": db_user.conversations_count,
         "created_at": db_user.created_at.isoformat(),
         "updated_at": db_user.updated_at.isoformat()
     }
@@ -68,6 +82,7 @@ def get_user_by_id(db: Session, user_id: str) -> Optional[Dict[str, Any]]:
         "picture": db_user.picture,
         "given_name": db_user.given_name,
         "family_name": db_user.family_name,
+        "conversations_count": db_user.conversations_count,
         "created_at": db_user.created_at.isoformat(),
         "updated_at": db_user.updated_at.isoformat()
     }
@@ -76,40 +91,89 @@ def get_user_by_id(db: Session, user_id: str) -> Optional[Dict[str, Any]]:
 
 def get_user_conversations_count(db: Session, user_id: str) -> int:
     """Get the number of conversations for a user"""
-    return db.query(func.count(models.Conversation.id)).filter(models.Conversation.user_id == user_id).scalar() or 0
+    return db.query(models.User.conversations_count).filter(models.User.user_id == user_id).scalar() or 0
 
 # Conversation operations
 def create_conversation(db: Session, conversation: ConversationSchema) -> models.Conversation:
-    """Create a new conversation"""
+    """Create a new conversation and its messages in one transaction"""
     db_conversation = models.Conversation(
         id=conversation.id,
         user_id=conversation.user_id,
-        title=conversation.title
+        title=conversation.title,
+        message_count=len(conversation.messages),
+        last_message_at=func.now() if conversation.messages else None
     )
     db.add(db_conversation)
+    # The messages refer to the conversation row
+    db.flush()
+    _adjust_conversations_count(db, conversation.user_id, 1)
+    _insert_messages(db, conversation.id, conversation.messages, 0)
     db.commit()
-    db.refresh(db_conversation)
-    
-    # Add messages if any
-    if conversation.messages:
-        for i, message in enumerate(conversation.messages):
-            db_message = models.Message(
-                conversation_id=db_conversation.id,
-                role=message.role,
-                content=message.content,
-                name=message.name,
-                content_type=message.content_type,
-                image_url=message.image_url,
-                sequence_number=i
-            )
-            db.add(db_message)
-        
-        db.commit()
-    
     return db_conversation
 
+def _parse_timestamp(value: str) -> datetime:
+    """ISO timestamp, in UTC if it has an offset (SQLite would store it without one)"""
+    parsed = datetime.fromisoformat(value)
+    return parsed.astimezone(timezone.utc) if parsed.tzinfo else parsed
+
+def bulk_create_conversations(db: Session, conversations: List[ConversationSchema]) -> List[str]:
+    """Create many conversations and their messages in one transaction.
+
+    Conversations are written with one multi-row INSERT that skips ids
+    already stored and returns the ids it did write; only their messages are
+    inserted, again in multi-row batches. Counters are set as the rows are
+    written, and created_at/updated_at are kept. Returns the ids created.
+    """
+    unique: Dict[str, ConversationSchema] = {}
+    for conversation in conversations:
+        unique.setdefault(conversation.id, conversation)
+    if not unique:
+        return []
+
+    rows = []
+    for conversation in unique.values():
+        created_at = _parse_timestamp(conversation.created_at)
+        updated_at = _parse_timestamp(conversation.updated_at)
+        rows.append({
+            "id": conversation.id,
+            "user_id": conversation.user_id,
+            "title": conversation.title,
+            "message_count": len(conversation.messages),
+            "last_message_at": updated_at if conversation.messages else None,
+            "created_at": created_at,
+            "updated_at": updated_at
+        })
+    dialect_insert = postgresql_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    created = set(db.scalars(
+        dialect_insert(models.Conversation).on_conflict_do_nothing(index_elements=["id"]).returning(models.Conversation.id),
+        rows,
+        execution_options=_ONE_BATCH
+    ).all())
+
+    message_rows = [
+        {
+            "conversation_id": conversation.id,
+            "role": message.role,
+            "content": message.content,
+            "name": message.name,
+            "content_type": message.content_type,
+            "image_url": message.image_url,
+            "sequence_number": i
+        }
+        for conversation in unique.values() if conversation.id in created
+        for i, message in enumerate(conversation.messages)
+    ]
+    if message_rows:
+        db.execute(insert(models.Message), message_rows, execution_options=_ONE_BATCH)
+
+    created_per_user = Counter(conversation.user_id for conversation in unique.values() if conversation.id in created)
+    for user_id, count in created_per_user.items():
+        _adjust_conversations_count(db, user_id, count)
+    db.commit()
+    return [conversation_id for conversation_id in unique if conversation_id in created]
+
 def update_conversation(db: Session, conversation: ConversationSchema) -> models.Conversation:
-    """Update an existing conversation"""
+    """Update an existing conversation, writing only the messages that differ"""
     db_conversation = db.query(models.Conversation).filter(models.Conversation.id == conversation.id).first()
     
     if not db_conversation:
@@ -117,31 +181,16 @@ def update_conversation(db: Session, conversation: ConversationSchema) -> models
     
     # Update conversation title
     db_conversation.title = conversation.title
-    db.commit()
+    db_conversation.message_count = len(conversation.messages)
     
     # Get existing messages
-    existing_messages = db.query(models.Message).filter(models.Message.conversation_id == conversation.id).all()
-    
-    # If the number of messages is different, delete all and recreate
-    if len(existing_messages) != len(conversation.messages):
-        # Delete all existing messages
-        db.query(models.Message).filter(models.Message.conversation_id == conversation.id).delete()
-        
-        # Add all messages
-        for i, message in enumerate(conversation.messages):
-            db_message = models.Message(
-                conversation_id=db_conversation.id,
-                role=message.role,
-                content=message.content,
-                name=message.name,
-                content_type=message.content_type,
-                image_url=message.image_url,
-                sequence_number=i
-            )
-            db.add(db_message)
-    else:
-        # Update existing messages
-        for i, (existing, new) in enumerate(zip(existing_messages, conversation.messages)):
+    existing_messages = db.query(models.Message).filter(
+        models.Message.conversation_id == conversation.id
+    ).order_by(models.Message.sequence_number).all()
+    
+    # Update the rows whose content changed
+    for i, (existing, new) in enumerate(zip(existing_messages, conversation.messages)):
+        if _message_fields(existing) != _message_fields(new) or existing.sequence_number != i:
             existing.role = new.role
             existing.content = new.content
             existing.name = new.name
@@ -149,75 +198,200 @@ def update_conversation(db: Session, conversation: ConversationSchema) -> models
             existing.image_url = new.image_url
             existing.sequence_number = i
     
+    if [_message_fields(msg) for msg in existing_messages] != [_message_fields(msg) for msg in conversation.messages]:
+        db_conversation.last_message_at = func.now()
+
+    if len(existing_messages) > len(conversation.messages):
+        # Drop messages that were removed from the end
+        removed_ids = [msg.id for msg in existing_messages[len(conversation.messages):]]
+        db.query(models.Message).filter(models.Message.id.in_(removed_ids)).delete(synchronize_session=False)
+    elif len(existing_messages) < len(conversation.messages):
+        # Add messages that were appended
+        _insert_messages(db, conversation.id, conversation.messages[len(existing_messages):], len(existing_messages))
+    
     db.commit()
     db.refresh(db_conversation)
     return db_conversation
 
+# Tries append_messages makes while other requests keep appending first
+APPEND_ATTEMPTS = 3
+
+def append_messages(db: Session, conversation: ConversationSchema, start_sequence: int) -> int:
+    """Append conversation.messages[start_sequence:] to an existing conversation.
+
+    Stored messages are not read or rewritten; the new rows go out in a single
+    multi-row INSERT. If another request appended to the conversation first,
+    the stored messages are read back: when they already end with these
+    messages (a double submit) nothing more is written, otherwise the new
+    messages go after them. conversation.messages then matches storage.
+    Returns the number of messages written.
+    """
+    new_messages = conversation.messages[start_sequence:]
+    for _ in range(APPEND_ATTEMPTS):
+        try:
+            # Touch the conversation so title and updated_at stay current
+            db.query(models.Conversation).filter(models.Conversation.id == conversation.id).update(
+                {
+                    models.Conversation.title: conversation.title,
+                    models.Conversation.message_count: models.Conversation.message_count + len(new_messages),
+                    models.Conversation.last_message_at: func.now()
+                },
+                synchronize_session=False
+            )
+            _insert_messages(db, conversation.id, new_messages, start_sequence)
+            db.commit()
+            return len(new_messages)
+        except IntegrityError:
+            # Another request took these sequence numbers
+            db.rollback()
+
+        stored = [_message_from_row(row) for row in db.execute(
+            select(*_MESSAGE_COLUMNS)
+            .where(models.Message.conversation_id == conversation.id)
+            .order_by(models.Message.sequence_number)
+        )]
+        new_fields = [_message_fields(message) for message in new_messages]
+        if len(stored) >= len(new_fields) and [
+            _message_fields(message) for message in stored[len(stored) - len(new_fields):]
+        ] == new_fields:
+            conversation.messages = stored
+            return 0
+        conversation.messages = stored + new_messages
+        start_sequence = len(stored)
+    raise RuntimeError(f"Could not append to conversation {conversation.id}: it kept changing")
+
 def get_conversation_by_id(db: Session, conversation_id: str) -> Optional[ConversationSchema]:
-    """Get a conversation by ID"""
-    db_conversation = db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
-    
-    if not db_conversation:
+    """Get a conversation and its messages in one query"""
+    rows = db.execute(
+        select(*_CONVERSATION_COLUMNS, *_MESSAGE_COLUMNS)
+        .outerjoin(models.Message, models.Message.conversation_id == models.Conversation.id)
+        .where(models.Conversation.id == conversation_id)
+        .order_by(models.Message.sequence_number)
+    ).all()
+
+    if not rows:
         return None
-    
-    # Get messages
-    db_messages = db.query(models.Message).filter(models.Message.conversation_id == conversation_id).order_by(models.Message.sequence_number).all()
-    
-    # Convert to Pydantic model
-    messages = []
-    for msg in db_messages:
-        messages.append(MessageSchema(
-            role=msg.role,
-            content=msg.content,
-            name=msg.name,
-            content_type=msg.content_type,
-            image_url=msg.image_url
-        ))
-    
-    return ConversationSchema(
-        id=db_conversation.id,
-        user_id=db_conversation.user_id,
-        title=db_conversation.title,
-        messages=messages,
-        created_at=db_conversation.created_at.isoformat(),
-        updated_at=db_conversation.updated_at.isoformat()
+
+    conversation = _conversation_from_row(rows[0], [_message_from_row(row) for row in rows if row.role is not None])
+    mark_persisted(conversation)
+    return conversation
+
+def get_user_conversations(
+    db: Session, user_id: str, skip: int = 0, limit: int = 10, cursor: Optional[str] = None
+) -> Tuple[List[ConversationSchema], Optional[str]]:
+    """Get a page of a user's conversations with their messages.
+
+    Returns the page and the cursor for the next page, if any.
+    """
+    query = db.query(*_CONVERSATION_COLUMNS).filter(models.Conversation.user_id == user_id)
+    # Fetch one extra row to know whether there is a next page
+    headers = _paginate_conversations(query, skip, limit + 1, cursor).all()
+    next_cursor = None
+    if len(headers) > limit:
+        headers = headers[:limit]
+        next_cursor = encode_conversation_cursor(headers[-1].updated_at, headers[-1].id)
+    if not headers:
+        return [], None
+
+    # Messages for the whole page in one query
+    messages: Dict[str, List[MessageSchema]] = {header.id: [] for header in headers}
+    rows = db.execute(
+        select(models.Message.conversation_id, *_MESSAGE_COLUMNS)
+        .where(models.Message.conversation_id.in_(list(messages)))
+        .order_by(models.Message.conversation_id, models.Message.sequence_number)
     )
+    for row in rows:
+        messages[row.conversation_id].append(_message_from_row(row))
 
-def get_user_conversations(db: Session, user_id: str, skip: int = 0, limit: int = 10) -> List[ConversationSchema]:
-    """Get all conversations for a user"""
-    db_conversations = db.query(models.Conversation).filter(
-        models.Conversation.user_id == user_id
-    ).order_by(desc(models.Conversation.updated_at)).offset(skip).limit(limit).all()
-    
-    conversations = []
-    for conv in db_conversations:
-        # Get messages for this conversation
-        db_messages = db.query(models.Message).filter(
-            models.Message.conversation_id == conv.id
-        ).order_by(models.Message.sequence_number).all()
-        
-        # Convert messages to Pydantic models
-        messages = []
-        for msg in db_messages:
-            messages.append(MessageSchema(
-                role=msg.role,
-                content=msg.content,
-                name=msg.name,
-                content_type=msg.content_type,
-                image_url=msg.image_url
-            ))
-        
-        # Create conversation schema
-        conversations.append(ConversationSchema(
-            id=conv.id,
-            user_id=conv.user_id,
-            title=conv.title,
-            messages=messages,
-            created_at=conv.created_at.isoformat(),
-            updated_at=conv.updated_at.isoformat()
+    return [_conversation_from_row(header, messages[header.id]) for header in headers], next_cursor
+
+def iter_user_conversations(
+    db: Session, user_id: str, cursor: Optional[str] = None, yield_per: int = 1000
+) -> Iterator[Tuple[ConversationSchema, str]]:
+    """Every conversation of a user, oldest first, each with the cursor that resumes after it.
+
+    One query joins the conversations with their messages and is read
+    through a server-side cursor yield_per rows at a time, so only one
+    conversation is held in memory however long the history is.
+    """
+    statement = (
+        select(*_CONVERSATION_COLUMNS, *_MESSAGE_COLUMNS)
+        .outerjoin(models.Message, models.Message.conversation_id == models.Conversation.id)
+        .where(models.Conversation.user_id == user_id)
+        .order_by(models.Conversation.created_at, models.Conversation.id, models.Message.sequence_number)
+    )
+    if cursor:
+        created_at, conversation_id = decode_export_cursor(cursor)
+        column, value = models.Conversation.created_at, created_at
+        if db.get_bind().dialect.name == "sqlite":
+            # As in _paginate_conversations
+            column, value = func.julianday(column), func.julianday(value)
+        statement = statement.where(or_(
+            column > value,
+            and_(column == value, models.Conversation.id > conversation_id)
         ))
+
+    header, messages = None, []
+    for row in db.execute(statement, execution_options={"yield_per": yield_per}):
+        if header is not None and row.id != header.id:
+            yield _conversation_from_row(header, messages), encode_export_cursor(header.created_at, header.id)
+            header, messages = None, []
+        if header is None:
+            header = row
+        if row.role is not None:
+            messages.append(_message_from_row(row))
+    if header is not None:
+        yield _conversation_from_row(header, messages), encode_export_cursor(header.created_at, header.id)
+
+def get_user_conversation_summaries(
+    db: Session,
+    user_id: str,
+    skip: int = 0,
+    limit: int = 10,
+    cursor: Optional[str] = None
+) -> Tuple[List[ConversationSummarySchema], Optional[str]]:
+    """Get conversation summaries for a user in a single query.
+
+    Returns the page of summaries and the cursor for the next page, if any.
+    """
+    last_message_preview = select(func.substr(models.Message.content, 1, PREVIEW_LENGTH)).where(
+        models.Message.conversation_id == models.Conversation.id
+    ).order_by(desc(models.Message.sequence_number)).limit(1).correlate(models.Conversation).scalar_subquery()
+    
+    query = db.query(
+        models.Conversation.id,
+        models.Conversation.user_id,
+        models.Conversation.title,
+        models.Conversation.created_at,
+        models.Conversation.updated_at,
+        models.Conversation.message_count,
+        models.Conversation.last_message_at,
+        last_message_preview.label("last_message_preview")
+    ).filter(models.Conversation.user_id == user_id)
+    
+    # Fetch one extra row to know whether there is a next page
+    rows = _paginate_conversations(query, skip, limit + 1, cursor).all()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_conversation_cursor(rows[-1].updated_at, rows[-1].id)
+    
+    summaries = [
+        ConversationSummarySchema(
+            id=row.id,
+            user_id=row.user_id,
+            title=row.title,
+            message_count=row.message_count,
+            last_message_preview=row.last_message_preview,
+            last_message_at=row.last_message_at.isoformat() if row.last_message_at else None,
+            created_at=row.created_at.isoformat(),
+            updated_at=row.updated_at.isoformat()
+        )
+        for row in rows
+    ]
     
-    return conversations
+    return summaries, next_cursor
 
 def delete_conversation(db: Session, conversation_id: str, user_id: str) -> bool:
     """Delete a conversation"""
@@ -230,9 +404,335 @@ def delete_conversation(db: Session, conversation_id: str, user_id: str) -> bool
         return False
     
     db.delete(db_conversation)
+    # Their blobs are collected once no other image refers to them
+    db.query(models.Image).filter(models.Image.conversation_id == conversation_id).delete(synchronize_session=False)
+    _adjust_conversations_count(db, user_id, -1)
     db.commit()
     return True
 
+# Full-text search over message content (see migration 4)
+# Highlight markers put in by the database, replaced after HTML-escaping
+_MATCH_START, _MATCH_END = "\x02", "\x03"
+
+_POSTGRES_SEARCH = """
+WITH search AS (SELECT websearch_to_tsquery('english', :query) AS q),
+candidates AS (
+    SELECT m.id, m.conversation_id, m.role, m.sequence_number, m.content, m.content_tsv, c.title
+    FROM messages m
+    JOIN conversations c ON c.id = m.conversation_id
+    CROSS JOIN search
+    WHERE c.user_id = :user_id AND m.content_tsv @@ search.q
+    ORDER BY m.id DESC
+    LIMIT :candidates
+),
+ranked AS (
+    SELECT candidates.*, ts_rank(content_tsv, (SELECT q FROM search))::float8 AS rank FROM candidates
+),
+page AS (
+    SELECT * FROM ranked WHERE {after} ORDER BY rank DESC, id DESC LIMIT :limit
+)
+SELECT id, conversation_id, role, sequence_number, title, rank,
+       ts_headline('english', content, (SELECT q FROM search),
+                   'StartSel=\x02, StopSel=\x03, MinWords=10, MaxWords=30, MaxFragments=2') AS snippet
+FROM page
+ORDER BY rank DESC, id DESC
+"""
+
+_SQLITE_SEARCH = """
+SELECT id, conversation_id, role, sequence_number, title, rank FROM (
+    SELECT m.id, m.conversation_id, m.role, m.sequence_number, c.title, -bm25(messages_fts) AS rank
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :query AND c.user_id = :user_id
+    ORDER BY messages_fts.rowid DESC
+    LIMIT :candidates
+)
+WHERE {after}
+ORDER BY rank DESC, id DESC
+LIMIT :limit
+"""
+
+# snippet() needs the MATCH, so it runs again for just the page's rows
+_SQLITE_SNIPPETS = text(
+    "SELECT rowid, snippet(messages_fts, 0, char(2), char(3), '...', 24) FROM messages_fts "
+    "WHERE messages_fts MATCH :query AND rowid IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+def _fts5_query(query: str) -> str:
+    """Quote each word so user input is never read as FTS5 query syntax"""
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"' for word in words)
+
+def search_messages(
+    db: Session,
+    user_id: str,
+    query: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    max_candidates: int = SEARCH_MAX_CANDIDATES
+) -> Tuple[List[MessageSearchResultSchema], Optional[str]]:
+    """Find a user's messages matching query, best match first.
+
+    Only the newest max_candidates matches are ranked, which bounds the cost
+    of very common words. Dialects other than PostgreSQL and SQLite have no
+    full-text index and get a substring match instead. Returns the page of
+    results and the cursor for the next page, if any.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        sql, params = _POSTGRES_SEARCH, {"query": query}
+    elif dialect == "sqlite":
+        sql, params = _SQLITE_SEARCH, {"query": _fts5_query(query)}
+        if not params["query"]:
+            return [], None
+    else:
+        return _search_messages_like(db, user_id, query, limit, cursor)
+
+    after = "TRUE"
+    if cursor:
+        params["after_rank"], params["after_id"] = decode_search_cursor(cursor)
+        after = "(rank < :after_rank OR (rank = :after_rank AND id < :after_id))"
+    params.update(user_id=user_id, candidates=max_candidates, limit=limit + 1)
+
+    # Fetch one extra row to know whether there is a next page
+    rows = db.execute(text(sql.format(after=after)), params).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1].rank, rows[-1].id)
+
+    if dialect == "sqlite" and rows:
+        snippets = dict(db.execute(_SQLITE_SNIPPETS, {"query": params["query"], "ids": [row.id for row in rows]}).all())
+    else:
+        snippets = {row.id: row.snippet for row in rows}
+
+    return [_search_result(row, snippets.get(row.id)) for row in rows], next_cursor
+
+def _search_result(row, snippet: Optional[str]) -> MessageSearchResultSchema:
+    return MessageSearchResultSchema(
+        conversation_id=row.conversation_id,
+        conversation_title=row.title,
+        message_id=row.id,
+        role=row.role,
+        sequence_number=row.sequence_number,
+        snippet=html.escape(snippet or "").replace(_MATCH_START, "<mark>").replace(_MATCH_END, "</mark>"),
+        rank=row.rank
+    )
+
+def _like_snippet(content: str, words: List[str], width: int = 60) -> str:
+    """Excerpt around the first match, with every match marked"""
+    pattern = re.compile("|".join(re.escape(word) for word in words), re.IGNORECASE)
+    first = pattern.search(content)
+    start = max(0, first.start() - width) if first else 0
+    excerpt = content[start:start + 3 * width]
+    excerpt = pattern.sub(lambda match: f"{_MATCH_START}{match.group(0)}{_MATCH_END}", excerpt)
+    return ("..." if start else "") + excerpt + ("..." if start + 3 * width < len(content) else "")
+
+def _search_messages_like(
+    db: Session, user_id: str, query: str, limit: int, cursor: Optional[str]
+) -> Tuple[List[MessageSearchResultSchema], Optional[str]]:
+    """Substring search for dialects without a full-text index: every word must appear, newest first.
+
+    All matches rank 0, so the (rank, id) cursor pages by id alone.
+    """
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return [], None
+    statement = select(
+        models.Message.id,
+        models.Message.conversation_id,
+        models.Message.role,
+        models.Message.sequence_number,
+        models.Message.content,
+        models.Conversation.title,
+        literal(0.0).label("rank")
+    ).join(models.Conversation, models.Conversation.id == models.Message.conversation_id).where(
+        models.Conversation.user_id == user_id,
+        *(
+            func.lower(models.Message.content).like("%" + re.sub(r"([\\%_])", r"\\\1", word) + "%", escape="\\")
+            for word in words
+        )
+    )
+    if cursor:
+        statement = statement.where(models.Message.id < decode_search_cursor(cursor)[1])
+    rows = db.execute(statement.order_by(desc(models.Message.id)).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1].rank, rows[-1].id)
+    return [_search_result(row, _like_snippet(row.content, words)) for row in rows], next_cursor
+
+# Denormalized counters
+def _adjust_conversations_count(db: Session, user_id: str, delta: int) -> None:
+    # Setting updated_at to itself keeps its onupdate default out of the statement
+    db.query(models.User).filter(models.User.user_id == user_id).update(
+        {
+            models.User.conversations_count: models.User.conversations_count + delta,
+            models.User.updated_at: models.User.updated_at
+        },
+        synchronize_session=False
+    )
+
+def repair_counters(db: Session) -> Dict[str, int]:
+    """Recompute every denormalized counter in bulk.
+
+    Only rows whose stored values are wrong are written. Returns the number
+    of users and conversations that were corrected. updated_at is left as
+    it was: a repaired counter is not a change to the row.
+    """
+    conversations_count = select(func.count(models.Conversation.id)).where(
+        models.Conversation.user_id == models.User.user_id
+    ).correlate(models.User).scalar_subquery()
+    users = db.query(models.User).filter(models.User.conversations_count != conversations_count).update(
+        {models.User.conversations_count: conversations_count, models.User.updated_at: models.User.updated_at},
+        synchronize_session=False
+    )
+
+    message_count = select(func.count(models.Message.id)).where(
+        models.Message.conversation_id == models.Conversation.id
+    ).correlate(models.Conversation).scalar_subquery()
+    last_message_at = select(func.max(models.Message.created_at)).where(
+        models.Message.conversation_id == models.Conversation.id
+    ).correlate(models.Conversation).scalar_subquery()
+    conversations = db.query(models.Conversation).filter(or_(
+        models.Conversation.message_count != message_count,
+        and_(models.Conversation.last_message_at.is_(None), message_count > 0)
+    )).update(
+        {
+            models.Conversation.message_count: message_count,
+            models.Conversation.last_message_at: last_message_at,
+            models.Conversation.updated_at: models.Conversation.updated_at
+        },
+        synchronize_session=False
+    )
+
+    db.commit()
+    return {"users": users, "conversations": conversations}
+
+# Rolling context summaries
+def get_context_summary(db: Session, conversation_id: str) -> Optional[models.ContextSummary]:
+    """Get the cached summary of a conversation's older messages"""
+    return db.query(models.ContextSummary).filter(models.ContextSummary.conversation_id == conversation_id).first()
+
+def save_context_summary(db: Session, conversation_id: str, covered_messages: int, summary: str, token_count: int) -> None:
+    """Create or replace the cached summary of a conversation's older messages"""
+    db_summary = get_context_summary(db, conversation_id)
+    if db_summary is None:
+        db_summary = models.ContextSummary(conversation_id=conversation_id)
+        db.add(db_summary)
+    db_summary.covered_messages = covered_messages
+    db_summary.summary = summary
+    db_summary.token_count = token_count
+    db.commit()
+
+# Images
+def create_image(
+    db: Session,
+    image_id: str,
+    user_id: str,
+    prompt: str,
+    image_path: str,
+    content_hash: str,
+    mime_type: str,
+    size_bytes: int,
+    conversation_id: Optional[str] = None,
+    is_modification: bool = False,
+    original_image_id: Optional[str] = None,
+    revision: int = 0
+) -> None:
+    """Record which stored blob an image id refers to, and where it came from"""
+    db.add(models.Image(
+        id=image_id,
+        user_id=user_id,
+        prompt=prompt,
+        image_path=image_path,
+        content_hash=content_hash,
+        mime_type=mime_type,
+        size_bytes=size_bytes,
+        conversation_id=conversation_id,
+        is_modification=is_modification,
+        original_image_id=original_image_id,
+        revision=revision,
+        # Set here rather than by the database, whose clock may only have
+        # second resolution: the latest image is found by created_at
+        created_at=datetime.now(timezone.utc)
+    ))
+    db.commit()
+
+def get_latest_image(db: Session, conversation_id: Optional[str] = None, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """The newest image of a conversation, or of a user if no conversation is given"""
+    query = db.query(models.Image.id, models.Image.prompt, models.Image.revision)
+    if conversation_id is not None:
+        query = query.filter(models.Image.conversation_id == conversation_id)
+    else:
+        query = query.filter(models.Image.user_id == user_id)
+    row = query.order_by(desc(models.Image.created_at)).first()
+    if row is None:
+        return None
+    return {"id": row.id, "prompt": row.prompt, "revision": row.revision}
+
+def get_image_blob(db: Session, image_id: str) -> Optional[Tuple[str, str]]:
+    """(content hash, MIME type) of an image, or None if it is not in the store"""
+    row = db.query(models.Image.content_hash, models.Image.mime_type).filter(
+        models.Image.id == image_id,
+        models.Image.content_hash.isnot(None)
+    ).first()
+    return (row.content_hash, row.mime_type) if row else None
+
+def get_referenced_image_hashes(db: Session) -> List[str]:
+    """Hashes of every blob some image still refers to"""
+    rows = db.query(models.Image.content_hash).filter(models.Image.content_hash.isnot(None)).distinct()
+    return [row.content_hash for row in rows]
+
+# Idempotency keys
+def claim_idempotency_key(
+    db: Session, user_id: str, key: str, request_hash: str, expires_before: datetime
+) -> Optional[Dict[str, Any]]:
+    """Claim a key for a new request. If it was already claimed, returns its
+    {"request_hash", "response"} instead; response is None while that request runs.
+    """
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.created_at < expires_before
+    ).delete(synchronize_session=False)
+    db.add(models.IdempotencyKey(
+        user_id=user_id,
+        idempotency_key=key,
+        request_hash=request_hash,
+        created_at=datetime.now(timezone.utc)
+    ))
+    try:
+        db.commit()
+        return None
+    except IntegrityError:
+        db.rollback()
+    row = db.query(models.IdempotencyKey.request_hash, models.IdempotencyKey.response).filter(
+        models.IdempotencyKey.user_id == user_id,
+        models.IdempotencyKey.idempotency_key == key
+    ).first()
+    if row is None:
+        # Released by a failed request in the meantime: still busy as far as
+        # this request knows, and the next retry claims it
+        return {"request_hash": request_hash, "response": None}
+    return {"request_hash": row.request_hash, "response": row.response}
+
+def complete_idempotency_key(db: Session, user_id: str, key: str, response: str) -> None:
+    """Store the response to replay for a claimed key"""
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.user_id == user_id,
+        models.IdempotencyKey.idempotency_key == key
+    ).update({models.IdempotencyKey.response: response}, synchronize_session=False)
+    db.commit()
+
+def release_idempotency_key(db: Session, user_id: str, key: str) -> None:
+    """Give up a claimed key whose request failed, so a retry runs it again"""
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.user_id == user_id,
+        models.IdempotencyKey.idempotency_key == key,
+        models.IdempotencyKey.response.is_(None)
+    ).delete(synchronize_session=False)
+    db.commit()
+
 # Helper function to get conversation title from messages
 def get_conversation_title(messages: List[MessageSchema]) -> str:
     """Extract title from the first user message in conversation"""
@@ -249,3 +749,143 @@ def get_conversation_title(messages: List[MessageSchema]) -> str:
             return title
 
     return "New Conversation"
+
+def _encode_keyset(timestamp: datetime, conversation_id: str) -> str:
+    raw = f"{timestamp.isoformat()}|{conversation_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def _decode_keyset(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        timestamp, conversation_id = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), conversation_id
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+# Keyset pagination over (updated_at, id), newest first
+def encode_conversation_cursor(updated_at: datetime, conversation_id: str) -> str:
+    """Encode the position after a conversation as an opaque cursor"""
+    return _encode_keyset(updated_at, conversation_id)
+
+def decode_conversation_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor from encode_conversation_cursor, raising ValueError if malformed"""
+    return _decode_keyset(cursor)
+
+# Export order: (created_at, id), oldest first
+def encode_export_cursor(created_at: datetime, conversation_id: str) -> str:
+    """Encode the position after an exported conversation as an opaque cursor"""
+    return _encode_keyset(created_at, conversation_id)
+
+def decode_export_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor from encode_export_cursor, raising ValueError if malformed"""
+    return _decode_keyset(cursor)
+
+# Keyset pagination over (rank, id) for search results
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    raw = f"{rank!r}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    """Decode a cursor from encode_search_cursor, raising ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        rank, message_id = raw.split("|", 1)
+        return float(rank), int(message_id)
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _paginate_conversations(query: Query, skip: int, limit: int, cursor: Optional[str]) -> Query:
+    """Order conversations newest first and apply a cursor, or an offset if no cursor is given"""
+    query = query.order_by(desc(models.Conversation.updated_at), desc(models.Conversation.id))
+    
+    if cursor:
+        updated_at, conversation_id = decode_conversation_cursor(cursor)
+        column, value = models.Conversation.updated_at, updated_at
+        if query.session.get_bind().dialect.name == "sqlite":
+            # SQLite keeps timestamps as text in mixed formats; compare them as numbers
+            column, value = func.julianday(column), func.julianday(value)
+        query = query.filter(or_(
+            column < value,
+            and_(column == value, models.Conversation.id < conversation_id)
+        ))
+    elif skip:
+        query = query.offset(skip)
+    
+    return query.limit(limit)
+
+# Column-only reads that map rows straight into response models
+_CONVERSATION_COLUMNS = (
+    models.Conversation.id,
+    models.Conversation.user_id,
+    models.Conversation.title,
+    models.Conversation.created_at,
+    models.Conversation.updated_at
+)
+_MESSAGE_COLUMNS = (
+    models.Message.role,
+    models.Message.content,
+    models.Message.name,
+    models.Message.content_type,
+    models.Message.image_url
+)
+
+def _message_from_row(row) -> MessageSchema:
+    return MessageSchema(
+        role=row.role,
+        content=row.content,
+        name=row.name,
+        content_type=row.content_type,
+        image_url=row.image_url
+    )
+
+def _conversation_from_row(row, messages: List[MessageSchema]) -> ConversationSchema:
+    return ConversationSchema(
+        id=row.id,
+        user_id=row.user_id,
+        title=row.title,
+        messages=messages,
+        created_at=row.created_at.isoformat(),
+        updated_at=row.updated_at.isoformat()
+    )
+
+# Helpers for incremental message persistence
+# Bulk INSERTs send NULLs rather than leaving out columns that are None,
+# which would split rows with and without them into separate statements
+_ONE_BATCH = {"render_nulls": True}
+
+def _message_fields(message) -> tuple:
+    """Fields of a message (ORM row or schema) that are stored per row"""
+    return (message.role, message.content, message.name, message.content_type, message.image_url)
+
+def _insert_messages(db: Session, conversation_id: str, messages: List[MessageSchema], start_sequence: int) -> None:
+    """Insert messages numbered from start_sequence in one statement"""
+    if not messages:
+        return
+    db.execute(insert(models.Message), [
+        {
+            "conversation_id": conversation_id,
+            "role": message.role,
+            "content": message.content,
+            "name": message.name,
+            "content_type": message.content_type,
+            "image_url": message.image_url,
+            "sequence_number": start_sequence + i
+        }
+        for i, message in enumerate(messages)
+    ], execution_options=_ONE_BATCH)
+
+def stored_prefix_unchanged(conversation: ConversationSchema) -> bool:
+    """Check that the messages recorded by mark_persisted are still unmodified"""
+    stored = conversation._persisted
+    if stored is None or len(conversation.messages) < len(stored):
+        return False
+    return [_message_fields(msg) for msg in conversation.messages[:len(stored)]] == stored
+
+def mark_persisted(conversation: ConversationSchema, start: int = 0) -> None:
+    """Record that the conversation's messages match what is stored.
+
+    With start, the first start messages are known to be recorded already.
+    """
+    stored = conversation._persisted[:start] if start else []
+    stored.extend(_message_fields(msg) for msg in conversation.messages[start:])
+    conversation._persisted = stored
@@ -1,14 +1,38 @@
 """
 Database connection and session management
 """
+import threading
+import time
+from typing import Any, Dict
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from ..config import DATABASE_URL
+from ..config import (
+    DATABASE_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_TIMEOUT_MS
+)
+
+def _engine_options(url: str) -> Dict[str, Any]:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    if url.startswith("sqlite"):
+        # SQLite picks its own pool class, which may not take sizing options
+        return options
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    if url.startswith("postgresql") and DB_STATEMENT_TIMEOUT_MS > 0:
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
 
 # Create SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -16,6 +40,56 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Create base class for models
 Base = declarative_base()
 
+class PoolMetrics:
+    """Time spent waiting for pooled connections, plus checkout timeouts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        pool = engine.pool
+        # Sizing methods only exist on QueuePool
+        status = {
+            name: getattr(pool, name)() if hasattr(pool, name) else None
+            for name in ("size", "checkedout", "checkedin", "overflow")
+        }
+        status.update(
+            pool_class=type(pool).__name__,
+            checkouts=self.checkouts,
+            timeouts=self.timeouts,
+            wait_seconds_total=self.wait_seconds_total,
+            wait_seconds_max=self.wait_seconds_max,
+            wait_seconds_avg=self.wait_seconds_total / self.checkouts if self.checkouts else None
+        )
+        return status
+
+pool_metrics = PoolMetrics()
+
+def connect() -> Connection:
+    """Check a connection out of the pool, recording how long it took"""
+    start = time.perf_counter()
+    try:
+        connection = engine.connect()
+    except PoolTimeoutError:
+        pool_metrics.record_timeout()
+        raise
+    pool_metrics.record_wait(time.perf_counter() - start)
+    return connection
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,254 @@
+"""
+Versioned schema migrations
+
+The applied version is kept in schema_migrations. A new database is created
+from the ORM models and stamped with the latest version; an existing one is
+upgraded one migration at a time. Every schema change gets a Migration here,
+plus the same change in models.py and sql/create_tables.sql. Changes the
+models cannot express (e.g. search indexes) are marked on_create and also run,
+after create_all, on a new database; they must be safe to re-run.
+"""
+from typing import Callable, List, Optional
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from .database import Base
+from . import models  # registers the tables on Base.metadata
+
+# The schema create_all produced before migrations existed
+BASELINE_VERSION = 1
+
+# Arbitrary key for the advisory lock that stops workers migrating at once
+MIGRATION_LOCK_ID = 727401
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now())
+)
+
+class Migration:
+    def __init__(self, version: int, description: str, upgrade: Callable[[Connection], None], on_create: bool = False):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.on_create = on_create
+
+def _hot_query_indexes(connection: Connection):
+    # Duplicate positions would block the unique index. The newest row of each
+    # stays; the others are moved to messages_duplicates for review, not dropped.
+    older_duplicates = (
+        "FROM messages WHERE id NOT IN "
+        "(SELECT MAX(id) FROM messages GROUP BY conversation_id, sequence_number)"
+    )
+    duplicates = connection.execute(text(f"SELECT COUNT(*) {older_duplicates}")).scalar()
+    if duplicates:
+        connection.execute(text(f"CREATE TABLE messages_duplicates AS SELECT * {older_duplicates}"))
+        connection.execute(text("DELETE FROM messages WHERE id IN (SELECT id FROM messages_duplicates)"))
+        print(
+            f"Moved {duplicates} messages that shared a conversation position with a newer one "
+            "to the messages_duplicates table"
+        )
+    # Conversation listing: WHERE user_id = ? ORDER BY updated_at DESC, id DESC
+    include = " INCLUDE (title, created_at)" if connection.dialect.name == "postgresql" else ""
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_updated "
+        f"ON conversations (user_id, updated_at DESC, id DESC){include}"
+    ))
+    # Ordered message reads, counts and last-message lookups
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_conversation_sequence "
+        "ON messages (conversation_id, sequence_number)"
+    ))
+    # Prefixes of the indexes above
+    for index in ("idx_conversations_user_id", "idx_messages_conversation_id", "idx_messages_sequence"):
+        connection.execute(text(f"DROP INDEX IF EXISTS {index}"))
+
+# Trigger function of databases created from sql/create_tables.sql (PostgreSQL).
+# An updated_at the statement sets is kept, and an update that changes only
+# denormalized counters leaves it alone; any other update is stamped.
+UPDATED_AT_FUNCTION = """
+CREATE OR REPLACE FUNCTION update_updated_at_column()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.updated_at IS DISTINCT FROM OLD.updated_at THEN
+        RETURN NEW;
+    END IF;
+    IF to_jsonb(NEW) - ARRAY['updated_at', 'conversations_count', 'message_count', 'last_message_at']
+        IS NOT DISTINCT FROM
+        to_jsonb(OLD) - ARRAY['updated_at', 'conversations_count', 'message_count', 'last_message_at'] THEN
+        RETURN NEW;
+    END IF;
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ language 'plpgsql'
+"""
+
+def _counter_aware_updated_at(connection: Connection):
+    if connection.dialect.name != "postgresql":
+        return
+    # Only databases from create_tables.sql have the triggers
+    if connection.execute(text("SELECT 1 FROM pg_proc WHERE proname = 'update_updated_at_column'")).first():
+        connection.execute(text(UPDATED_AT_FUNCTION))
+
+def _denormalized_counters(connection: Connection):
+    # The backfill below must not stamp every user and conversation
+    _counter_aware_updated_at(connection)
+    connection.execute(text("ALTER TABLE users ADD COLUMN conversations_count INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+    timestamp = "TIMESTAMP WITH TIME ZONE" if connection.dialect.name == "postgresql" else "DATETIME"
+    connection.execute(text(f"ALTER TABLE conversations ADD COLUMN last_message_at {timestamp}"))
+    connection.execute(text(
+        "UPDATE users SET conversations_count = "
+        "(SELECT COUNT(*) FROM conversations WHERE conversations.user_id = users.user_id)"
+    ))
+    connection.execute(text(
+        "UPDATE conversations SET "
+        "message_count = (SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id), "
+        "last_message_at = (SELECT MAX(created_at) FROM messages WHERE messages.conversation_id = conversations.id)"
+    ))
+
+def _message_search(connection: Connection):
+    if connection.dialect.name == "postgresql":
+        # Kept current by PostgreSQL on every insert and update
+        connection.execute(text(
+            "ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED"
+        ))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_messages_content_tsv ON messages USING GIN (content_tsv)"))
+    elif connection.dialect.name == "sqlite":
+        # External-content FTS5 index kept current by triggers
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, content='messages', content_rowid='id', tokenize='porter unicode61')"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+            "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+            "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+            "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+            "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+        ))
+        connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+def _image_store(connection: Connection):
+    timestamp = "TIMESTAMP WITH TIME ZONE" if connection.dialect.name == "postgresql" else "DATETIME"
+    if not inspect(connection).has_table("images"):
+        # Databases created from sql/create_tables.sql never had the table
+        connection.execute(text(
+            "CREATE TABLE images ("
+            "id VARCHAR(255) PRIMARY KEY, "
+            "user_id VARCHAR(255) NOT NULL REFERENCES users(user_id) ON DELETE CASCADE, "
+            "prompt TEXT NOT NULL, "
+            "image_path VARCHAR(1024) NOT NULL, "
+            "content_hash VARCHAR(64), "
+            "mime_type VARCHAR(100), "
+            "size_bytes INTEGER, "
+            "is_modification BOOLEAN DEFAULT FALSE, "
+            "original_image_id VARCHAR(255) REFERENCES images(id) ON DELETE SET NULL, "
+            f"created_at {timestamp} DEFAULT CURRENT_TIMESTAMP)"
+        ))
+    else:
+        connection.execute(text("ALTER TABLE images ADD COLUMN content_hash VARCHAR(64)"))
+        connection.execute(text("ALTER TABLE images ADD COLUMN mime_type VARCHAR(100)"))
+        connection.execute(text("ALTER TABLE images ADD COLUMN size_bytes INTEGER"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash)"))
+
+def _image_lineage(connection: Connection):
+    connection.execute(text("ALTER TABLE images ADD COLUMN conversation_id VARCHAR(255)"))
+    connection.execute(text("ALTER TABLE images ADD COLUMN revision INTEGER NOT NULL DEFAULT 0"))
+    # Images saved so far are found through the message that shows them
+    connection.execute(text(
+        "UPDATE images SET conversation_id = (SELECT MIN(messages.conversation_id) FROM messages "
+        "WHERE messages.image_url = '/images/' || images.id || '.png')"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_images_conversation_created ON images (conversation_id, created_at DESC)"
+    ))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS idx_images_user_created ON images (user_id, created_at DESC)"))
+
+def _idempotency_keys(connection: Connection):
+    timestamp = "TIMESTAMP WITH TIME ZONE" if connection.dialect.name == "postgresql" else "DATETIME"
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+        "user_id VARCHAR(255) NOT NULL, "
+        "idempotency_key VARCHAR(255) NOT NULL, "
+        "request_hash VARCHAR(64) NOT NULL, "
+        "response TEXT, "
+        f"created_at {timestamp} DEFAULT CURRENT_TIMESTAMP, "
+        "PRIMARY KEY (user_id, idempotency_key))"
+    ))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)"))
+
+def _export_order_index(connection: Connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_created ON conversations (user_id, created_at, id)"
+    ))
+
+MIGRATIONS: List[Migration] = [
+    Migration(2, "Indexes for conversation listing and ordered message reads", _hot_query_indexes),
+    Migration(3, "Denormalized conversation and message counters", _denormalized_counters),
+    Migration(4, "Full-text search over message content", _message_search, on_create=True),
+    Migration(5, "Image ids mapped to content-addressed blobs", _image_store),
+    Migration(6, "Image lineage per conversation", _image_lineage),
+    Migration(7, "Idempotency keys for retried chat requests", _idempotency_keys),
+    Migration(8, "Index for exporting a user's conversations oldest first", _export_order_index),
+    Migration(9, "Counter-only updates keep updated_at", _counter_aware_updated_at),
+]
+
+HEAD_VERSION = MIGRATIONS[-1].version if MIGRATIONS else BASELINE_VERSION
+
+def current_version(connection: Connection) -> Optional[int]:
+    """Latest applied version, or None if the database is not versioned yet"""
+    if not inspect(connection).has_table(schema_migrations.name):
+        return None
+    return connection.execute(select(func.max(schema_migrations.c.version))).scalar()
+
+def _stamp(connection: Connection, version: int, description: str):
+    connection.execute(schema_migrations.insert().values(version=version, description=description))
+
+def _lock(connection: Connection):
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+def migrate(engine: Engine, target: Optional[int] = None) -> int:
+    """Bring the database up to target (default: latest) and return its version"""
+    target = HEAD_VERSION if target is None else target
+
+    with engine.begin() as connection:
+        _lock(connection)
+        if current_version(connection) is None:
+            schema_migrations.create(connection)
+            if inspect(connection).has_table("conversations"):
+                # Created before migrations existed
+                _stamp(connection, BASELINE_VERSION, "Baseline schema")
+            else:
+                Base.metadata.create_all(connection)
+                for migration in MIGRATIONS:
+                    if migration.on_create:
+                        migration.upgrade(connection)
+                _stamp(connection, HEAD_VERSION, "Created from models")
+                return HEAD_VERSION
+
+    for migration in MIGRATIONS:
+        with engine.begin() as connection:
+            _lock(connection)
+            version = current_version(connection)
+            if migration.version <= version or migration.version > target:
+                continue
+            print(f"Applying migration {migration.version}: {migration.description}")
+            migration.upgrade(connection)
+            _stamp(connection, migration.version, migration.description)
+
+    with engine.connect() as connection:
+        return current_version(connection)
@@ -2,7 +2,7 @@
 SQLAlchemy models for the application
 """
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, Text, ForeignKey, Boolean, DateTime, func
+from sqlalchemy import Column, String, Integer, Text, ForeignKey, Boolean, DateTime, Index, func
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -16,6 +16,8 @@ class User(Base):
     picture = Column(String(1024))
     given_name = Column(String(255))
     family_name = Column(String(255))
+    # Maintained by the write paths in crud.py; repair_counters.py recomputes it
+    conversations_count = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -28,6 +30,9 @@ class Conversation(Base):
     id = Column(String(255), primary_key=True)
     user_id = Column(String(255), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
     title = Column(String(255), default="New Conversation")
+    # Maintained by the write paths in crud.py; repair_counters.py recomputes them
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -35,6 +40,13 @@ class Conversation(Base):
     user = relationship("User", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan", order_by="Message.sequence_number")
 
+    __table_args__ = (
+        # Listing a user's conversations newest first
+        Index("idx_conversations_user_updated", user_id, updated_at.desc(), id.desc(), postgresql_include=["title", "created_at"]),
+        # Exporting a user's conversations oldest first, resumable by cursor
+        Index("idx_conversations_user_created", user_id, created_at, id),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -51,13 +63,62 @@ class Message(Base):
     # Relationships
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        Index("uq_messages_conversation_sequence", conversation_id, sequence_number, unique=True),
+    )
+
 class Image(Base):
     __tablename__ = "images"
 
     id = Column(String(255), primary_key=True)
     user_id = Column(String(255), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
+    # What the image shows: the first prompt plus each modification request
     prompt = Column(Text, nullable=False)
+    # Blob in the image store, relative to IMAGE_STORE_PATH
     image_path = Column(String(1024), nullable=False)
+    content_hash = Column(String(64))
+    mime_type = Column(String(100))
+    size_bytes = Column(Integer)
+    # No foreign key: an image is recorded before a new conversation is first saved.
+    # delete_conversation removes the conversation's images.
+    conversation_id = Column(String(255))
     is_modification = Column(Boolean, default=False)
     original_image_id = Column(String(255), ForeignKey("images.id", ondelete="SET NULL"))
+    # Modifications since the first image of the lineage
+    revision = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Blobs still referenced, for garbage collection
+        Index("idx_images_content_hash", "content_hash"),
+        # Latest image of a conversation or user, for modification requests
+        Index("idx_images_conversation_created", conversation_id, created_at.desc()),
+        Index("idx_images_user_created", user_id, created_at.desc()),
+    )
+
+class ContextSummary(Base):
+    __tablename__ = "context_summaries"
+
+    conversation_id = Column(String(255), ForeignKey("conversations.id", ondelete="CASCADE"), primary_key=True)
+    # Number of leading messages the summary replaces
+    covered_messages = Column(Integer, nullable=False)
+    summary = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # No foreign key: keys are claimed before anything else about the request is checked
+    user_id = Column(String(255), primary_key=True)
+    idempotency_key = Column(String(255), primary_key=True)
+    # SHA-256 of the request body the key was first used with
+    request_hash = Column(String(64), nullable=False)
+    # JSON of the response; NULL while the first request is still running
+    response = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Expiry
+        Index("idx_idempotency_keys_created", created_at),
+    )
@@ -0,0 +1,97 @@
+"""
+Cross-worker notifications over PostgreSQL LISTEN/NOTIFY
+"""
+import re
+import select
+import threading
+import time
+from typing import Callable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+CHANNEL_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+def notify(db: Session, channel: str, payload: str) -> None:
+    """Send a notification; it is delivered when the transaction commits"""
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
+
+class NotificationListener:
+    """Listen on a channel from a background thread with its own connection.
+
+    on_notify gets each payload. on_reconnect is called after the connection
+    had to be re-established, since notifications sent meanwhile are lost.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        channel: str,
+        on_notify: Callable[[str], None],
+        on_reconnect: Optional[Callable[[], None]] = None,
+        poll_interval: float = 1.0
+    ):
+        if not CHANNEL_NAME.match(channel):
+            raise ValueError(f"Invalid channel name: {channel}")
+        self.engine = engine
+        self.channel = channel
+        self.on_notify = on_notify
+        self.on_reconnect = on_reconnect
+        self.poll_interval = poll_interval
+        self.received = 0
+        self.reconnects = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"listen-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval * 2)
+
+    def _connect(self):
+        # A dedicated DBAPI connection outside the pool, in autocommit mode
+        cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+        connection = self.engine.dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        connection.cursor().execute(f"LISTEN {self.channel}")
+        return connection
+
+    def _run(self):
+        delay = self.poll_interval
+        first = True
+        while not self._stop.is_set():
+            try:
+                connection = self._connect()
+            except Exception as e:
+                print(f"Could not listen on {self.channel}: {str(e)}")
+                self._stop.wait(delay)
+                delay = min(delay * 2, 30)
+                continue
+
+            if not first:
+                self.reconnects += 1
+                if self.on_reconnect:
+                    self.on_reconnect()
+            first = False
+            delay = self.poll_interval
+
+            try:
+                while not self._stop.is_set():
+                    if select.select([connection], [], [], self.poll_interval)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            self.received += 1
+                            self.on_notify(connection.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Lost {self.channel} listener connection: {str(e)}")
+                time.sleep(self.poll_interval)
+            finally:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
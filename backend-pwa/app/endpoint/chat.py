@@ -1,34 +1,56 @@
 """
 Chat endpoints for the application
 """
+import json
 import uuid
+import asyncio
+import hashlib
 from datetime import datetime
-from typing import List, Optional
-from fastapi import APIRouter, HTTPException, Query, Body
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Query, Body, Header, Response
+from fastapi.responses import StreamingResponse
 
 from ..models import Message, Conversation, ChatRequest, UnifiedResponse
-from ..database import get_conversation, save_conversation
-from ..utils import convert_to_langchain_messages, ImageContext
-from ..ai_service import classify_prompt_with_ai, get_langchain_model, generate_dalle_image
-from ..config import ModelConfig
-
-# Global instance to track image context
-image_context = ImageContext()
+from ..database import (
+    get_conversation,
+    get_image_context,
+    save_conversation,
+    claim_idempotency_key,
+    save_idempotent_response,
+    release_idempotency_key
+)
+from ..utils import convert_to_langchain_messages
+from ..ai_service import (
+    classify_prompt,
+    classify_with_speculation,
+    get_langchain_model,
+    get_response_cache,
+    generate_dalle_image_to_store,
+    model_calls,
+    flight_key,
+    SingleFlight
+)
+from ..response_cache import ResponseKey
+from ..config import ModelConfig, SPECULATIVE_CHAT_ENABLED
+from ..context import build_prompt_context
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+_background_tasks = set()
+
+# Keyed /unified-chat requests in flight in this worker
+idempotent_requests = SingleFlight()
+
+# Headers that keep proxies from buffering event streams
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 # Create router
 router = APIRouter()
 
-@router.post("/unified-chat", response_model=UnifiedResponse)
-async def unified_chat(request: ChatRequest):
-    global image_context
-
-    # Debug print request
-    print(f"Received chat request from user: {request.user_id}")
-
-    # Get or create conversation
+async def _resolve_conversation(request: ChatRequest) -> Conversation:
+    """Load the requested conversation, or start a new one"""
     conversation = None
     if request.conversation_id:
-        conversation = get_conversation(request.conversation_id)
+        conversation = await get_conversation(request.conversation_id)
         if not conversation or conversation.user_id != request.user_id:
             raise HTTPException(status_code=404, detail="Conversation not found")
 
@@ -55,153 +77,159 @@ async def unified_chat(request: ChatRequest):
             updated_at=now
         )
 
-    # Determine the last user message
-    last_user_message = None
+    return conversation
+
+def _last_user_message(request: ChatRequest) -> str:
+    """Determine the last user message"""
     for msg in reversed(request.messages):
         if msg.role == "user":
-            last_user_message = msg.content
-            break
+            return msg.content
 
-    if not last_user_message:
-        raise HTTPException(status_code=400, detail="No user message found")
+    raise HTTPException(status_code=400, detail="No user message found")
 
-    # Determine which model type to use - use AI-based classification
+async def _detect_prompt_type(request: ChatRequest, conversation: Conversation, last_user_message: str) -> str:
+    """Determine which model type to use - local fast path, AI-based classification otherwise"""
     prompt_type = request.force_type
     if not prompt_type:
-        prompt_type = await classify_prompt_with_ai(last_user_message, conversation.messages)
+        prompt_type = await classify_prompt(last_user_message, conversation.messages)
 
     print(f"Detected prompt type: {prompt_type}")
-
-    # Set model based on detected type
-    if prompt_type == "image":
-        # Check if this is a modification request and we have a previous image
-        is_modification = False
-        image_to_modify = None
-
-        # Look for modification intent in the message
-        modification_indicators = [
-            "modify", "change", "update", "edit", "revise", "adjust", "alter",
-            "instead", "rather", "different", "tweak", "fix", "improve", "add", "remove",
-            "make it", "try again", "another", "version", "iteration", "retry",
-            "better", "more", "less", "change the", "different style", "with"
-        ]
-
-        # Clear decision logic for modifications
-        is_modification = False
-        image_to_modify = None
-        enhanced_prompt = last_user_message
-
-        # If we have a previous image and there are modification indicators
-        if image_context.last_image_id and (
-            any(indicator in last_user_message.lower() for indicator in modification_indicators) or
-            len(last_user_message.split()) < 5  # Short messages after an image are likely modification requests
-        ):
-            is_modification = True
-            from ..config import IMAGES_PATH
-            import os
-            image_to_modify = os.path.join(IMAGES_PATH, f"{image_context.last_image_id}.png")
-
-            # Update the prompt to reference the previous image
-            enhanced_prompt = f"Modify the previous image that was described as '{image_context.last_prompt}'. The modification request is: {last_user_message}"
-
-            # If it doesn't exist, fallback to regular generation
-            if not os.path.exists(image_to_modify):
-                is_modification = False
-                enhanced_prompt = last_user_message
-        else:
+    return prompt_type
+
+def _text_model_for(prompt_type: str, request: ChatRequest) -> str:
+    """Pick the text model for a prompt type"""
+    if prompt_type == "search":
+        model_used = ModelConfig.SEARCH_MODEL
+    elif prompt_type == "mini":
+        model_used = ModelConfig.MINI_MODEL
+    else:  # Default to standard chat
+        model_used = ModelConfig.CHAT_MODEL
+
+    # Override with user specified model if provided
+    if request.model_override:
+        model_used = request.model_override
+
+    return model_used
+
+def _flight_scope(request: ChatRequest) -> str:
+    """Duplicate requests are only coalesced within one conversation (or a user's new ones)"""
+    return request.conversation_id or f"user:{request.user_id}"
+
+def _response_cache_key(prompt_type: str, model_used: str, request: ChatRequest, context_messages: List[Message]) -> Optional[ResponseKey]:
+    """Where the answer to this turn is cached, or None if it is not"""
+    response_cache = get_response_cache()
+    if response_cache is None:
+        return None
+    return response_cache.key(prompt_type, model_used, request.temperature, request.max_tokens, context_messages)
+
+async def _generate_image_message(request: ChatRequest, conversation: Conversation, last_user_message: str) -> Message:
+    """Generate (or modify) an image and build the assistant message pointing at it"""
+    # Check if this is a modification request and we have a previous image
+    is_modification = False
+    image_to_modify = None
+
+    # Look for modification intent in the message
+    modification_indicators = [
+        "modify", "change", "update", "edit", "revise", "adjust", "alter",
+        "instead", "rather", "different", "tweak", "fix", "improve", "add", "remove",
+        "make it", "try again", "another", "version", "iteration", "retry",
+        "better", "more", "less", "change the", "different style", "with"
+    ]
+
+    # Clear decision logic for modifications
+    is_modification = False
+    image_to_modify = None
+    enhanced_prompt = last_user_message
+
+    # The previous image: this conversation's latest, or for a new conversation
+    # the user's latest anywhere
+    if request.conversation_id:
+        previous_image = await get_image_context(conversation_id=conversation.id)
+    else:
+        previous_image = await get_image_context(user_id=request.user_id)
+
+    # If we have a previous image and there are modification indicators
+    if previous_image and (
+        any(indicator in last_user_message.lower() for indicator in modification_indicators) or
+        len(last_user_message.split()) < 5  # Short messages after an image are likely modification requests
+    ):
+        is_modification = True
+        from ..utils import find_image
+        image_to_modify = await find_image(previous_image["id"])
+
+        # Update the prompt to reference the previous image
+        enhanced_prompt = f"Modify the previous image that was described as '{previous_image['prompt']}'. The modification request is: {last_user_message}"
+
+        # If it doesn't exist, fallback to regular generation
+        if image_to_modify is None:
+            is_modification = False
             enhanced_prompt = last_user_message
+    else:
+        enhanced_prompt = last_user_message
 
-        # Process image generation
-        try:
-            if is_modification:
-                print(f"Modifying existing image: {image_context.last_image_id}")
-                # Increment revision count
-                image_context.revision_count += 1
-
-                # For modifications, we use the enhanced prompt
-                image_data = await generate_dalle_image(
-                    enhanced_prompt,
-                    size="1024x1024",
-                    quality="standard",
-                    style="vivid"
-                )
-            else:
-                # New image generation
-                image_context.revision_count = 0
-                image_data = await generate_dalle_image(
-                    last_user_message,
-                    size="1024x1024",
-                    quality="standard",
-                    style="vivid"
-                )
-
-            image_id = str(uuid.uuid4())
-            from ..utils import save_image
-            image_path = await save_image(image_data, image_id)
-            image_url = f"/images/{image_id}.png"
-
-            # Update image context
-            image_context.last_image_id = image_id
-            image_context.last_prompt = last_user_message if not is_modification else f"{image_context.last_prompt} + {last_user_message}"
-
-            # Create assistant message with image reference
-            response_message = "I've generated an image based on your request"
-            is_same_conversation = request.conversation_id and conversation.id == request.conversation_id
-
-            # Create appropriate response message
-            if is_modification and is_same_conversation:
-                response_message = "I've created a new image based on your modifications to the previous one"
-            elif is_modification:
-                response_message = "I've created a new image similar to your previous request, but in a new conversation"
-            elif is_same_conversation:
-                response_message = "I've generated another image in this conversation"
-            else:
-                response_message = "I've generated an image based on your request"
-
-            assistant_message = Message(
-                role="assistant",
-                content=response_message,
-                content_type="image",
-                image_url=image_url
+    # Process image generation
+    try:
+        if is_modification:
+            print(f"Modifying existing image: {previous_image['id']}")
+
+        # For modifications, we use the enhanced prompt. A double submit
+        # shares the generation already running for the same prompt.
+        image_blob = await model_calls.do(
+            flight_key("image", _flight_scope(request), enhanced_prompt, "1024x1024", "standard", "vivid"),
+            lambda: generate_dalle_image_to_store(
+                enhanced_prompt,
+                size="1024x1024",
+                quality="standard",
+                style="vivid"
             )
+        )
 
-            model_used = ModelConfig.IMAGE_MODEL
-
-        except Exception as e:
-            print(f"Image generation error: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Image generation error: {str(e)}")
-    else:
-        # Handle text chat or search
-        if prompt_type == "search":
-            model_used = ModelConfig.SEARCH_MODEL
-        elif prompt_type == "mini":
-            model_used = ModelConfig.MINI_MODEL
-        else:  # Default to standard chat
-            model_used = ModelConfig.CHAT_MODEL
-
-        # Override with user specified model if provided
-        if request.model_override:
-            model_used = request.model_override
+        # Record the image as the latest of this conversation's lineage
+        image_id = str(uuid.uuid4())
+        from ..utils import record_image
+        image_path = await record_image(
+            image_blob,
+            image_id,
+            request.user_id,
+            f"{previous_image['prompt']} + {last_user_message}" if is_modification else last_user_message,
+            conversation.id,
+            is_modification,
+            previous_image["id"] if is_modification else None,
+            previous_image["revision"] + 1 if is_modification else 0
+        )
+        image_url = f"/images/{image_id}.png"
+
+        # Create assistant message with image reference
+        response_message = "I've generated an image based on your request"
+        is_same_conversation = request.conversation_id and conversation.id == request.conversation_id
+
+        # Create appropriate response message
+        if is_modification and is_same_conversation:
+            response_message = "I've created a new image based on your modifications to the previous one"
+        elif is_modification:
+            response_message = "I've created a new image similar to your previous request, but in a new conversation"
+        elif is_same_conversation:
+            response_message = "I've generated another image in this conversation"
+        else:
+            response_message = "I've generated an image based on your request"
 
-        # Get appropriate LangChain model
-        llm = get_langchain_model(prompt_type, model_used, request.temperature)
+        assistant_message = Message(
+            role="assistant",
+            content=response_message,
+            content_type="image",
+            image_url=image_url
+        )
 
-        # Convert messages to LangChain format
-        lc_messages = convert_to_langchain_messages(request.messages)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Image generation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Image generation error: {str(e)}")
 
-        # Make request using LangChain
-        try:
-            response = await llm.ainvoke(lc_messages)
-            assistant_message = Message(
-                role="assistant",
-                content=response.content,
-                content_type="text"
-            )
-        except Exception as e:
-            print(f"AI model error: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"AI model error: {str(e)}")
+    return assistant_message
 
-    # Update conversation with new messages
+async def _record_turn(conversation: Conversation, last_user_message: str, assistant_message: Message):
+    """Append the turn to the conversation and persist it"""
     user_message = Message(role="user", content=last_user_message, content_type="text")
 
     # Only add the last user message if it's not already in the conversation
@@ -210,13 +238,225 @@ async def unified_chat(request: ChatRequest):
 
     conversation.messages.append(assistant_message)
     conversation.updated_at = datetime.now().isoformat()
-    save_conversation(conversation)
+    await save_conversation(conversation)
 
     print(f"Saved conversation: {conversation.id}")
 
+@router.post("/unified-chat", response_model=UnifiedResponse)
+async def unified_chat(request: ChatRequest, idempotency_key: Optional[str] = Header(None, max_length=255)):
+    """
+    Answer the last user message and save the turn.
+
+    A request sent with an Idempotency-Key header is answered once: retrying
+    it with the same key returns the saved response (with an
+    Idempotent-Replayed header) instead of appending another turn. Reusing a
+    key for a different request is rejected with 422, and retrying while the
+    first request is still running on another worker with 409.
+    """
+    if idempotency_key is None:
+        return await _unified_chat(request)
+
+    request_hash = hashlib.sha256(request.model_dump_json().encode("utf-8")).hexdigest()
+    # Retries reaching this worker while the first request runs wait for its answer
+    body, replayed = await idempotent_requests.do(
+        flight_key(request.user_id, idempotency_key, request_hash),
+        lambda: _idempotent_chat(request, idempotency_key, request_hash)
+    )
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def _idempotent_chat(request: ChatRequest, idempotency_key: str, request_hash: str) -> Tuple[str, bool]:
+    """Response JSON for a keyed request, and whether it was saved by an earlier request"""
+    claimed = await claim_idempotency_key(request.user_id, idempotency_key, request_hash)
+    if claimed is not None:
+        if claimed["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if claimed["response"] is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        return claimed["response"], True
+
+    saved = False
+    try:
+        response = await _unified_chat(request)
+        body = response.model_dump_json()
+        await save_idempotent_response(request.user_id, idempotency_key, body)
+        saved = True
+    finally:
+        if not saved:
+            # Failed or cancelled before a response was saved, so a retry may
+            # run it again. Shielded: a cancelled request still gets here.
+            await asyncio.shield(release_idempotency_key(request.user_id, idempotency_key))
+    return body, False
+
+async def _text_answer(
+    request: ChatRequest,
+    prompt_type: str,
+    model_used: str,
+    context_messages: List[Message],
+    keep_running: bool = True
+) -> str:
+    """The model's answer to a text turn: from the response cache, shared with an identical call in flight, or new"""
+    cache_key = _response_cache_key(prompt_type, model_used, request, context_messages)
+    content = await get_response_cache().get(cache_key) if cache_key else None
+    if content is not None:
+        return content
+
+    llm = get_langchain_model(prompt_type, model_used, request.temperature, request.max_tokens)
+    lc_messages = convert_to_langchain_messages(context_messages)
+    response = await model_calls.do(
+        flight_key(
+            "text", _flight_scope(request), model_used, request.temperature, request.max_tokens,
+            [(message.role, message.content) for message in context_messages]
+        ),
+        lambda: llm.ainvoke(lc_messages),
+        keep_running=keep_running
+    )
+    if cache_key:
+        await get_response_cache().set(cache_key, response.content)
+    return response.content
+
+async def _unified_chat(request: ChatRequest) -> UnifiedResponse:
+    # Debug print request
+    print(f"Received chat request from user: {request.user_id}")
+
+    conversation = await _resolve_conversation(request)
+    last_user_message = _last_user_message(request)
+
+    speculative_content = None
+    if SPECULATIVE_CHAT_ENABLED and not request.force_type:
+        # Start the default chat answer, context included, while the classifier
+        # decides. It is cancelled if the prompt turns out not to be a chat.
+        speculative_model = _text_model_for("chat", request)
+
+        async def speculate() -> str:
+            context_messages = await build_prompt_context(request.conversation_id, request.messages)
+            return await _text_answer(request, "chat", speculative_model, context_messages, keep_running=False)
+
+        prompt_type, speculative_content = await classify_with_speculation(
+            last_user_message,
+            conversation.messages,
+            speculate
+        )
+        print(f"Detected prompt type: {prompt_type}")
+    else:
+        prompt_type = await _detect_prompt_type(request, conversation, last_user_message)
+
+    # Set model based on detected type
+    if prompt_type == "image":
+        assistant_message = await _generate_image_message(request, conversation, last_user_message)
+        model_used = ModelConfig.IMAGE_MODEL
+    else:
+        if speculative_content is not None:
+            # The speculative chat answer is good for this prompt type
+            model_used = speculative_model
+            content = speculative_content
+        else:
+            # Handle text chat or search. The history is only fitted into the
+            # token budget (which may mean summarizing) for text routes.
+            model_used = _text_model_for(prompt_type, request)
+            context_messages = await build_prompt_context(request.conversation_id, request.messages)
+            try:
+                content = await _text_answer(request, prompt_type, model_used, context_messages)
+            except Exception as e:
+                print(f"AI model error: {str(e)}")
+                raise HTTPException(status_code=500, detail=f"AI model error: {str(e)}")
+
+        assistant_message = Message(
+            role="assistant",
+            content=content,
+            content_type="text"
+        )
+
+    await _record_turn(conversation, last_user_message, assistant_message)
+
     return UnifiedResponse(
         conversation_id=conversation.id,
         message=assistant_message,
         model_used=model_used,
         created_at=datetime.now().isoformat()
     )
+
+def _sse(event: str, data: str) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {data}\n\n"
+
+@router.post("/unified-chat/stream")
+async def unified_chat_stream(request: ChatRequest):
+    """
+    Streaming variant of /unified-chat using Server-Sent Events.
+
+    Text and search turns emit "token" events as the model produces them;
+    image turns emit no tokens. A closing "done" event carries the
+    UnifiedResponse. If the client disconnects mid-stream, the partial
+    answer is saved.
+    """
+    print(f"Received streaming chat request from user: {request.user_id}")
+
+    conversation = await _resolve_conversation(request)
+    last_user_message = _last_user_message(request)
+    prompt_type = await _detect_prompt_type(request, conversation, last_user_message)
+
+    if prompt_type == "image":
+        assistant_message = await _generate_image_message(request, conversation, last_user_message)
+        await _record_turn(conversation, last_user_message, assistant_message)
+        response = UnifiedResponse(
+            conversation_id=conversation.id,
+            message=assistant_message,
+            model_used=ModelConfig.IMAGE_MODEL
+        )
+
+        async def image_events():
+            yield _sse("done", response.model_dump_json())
+
+        return StreamingResponse(image_events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    model_used = _text_model_for(prompt_type, request)
+    llm = get_langchain_model(prompt_type, model_used, request.temperature, request.max_tokens)
+    context_messages = await build_prompt_context(request.conversation_id, request.messages)
+    lc_messages = convert_to_langchain_messages(context_messages)
+    cache_key = _response_cache_key(prompt_type, model_used, request, context_messages)
+    cached_content = await get_response_cache().get(cache_key) if cache_key else None
+
+    async def token_events():
+        chunks = []
+        recording = False
+        try:
+            if cached_content is not None:
+                # Already answered: the whole answer as one token
+                chunks.append(cached_content)
+                yield _sse("token", json.dumps({"content": cached_content}))
+            else:
+                async for chunk in llm.astream(lc_messages):
+                    if chunk.content:
+                        chunks.append(chunk.content)
+                        yield _sse("token", json.dumps({"content": chunk.content}))
+                if cache_key:
+                    await get_response_cache().set(cache_key, "".join(chunks))
+
+            assistant_message = Message(role="assistant", content="".join(chunks), content_type="text")
+            # From here the turn is saved (or the error reported) exactly once;
+            # shielded so a disconnect mid-save does not leave it half done
+            recording = True
+            await asyncio.shield(_record_turn(conversation, last_user_message, assistant_message))
+
+            response = UnifiedResponse(
+                conversation_id=conversation.id,
+                message=assistant_message,
+                model_used=model_used
+            )
+            yield _sse("done", response.model_dump_json())
+        except Exception as e:
+            print(f"AI model error: {str(e)}")
+            yield _sse("error", json.dumps({"detail": f"AI model error: {str(e)}"}))
+        finally:
+            # Client went away (or the model failed) part way: keep what was generated.
+            # This generator may be cancelled, so the save runs as its own task.
+            # Not once the full turn was being recorded: if that failed, the
+            # conversation may already hold this user message.
+            if not recording and chunks:
+                partial_message = Message(role="assistant", content="".join(chunks), content_type="text")
+                task = asyncio.get_running_loop().create_task(_record_turn(conversation, last_user_message, partial_message))
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+
+    return StreamingResponse(token_events(), media_type="text/event-stream", headers=SSE_HEADERS)
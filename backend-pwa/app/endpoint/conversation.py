@@ -3,13 +3,29 @@ Conversation endpoints for the application
 """
 import os
 import json
-from typing import List
-from fastapi import APIRouter, HTTPException, Query
+import uuid
+from datetime import datetime, timezone
+from typing import List, Optional, Union
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 
-from ..models import Conversation
+from ..models import (
+    Conversation,
+    ConversationSummary,
+    MessageSearchResult,
+    ConversationImportRequest,
+    ConversationImportResult
+)
+from ..config import CONVERSATION_IMPORT_MAX
 from ..database import (
     get_conversation,
+    get_conversation_title,
+    get_user,
+    import_conversations,
+    export_user_conversations,
     get_user_conversations,
+    get_user_conversation_summaries,
+    search_user_messages,
     get_user_conversations_count
 )
 # from ..config import DB_PATH
@@ -17,25 +33,125 @@ from ..database import (
 # Create router
 router = APIRouter()
 
+@router.get("/conversations/search", response_model=List[MessageSearchResult])
+async def search_conversations(
+    response: Response,
+    user_id: str = Query(...),
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None)
+):
+    """
+    Search the content of a user's messages, best match first.
+
+    Snippets are HTML-escaped with the matching words wrapped in <mark>.
+    Pass the X-Next-Cursor response header back as cursor for the next page.
+    """
+    try:
+        results, next_cursor = await search_user_messages(user_id, q, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return results
+
+@router.post("/conversations/import", response_model=ConversationImportResult)
+async def import_conversations_endpoint(request: ConversationImportRequest):
+    """
+    Create many conversations for a user at once, e.g. from an export.
+
+    Everything is written in one transaction with multi-row inserts.
+    Conversations whose id already exists are skipped and listed as such,
+    so a failed import can simply be sent again.
+    """
+    if len(request.conversations) > CONVERSATION_IMPORT_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CONVERSATION_IMPORT_MAX} conversations per import")
+    if not await get_user(request.user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+
+    now = datetime.now(timezone.utc)
+    conversations = [
+        Conversation(
+            id=item.id or str(uuid.uuid4()),
+            user_id=request.user_id,
+            title=item.title or get_conversation_title(item.messages),
+            messages=item.messages,
+            created_at=(item.created_at or now).isoformat(),
+            updated_at=(item.updated_at or item.created_at or now).isoformat()
+        )
+        for item in request.conversations
+    ]
+    imported = await import_conversations(conversations)
+    created = set(imported)
+    skipped = [conversation.id for conversation in conversations if conversation.id not in created]
+    return ConversationImportResult(imported=imported, skipped=skipped)
+
+@router.get("/users/{user_id}/export")
+async def export_conversations_endpoint(
+    user_id: str,
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    images: bool = Query(False)
+):
+    """
+    Stream a user's conversations, oldest first, as NDJSON.
+
+    Each line is a conversation as /conversations/import accepts it, plus
+    the cursor that resumes the export after it: an interrupted download
+    continues from the last line received, and limit splits the history
+    into ranges. With images=true the response is a gzip'd tar of
+    conversations.ndjson and the images it refers to.
+    """
+    if not await get_user(user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    try:
+        body = export_user_conversations(user_id, cursor, limit, images)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if images:
+        return StreamingResponse(
+            body,
+            media_type="application/gzip",
+            headers={"Content-Disposition": 'attachment; filename="conversations.tar.gz"'}
+        )
+    return StreamingResponse(body, media_type="application/x-ndjson")
+
 @router.get("/conversations/{conversation_id}", response_model=Conversation)
 async def get_conversation_endpoint(conversation_id: str, user_id: str = Query(...)):
     print(f"Getting conversation {conversation_id} for user {user_id}")
-    conversation = get_conversation(conversation_id)
+    conversation = await get_conversation(conversation_id)
     if not conversation or conversation.user_id != user_id:
         raise HTTPException(status_code=404, detail="Conversation not found")
     return conversation
 
-@router.get("/conversations", response_model=List[Conversation])
+@router.get("/conversations", response_model=None)
 async def list_conversations(
+    response: Response,
     user_id: str = Query(...),
     skip: int = Query(0, ge=0),
-    limit: int = Query(10, ge=1, le=100)
-):
+    limit: int = Query(10, ge=1, le=100),
+    summary: bool = Query(False),
+    cursor: Optional[str] = Query(None)
+) -> Union[List[ConversationSummary], List[Conversation]]:
+    """
+    List a user's conversations, newest first.
+
+    With summary=true only titles, counts and a last-message preview are
+    returned; load full messages through /conversations/{id}. Pass the
+    X-Next-Cursor response header back as cursor to fetch the next page.
+    """
     try:
         print(f"Fetching conversations for user: {user_id}")
-        conversations = get_user_conversations(user_id, skip, limit)
+        if summary:
+            conversations, next_cursor = await get_user_conversation_summaries(user_id, skip, limit, cursor)
+        else:
+            conversations, next_cursor = await get_user_conversations(user_id, skip, limit, cursor)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         print(f"Found {len(conversations)} conversations")
         return conversations
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"Error fetching conversations: {str(e)}")
         # Return an empty list instead of raising an error
@@ -46,7 +162,7 @@ async def delete_conversation_endpoint(conversation_id: str, user_id: str = Quer
     from ..database import delete_user_conversation
 
     # First check if conversation exists and belongs to user
-    conversation = get_conversation(conversation_id)
+    conversation = await get_conversation(conversation_id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
@@ -54,7 +170,7 @@ async def delete_conversation_endpoint(conversation_id: str, user_id: str = Quer
         raise HTTPException(status_code=403, detail="Not authorized to delete this conversation")
 
     # Delete the conversation
-    success = delete_user_conversation(conversation_id, user_id)
+    success = await delete_user_conversation(conversation_id, user_id)
     if not success:
         raise HTTPException(status_code=500, detail="Failed to delete conversation")
 
@@ -1,18 +1,149 @@
 """
 Image endpoints for the application
+
+An image id always names the same bytes, so responses are cacheable for a
+year and marked immutable. Stored images carry their SHA-256 as a strong
+ETag (revalidation answers 304 without touching the file), and single byte
+ranges are served as 206 Partial Content. Stored images can also be fetched
+scaled down (?w=) and as WebP when the Accept header allows it; the smallest
+configured variant that covers the requested width is served.
 """
+import asyncio
+import hashlib
 import os
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from email.utils import formatdate
+from typing import AsyncIterator, Optional, Tuple
+
+import anyio
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 
-from ..config import IMAGES_PATH
+from ..image_variants import FORMATS, get_variant, variant_width
+from ..utils import find_image
 
 # Create router
 router = APIRouter()
 
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+CHUNK_SIZE = 64 * 1024
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def _etag(content_hash: Optional[str], path: str, stat_result: os.stat_result) -> str:
+    if content_hash:
+        # Blob and variant names are derived from the content hash
+        return f'"{os.path.basename(path)}"'
+    # Files from before the store: weak, from size and modification time
+    base = f"{stat_result.st_mtime}-{stat_result.st_size}".encode()
+    return f'W/"{hashlib.md5(base, usedforsecurity=False).hexdigest()}"'
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match uses weak comparison: W/ prefixes are ignored"""
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+def _accepts(header: str, media_type: str) -> bool:
+    """Whether an Accept header names media_type with a non-zero quality"""
+    for part in header.split(","):
+        name, *params = [item.strip() for item in part.split(";")]
+        if name.lower() != media_type:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single bytes range, or None to send the whole file.
+
+    Malformed and multi-range headers are ignored, as RFC 9110 allows.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+async def _read_range(path: str, start: int, end: int) -> AsyncIterator[bytes]:
+    async with await anyio.open_file(path, mode="rb") as file:
+        await file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
 @router.get("/images/{image_id}.png")
-async def get_image(image_id: str):
-    image_path = os.path.join(IMAGES_PATH, f"{image_id}.png")
-    if not os.path.exists(image_path):
+async def get_image(image_id: str, request: Request, w: Optional[int] = Query(None, ge=1, le=4096)):
+    image = await find_image(image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    image_path, media_type, content_hash = image
+
+    vary = {}
+    if content_hash:
+        # Images from before the store have no variants
+        vary = {"Vary": "Accept"}
+        width = variant_width(w)
+        fmt = "webp" if _accepts(request.headers.get("accept", ""), "image/webp") else ("png" if width else None)
+        if fmt:
+            variant_path = await get_variant(content_hash, width, fmt)
+            if variant_path is not None:
+                image_path, media_type = variant_path, FORMATS[fmt]
+
+    try:
+        stat_result = await asyncio.to_thread(os.stat, image_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path)
+
+    etag = _etag(content_hash, image_path, stat_result)
+    headers = {
+        **vary,
+        "Cache-Control": CACHE_CONTROL,
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A range only applies to the representation the client already has part of
+    if range_header and (if_range is None or if_range.strip() == etag):
+        size = stat_result.st_size
+        try:
+            byte_range = _parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+            return StreamingResponse(_read_range(image_path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(image_path, media_type=media_type, headers=headers, stat_result=stat_result)
@@ -0,0 +1,155 @@
+"""
+Export of a user's conversation history
+
+The export is NDJSON: one conversation per line, oldest first, in the shape
+/conversations/import accepts, plus the cursor that resumes the export
+after that conversation. The archive form is a gzip'd tar holding the same
+NDJSON as conversations.ndjson and the image files its messages refer to,
+as images/<image id> with the extension of the stored image's type.
+
+Both are generators over a database session, meant to be driven through
+database.iterate_db, and produce bytes as they go: memory use does not
+depend on how much history there is.
+"""
+import gzip
+import json
+import os
+import re
+import tarfile
+import tempfile
+import time
+from typing import IO, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .config import IMAGES_PATH
+from .db.crud import get_image_blob, iter_user_conversations
+from .image_store import get_image_store
+from .models import Conversation
+
+CHUNK_SIZE = 64 * 1024
+
+# As built by chat._generate_image_message
+IMAGE_URL = re.compile(r"^/images/([\w-]+)\.png$")
+
+EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/gif": ".gif"}
+
+def _line(conversation: Conversation, cursor: str) -> bytes:
+    record = {**conversation.model_dump(), "cursor": cursor}
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+def export_lines(
+    db: Session, user_id: str, cursor: Optional[str] = None, limit: Optional[int] = None
+) -> Iterator[bytes]:
+    """NDJSON lines of the user's conversations after cursor, at most limit of them"""
+    for count, (conversation, next_cursor) in enumerate(iter_user_conversations(db, user_id, cursor), 1):
+        yield _line(conversation, next_cursor)
+        if count == limit:
+            return
+
+def _image_file(db: Session, image_id: str) -> Optional[Tuple[str, str]]:
+    """(file path, MIME type) of an image, or None if its file is gone"""
+    blob = get_image_blob(db, image_id)
+    if blob is not None:
+        content_hash, mime_type = blob
+        path, mime_type = get_image_store().path(content_hash), mime_type or "image/png"
+    else:
+        # Saved before the content-addressed store, always as PNG
+        path, mime_type = os.path.join(IMAGES_PATH, f"{image_id}.png"), "image/png"
+    return (path, mime_type) if os.path.isfile(path) else None
+
+def _read_chunks(file: IO[bytes]) -> Iterator[bytes]:
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+class _Output:
+    """File object the gzip stream writes into; take() hands over what was written so far"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+class _TarWriter:
+    """tar stream written member by member, so file contents are never held whole.
+
+    tarfile.addfile copies a member in one call; here the data goes through
+    in chunks and the compressed output is collected after each one.
+    """
+
+    def __init__(self):
+        self._output = _Output()
+        self._gzip = gzip.GzipFile(fileobj=self._output, mode="wb", mtime=0)
+
+    def member(self, name: str, size: int, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        self._gzip.write(info.tobuf(format=tarfile.PAX_FORMAT))
+        written = 0
+        for chunk in chunks:
+            # A file that grew after it was measured is cut to the size in its header
+            chunk = chunk[:size - written]
+            self._gzip.write(chunk)
+            written += len(chunk)
+            yield from self._compressed()
+        if written < size:
+            raise IOError(f"{name} shrank while it was being archived")
+        self._gzip.write(tarfile.NUL * (-size % tarfile.BLOCKSIZE))
+        yield from self._compressed()
+
+    def _compressed(self) -> Iterator[bytes]:
+        data = self._output.take()
+        if data:
+            yield data
+
+    def close(self) -> bytes:
+        # End-of-archive marker
+        self._gzip.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        self._gzip.close()
+        return self._output.take()
+
+def export_archive(
+    db: Session, user_id: str, cursor: Optional[str] = None, limit: Optional[int] = None
+) -> Iterator[bytes]:
+    """gzip'd tar of the NDJSON export and the images it refers to"""
+    tar = _TarWriter()
+    # A tar header needs the member's size, so the NDJSON is spooled first
+    with tempfile.TemporaryFile() as ndjson:
+        image_ids: List[str] = []
+        seen = set()
+        for count, (conversation, next_cursor) in enumerate(iter_user_conversations(db, user_id, cursor), 1):
+            ndjson.write(_line(conversation, next_cursor))
+            for message in conversation.messages:
+                match = IMAGE_URL.match(message.image_url or "")
+                if match and match.group(1) not in seen:
+                    seen.add(match.group(1))
+                    image_ids.append(match.group(1))
+            if count == limit:
+                break
+        size = ndjson.tell()
+        ndjson.seek(0)
+        yield from tar.member("conversations.ndjson", size, _read_chunks(ndjson))
+
+    for image_id in image_ids:
+        image = _image_file(db, image_id)
+        if image is None:
+            continue
+        path, mime_type = image
+        name = f"images/{image_id}{EXTENSIONS.get(mime_type, '')}"
+        with open(path, "rb") as file:
+            yield from tar.member(name, os.fstat(file.fileno()).st_size, _read_chunks(file))
+    yield tar.close()
@@ -0,0 +1,237 @@
+"""
+Shared client for the OpenAI image generation API
+"""
+import asyncio
+import math
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+
+from .config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    IMAGE_MAX_CONCURRENCY,
+    IMAGE_MAX_QUEUE,
+    IMAGE_CONNECT_TIMEOUT,
+    IMAGE_READ_TIMEOUT,
+    IMAGE_WRITE_TIMEOUT,
+    IMAGE_POOL_TIMEOUT,
+    IMAGE_MAX_RETRIES,
+    IMAGE_RETRY_BASE_DELAY
+)
+
+# Upstream statuses worth retrying
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+B64_JSON_KEY = b'"b64_json"'
+_VALUE_START = re.compile(rb'\s*:\s*"')
+
+T = TypeVar("T")
+
+async def read_json(response: httpx.Response) -> Dict[str, Any]:
+    """Read the whole response body and decode it as JSON"""
+    await response.aread()
+    return response.json()
+
+async def iter_b64_json(response: httpx.Response) -> AsyncIterator[bytes]:
+    """Yield the base64 text of the first b64_json field of a streamed response as it arrives.
+
+    Only a few bytes around the start of the field are buffered, so the
+    encoded image is never held in memory whole.
+    """
+    state = "key"
+    pending = b""
+    async for chunk in response.aiter_bytes():
+        if state == "done":
+            continue  # drain the rest, so the connection can be reused
+        pending += chunk
+        if state == "key":
+            index = pending.find(B64_JSON_KEY)
+            if index < 0:
+                pending = pending[-len(B64_JSON_KEY):]
+                continue
+            pending = pending[index + len(B64_JSON_KEY):]
+            state = "colon"
+        if state == "colon":
+            match = _VALUE_START.match(pending)
+            if match is None:
+                if pending.strip(b" \t\r\n:"):
+                    raise ValueError("b64_json in image response is not a string")
+                continue
+            pending = pending[match.end():]
+            state = "value"
+        if state == "value":
+            end = pending.find(b'"')
+            data = pending if end < 0 else pending[:end]
+            if data:
+                # Base64 never needs escaping, but "/" may arrive as "\/"
+                yield data.replace(b"\\", b"")
+            pending = b""
+            if end >= 0:
+                state = "done"
+    if state != "done":
+        raise ValueError("Image response has no b64_json data")
+
+class ImageQueueFull(Exception):
+    """Raised when every generation slot is busy and the wait queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Image generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class ImageGenerationClient:
+    """Pooled image generation client with bounded concurrency, backpressure and retries"""
+
+    def __init__(
+        self,
+        api_key: str = OPENAI_API_KEY,
+        base_url: str = OPENAI_BASE_URL,
+        max_concurrency: int = IMAGE_MAX_CONCURRENCY,
+        max_queue: int = IMAGE_MAX_QUEUE,
+        max_retries: int = IMAGE_MAX_RETRIES,
+        retry_base_delay: float = IMAGE_RETRY_BASE_DELAY,
+        timeout: Optional[httpx.Timeout] = None
+    ):
+        self.api_key = api_key
+        self.endpoint = f"{base_url.rstrip('/')}/images/generations"
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            timeout=timeout or httpx.Timeout(
+                connect=IMAGE_CONNECT_TIMEOUT,
+                read=IMAGE_READ_TIMEOUT,
+                write=IMAGE_WRITE_TIMEOUT,
+                pool=IMAGE_POOL_TIMEOUT
+            )
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+        # Metrics
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retries = 0
+        self._total_seconds = 0.0
+
+    def metrics(self) -> Dict[str, Any]:
+        """Current queue depth, in-flight requests and counters"""
+        return {
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "avg_seconds": self._average_seconds()
+        }
+
+    def _average_seconds(self) -> Optional[float]:
+        if not self.completed:
+            return None
+        return self._total_seconds / self.completed
+
+    def _retry_after(self) -> int:
+        """Estimate how long until a queue slot frees up"""
+        average = self._average_seconds() or 10.0
+        return max(1, math.ceil(average * (self.queued + 1) / self.max_concurrency))
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        """Delay before the next attempt: upstream Retry-After if given, else jittered exponential"""
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after and retry_after.isdigit():
+                return float(retry_after)
+        return random.uniform(0, self.retry_base_delay * (2 ** attempt))
+
+    async def generate(self, payload: Dict[str, Any], handle: Callable[[httpx.Response], Awaitable[T]] = read_json) -> T:
+        """Post a generation request and return handle(response), by default the decoded JSON.
+
+        handle reads the body as it streams in. It is called again for each
+        retry, so it must not leave anything behind when it fails.
+        """
+        if self.queued >= self.max_queue and self._slots.locked():
+            self.rejected += 1
+            raise ImageQueueFull(self._retry_after())
+
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            data = await self._post_with_retries(payload, handle)
+            self.completed += 1
+            self._total_seconds += time.monotonic() - started
+            return data
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def _post_with_retries(self, payload: Dict[str, Any], handle: Callable[[httpx.Response], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            response = None
+            try:
+                async with self.http_client.stream(
+                    "POST",
+                    self.endpoint,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    json=payload
+                ) as response:
+                    if response.status_code not in RETRYABLE_STATUSES:
+                        if response.is_error:
+                            await response.aread()
+                        response.raise_for_status()
+                        return await handle(response)
+                    if attempt >= self.max_retries:
+                        await response.aread()
+                        response.raise_for_status()
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+
+            await asyncio.sleep(self._backoff(attempt, response))
+            attempt += 1
+            self.retries += 1
+
+    async def aclose(self):
+        """Close the connection pool"""
+        await self.http_client.aclose()
+
+# Process-wide client, created in the application lifespan
+_client: Optional[ImageGenerationClient] = None
+
+def init_image_client(**kwargs) -> ImageGenerationClient:
+    """Create the process-wide image client"""
+    global _client
+    _client = ImageGenerationClient(**kwargs)
+    return _client
+
+def get_image_client() -> ImageGenerationClient:
+    """Get the process-wide image client, creating it on first use outside the app lifespan"""
+    if _client is None:
+        return init_image_client()
+    return _client
+
+async def close_image_client():
+    """Close the process-wide image client"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,220 @@
+"""
+Content-addressed image storage
+
+Blobs are named by the SHA-256 of their bytes and sharded two directory
+levels deep (ab/cd/abcd...), so identical images are stored once and no
+directory grows without bound. Which image id maps to which blob is kept in
+the images table; collect_garbage removes blobs no row refers to. Variants
+(see image_variants.py) are cached beside the blob they were made from.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import tempfile
+import time
+from typing import AsyncIterator, Dict, Iterable, Iterator, NamedTuple, Optional, Set
+
+# Temp files are written next to their target, so the rename is atomic
+TEMP_PREFIX = ".tmp-"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Encoded bytes collected before a streamed image is decoded and written
+INGEST_BATCH_BYTES = 256 * 1024
+
+class StoredBlob(NamedTuple):
+    content_hash: str
+    mime_type: str
+    size_bytes: int
+
+def sniff_mime_type(data: bytes) -> str:
+    """MIME type of image bytes, from their magic number"""
+    if data.startswith(PNG_SIGNATURE):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+def write_atomic(path: str, data: bytes):
+    """Write data to path so readers see either no file or the complete one"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        # mkstemp creates files readable only by their owner
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+class BlobWriter:
+    """Writes a blob in pieces: hashed as it is written, moved into place by commit"""
+
+    def __init__(self, store: "ImageStore"):
+        self.store = store
+        fd, self.temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=store.root)
+        self._file = os.fdopen(fd, "wb")
+        self._hash = hashlib.sha256()
+        self._head = b""
+        self.size = 0
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        if len(self._head) < 16:
+            self._head += data[:16]
+        self._file.write(data)
+        self.size += len(data)
+
+    def write_base64(self, encoded: bytes):
+        """Decode and write base64 text; pieces must be whole 4-character groups"""
+        self.write(base64.b64decode(encoded))
+
+    def commit(self) -> StoredBlob:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        content_hash = self._hash.hexdigest()
+        path = self.store.path(content_hash)
+        blob = StoredBlob(content_hash, sniff_mime_type(self._head), self.size)
+        try:
+            # Already stored: restart its GC grace period, as put does
+            os.utime(path)
+            os.unlink(self.temp_path)
+            return blob
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(self.temp_path, 0o644)
+        os.replace(self.temp_path, path)
+        return blob
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+class ImageStore:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def variant_path(self, content_hash: str, width: Optional[int], fmt: str) -> str:
+        """Where a resized or re-encoded copy of a blob is cached, next to the blob itself"""
+        size = f".w{width}" if width else ""
+        return f"{self.path(content_hash)}{size}.{fmt}"
+
+    def exists(self, content_hash: str) -> bool:
+        return os.path.exists(self.path(content_hash))
+
+    def put(self, data: bytes) -> str:
+        """Store data and return its hash; bytes already stored are not written again"""
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(content_hash)
+        if os.path.exists(path):
+            try:
+                # Restart the GC grace period: the new row may not be committed yet
+                os.utime(path)
+                return content_hash
+            except FileNotFoundError:
+                pass  # collected in the meantime; write it again
+
+        write_atomic(path, data)
+        return content_hash
+
+    def writer(self) -> BlobWriter:
+        """Start writing a blob whose hash is not known yet"""
+        return BlobWriter(self)
+
+    def blobs(self) -> Iterator[str]:
+        """Paths of every stored blob, variant and leftover temp file"""
+        for first in os.scandir(self.root):
+            if first.is_file() and first.name.startswith(TEMP_PREFIX):
+                yield first.path  # from an interrupted BlobWriter
+            if not first.is_dir() or len(first.name) != 2:
+                continue
+            for second in os.scandir(first.path):
+                if not second.is_dir():
+                    continue
+                for entry in os.scandir(second.path):
+                    if entry.is_file():
+                        yield entry.path
+
+    def collect_garbage(self, referenced: Iterable[str], grace_seconds: float = 3600, dry_run: bool = False) -> Dict[str, int]:
+        """Delete blobs whose hash is not in referenced, with their variants.
+
+        Files younger than grace_seconds are kept: their images rows may not
+        be committed yet. Returns counts of kept and removed files and bytes
+        freed.
+        """
+        referenced: Set[str] = set(referenced)
+        cutoff = time.time() - grace_seconds
+        stats = {"kept": 0, "removed": 0, "bytes_freed": 0}
+        for path in self.blobs():
+            # Variants are named <hash>[.w<width>].<format>; temp files never match
+            name = os.path.basename(path).split(".", 1)[0]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name in referenced or stat.st_mtime > cutoff:
+                stats["kept"] += 1
+                continue
+            if not dry_run:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+            stats["removed"] += 1
+            stats["bytes_freed"] += stat.st_size
+        return stats
+
+async def store_base64_stream(chunks: AsyncIterator[bytes], store: Optional[ImageStore] = None) -> StoredBlob:
+    """Store an image arriving as pieces of base64 text.
+
+    Pieces are collected into batches that are decoded, hashed and written
+    on a worker thread, so neither the event loop nor memory ever holds the
+    whole image.
+    """
+    store = store or get_image_store()
+    writer = await asyncio.to_thread(store.writer)
+    pending = bytearray()
+    try:
+        async for chunk in chunks:
+            pending += chunk
+            if len(pending) >= INGEST_BATCH_BYTES:
+                usable = len(pending) - len(pending) % 4
+                await asyncio.to_thread(writer.write_base64, bytes(pending[:usable]))
+                del pending[:usable]
+        await asyncio.to_thread(writer.write_base64, bytes(pending))
+        return await asyncio.to_thread(writer.commit)
+    except BaseException:
+        writer.abort()
+        raise
+
+# Process-wide store
+_store: Optional[ImageStore] = None
+
+def get_image_store() -> ImageStore:
+    global _store
+    if _store is None:
+        from .config import IMAGE_STORE_PATH
+        _store = ImageStore(IMAGE_STORE_PATH)
+    return _store
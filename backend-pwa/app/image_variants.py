@@ -0,0 +1,130 @@
+"""
+Resized and re-encoded copies of stored images
+
+Variants are made from the stored blob in a process pool, since decoding and
+encoding a 1024x1024 image takes tens of milliseconds of CPU. They are cached
+on disk beside the blob (see ImageStore.variant_path), so each one is made
+once; concurrent requests for a variant being made wait for the same job.
+"""
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+from .config import IMAGE_VARIANT_WIDTHS, IMAGE_VARIANT_WORKERS, IMAGE_WEBP_QUALITY
+from .image_store import get_image_store, write_atomic
+
+FORMATS = {"webp": "image/webp", "png": "image/png"}
+
+def render_variant(source_path: str, target_path: str, width: Optional[int], fmt: str, quality: int) -> str:
+    """Write source scaled down to width (if wider) in fmt to target_path; runs in a worker process"""
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        image.load()
+        if width and image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        if fmt == "webp":
+            image.save(buffer, "WEBP", quality=quality, method=4)
+        else:
+            image.save(buffer, "PNG", optimize=True)
+    write_atomic(target_path, buffer.getvalue())
+    return target_path
+
+def variant_width(requested: Optional[int]) -> Optional[int]:
+    """Smallest configured width that covers requested; None means full size"""
+    if requested is None:
+        return None
+    covering = [width for width in sorted(IMAGE_VARIANT_WIDTHS) if width >= requested]
+    return covering[0] if covering else None
+
+# Process-wide worker pool, created in the application lifespan
+_pool: Optional[ProcessPoolExecutor] = None
+# Variants being made, by target path, with the pool making them
+_pending: Dict[str, Tuple[asyncio.Future, ProcessPoolExecutor]] = {}
+_background_tasks = set()
+variant_stats = {"rendered": 0, "failed": 0}
+
+def init_variant_pool(workers: int = IMAGE_VARIANT_WORKERS) -> ProcessPoolExecutor:
+    """Create the process-wide variant pool"""
+    global _pool
+    # Workers only need Pillow; forking a process with live threads and connections is not safe
+    _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def get_variant_pool() -> ProcessPoolExecutor:
+    """Get the process-wide variant pool, creating it on first use outside the app lifespan"""
+    if _pool is None:
+        return init_variant_pool()
+    return _pool
+
+def close_variant_pool():
+    """Stop the worker processes, dropping variants not started yet"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+async def get_variant(content_hash: str, width: Optional[int], fmt: str) -> Optional[str]:
+    """Path of a variant of a stored image, making it if needed; None if it cannot be made"""
+    store = get_image_store()
+    target_path = store.variant_path(content_hash, width, fmt)
+    if os.path.exists(target_path):
+        return target_path
+
+    future, pool = _pending.get(target_path, (None, None))
+    if future is None:
+        pool = get_variant_pool()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                pool, render_variant, store.path(content_hash), target_path, width, fmt, IMAGE_WEBP_QUALITY
+            )
+        except BrokenProcessPool:
+            _replace_broken_pool(pool)
+            return None
+        _pending[target_path] = (future, pool)
+        future.add_done_callback(lambda _: _pending.pop(target_path, None))
+        future.add_done_callback(_count_result)
+    try:
+        # One waiter giving up must not cancel the job for the others
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        raise
+    except BrokenProcessPool:
+        _replace_broken_pool(pool)
+        return None
+    except Exception as e:
+        print(f"Image variant error ({content_hash} w={width} {fmt}): {str(e)}")
+        return None
+
+def _replace_broken_pool(pool: Optional[ProcessPoolExecutor]):
+    """A worker died (e.g. killed for memory): start a new pool on next use"""
+    global _pool
+    if pool is not None and pool is _pool:
+        print("Image variant pool broken, restarting it")
+        pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _count_result(future: asyncio.Future):
+    if future.cancelled() or future.exception() is not None:
+        variant_stats["failed"] += 1
+    else:
+        variant_stats["rendered"] += 1
+
+def schedule_variants(content_hash: str, widths: List[Optional[int]] = None):
+    """Start making the WebP variants of a newly stored image in the background"""
+    widths = widths if widths is not None else [*IMAGE_VARIANT_WIDTHS, None]
+    loop = asyncio.get_running_loop()
+    for width in widths:
+        task = loop.create_task(get_variant(content_hash, width, "webp"))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+def variant_metrics() -> Dict[str, int]:
+    """Variants made and failed, and jobs in progress"""
+    return {**variant_stats, "pending": len(_pending)}
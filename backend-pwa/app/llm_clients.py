@@ -0,0 +1,104 @@
+"""
+Shared, connection-pooled clients for the OpenAI chat models
+"""
+from typing import Dict, List, Optional
+
+import httpx
+import openai
+from langchain_core.runnables import Runnable
+from langchain_openai import ChatOpenAI
+
+from .config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    LLM_POOL_MAX_CONNECTIONS,
+    LLM_POOL_MAX_KEEPALIVE,
+    LLM_POOL_KEEPALIVE_EXPIRY,
+    LLM_HTTP2,
+    LLM_REQUEST_TIMEOUT
+)
+
+DEFAULT_TEMPERATURE = 0.7
+
+def resolve_temperature(temperature: Optional[float]) -> float:
+    """The temperature a request runs at"""
+    return DEFAULT_TEMPERATURE if temperature is None else temperature
+
+class LLMClientRegistry:
+    """Keeps one ChatOpenAI per model over a single HTTP connection pool; temperature is bound per call"""
+
+    def __init__(
+        self,
+        api_key: str = OPENAI_API_KEY,
+        base_url: str = OPENAI_BASE_URL,
+        max_connections: int = LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_POOL_MAX_KEEPALIVE,
+        keepalive_expiry: float = LLM_POOL_KEEPALIVE_EXPIRY,
+        http2: bool = LLM_HTTP2,
+        timeout: float = LLM_REQUEST_TIMEOUT
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            http2=http2,
+            timeout=timeout
+        )
+        self._async_openai = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client)
+        # Only used if something calls a model synchronously; it opens no connections until then
+        self._sync_openai = openai.OpenAI(api_key=api_key, base_url=base_url)
+        self._models: Dict[str, ChatOpenAI] = {}
+
+    def get(self, model_name: str, temperature: Optional[float] = DEFAULT_TEMPERATURE) -> Runnable:
+        """Get the shared chat model for a model name, bound to the exact temperature given"""
+        model = self._models.get(model_name)
+        if model is None:
+            model = ChatOpenAI(
+                model_name=model_name,
+                openai_api_key=self.api_key,
+                openai_api_base=self.base_url,
+                temperature=DEFAULT_TEMPERATURE,
+                client=self._sync_openai.chat.completions,
+                async_client=self._async_openai.chat.completions,
+            )
+            self._models[model_name] = model
+        # Call arguments override the model's defaults in the request
+        return model.bind(temperature=resolve_temperature(temperature))
+
+    async def embed(self, text: str, model: str, dimensions: Optional[int] = None) -> List[float]:
+        """Embedding of one text, over the shared connection pool"""
+        extra = {"dimensions": dimensions} if dimensions else {}
+        response = await self._async_openai.embeddings.create(model=model, input=text, **extra)
+        return response.data[0].embedding
+
+    async def aclose(self):
+        """Close the connection pools"""
+        self._models.clear()
+        await self.http_client.aclose()
+        self._sync_openai.close()
+
+# Process-wide registry, created in the application lifespan
+_registry: Optional[LLMClientRegistry] = None
+
+def init_llm_clients(**kwargs) -> LLMClientRegistry:
+    """Create the process-wide registry"""
+    global _registry
+    _registry = LLMClientRegistry(**kwargs)
+    return _registry
+
+def get_llm_clients() -> LLMClientRegistry:
+    """Get the process-wide registry, creating it on first use outside the app lifespan"""
+    if _registry is None:
+        return init_llm_clients()
+    return _registry
+
+async def close_llm_clients():
+    """Close the process-wide registry"""
+    global _registry
+    if _registry is not None:
+        await _registry.aclose()
+        _registry = None
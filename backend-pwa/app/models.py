@@ -2,7 +2,7 @@
 Data models for the application
 """
 from typing import List, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from datetime import datetime
 
 # Models
@@ -22,6 +22,47 @@ class Conversation(BaseModel):
     created_at: str
     updated_at: str
 
+    # Snapshot of what is already stored, set when loaded from the database.
+    # Lets save_conversation append only the new messages.
+    _persisted: Optional[List[tuple]] = PrivateAttr(default=None)
+
+class ConversationImport(BaseModel):
+    # Generated if missing; conversations whose id is taken are skipped
+    id: Optional[str] = None
+    title: Optional[str] = None
+    messages: List[Message] = []
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class ConversationImportRequest(BaseModel):
+    user_id: str
+    conversations: List[ConversationImport]
+
+class ConversationImportResult(BaseModel):
+    imported: List[str]
+    # Ids that already existed
+    skipped: List[str]
+
+class ConversationSummary(BaseModel):
+    id: str
+    user_id: str
+    title: Optional[str] = "New Conversation"
+    message_count: int = 0
+    last_message_preview: Optional[str] = None
+    last_message_at: Optional[str] = None
+    created_at: str
+    updated_at: str
+
+class MessageSearchResult(BaseModel):
+    conversation_id: str
+    conversation_title: Optional[str] = None
+    message_id: int
+    role: str
+    sequence_number: int
+    # HTML-escaped message excerpt with the matches wrapped in <mark>
+    snippet: str
+    rank: float
+
 class User(BaseModel):
     user_id: str
     name: str
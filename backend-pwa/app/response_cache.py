@@ -0,0 +1,170 @@
+"""
+Cache of model answers for repeated prompts
+
+Answers are stored under a hash of the model, temperature, token limit and
+normalized message history (the exact tier). Optionally, the last user
+message is also embedded, and a prompt whose history matches exactly and
+whose last message is close enough to a cached one gets that answer (the
+semantic tier). Only prompt types and temperatures low enough for a stored
+answer to stand in for a fresh one are cached; search answers expire sooner.
+"""
+import hashlib
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from .classifier import PROMPT_TYPES, normalize_prompt
+from .llm_clients import resolve_temperature
+from .models import Message
+
+class VectorIndex:
+    """Brute-force cosine similarity over a fixed number of slots.
+
+    Vectors are grouped by partition (the exact history before the last
+    message); only vectors of the same partition are compared. When full,
+    the oldest vector is overwritten.
+    """
+
+    def __init__(self, capacity: int, dimensions: int):
+        self.capacity = capacity
+        self.dimensions = dimensions
+        self._vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self._partitions = np.zeros(capacity, dtype=np.int64)
+        self._keys: List[Optional[str]] = [None] * capacity
+        self._next = 0
+        self.size = 0
+
+    @staticmethod
+    def partition_id(partition: str) -> int:
+        return int.from_bytes(hashlib.sha1(partition.encode("utf-8")).digest()[:8], "big", signed=True)
+
+    def add(self, partition: str, vector: Sequence[float], key: str):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if vector.shape != (self.dimensions,) or norm == 0:
+            return
+        slot = self._next
+        self._vectors[slot] = vector / norm
+        self._partitions[slot] = self.partition_id(partition)
+        self._keys[slot] = key
+        self._next = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def nearest(self, partition: str, vector: Sequence[float], min_similarity: float) -> Optional[str]:
+        """Key of the most similar vector in the partition, if it is at least min_similarity"""
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if self.size == 0 or vector.shape != (self.dimensions,) or norm == 0:
+            return None
+        candidates = np.flatnonzero(self._partitions[:self.size] == self.partition_id(partition))
+        if candidates.size == 0:
+            return None
+        similarities = self._vectors[candidates] @ (vector / norm)
+        best = int(np.argmax(similarities))
+        if similarities[best] < min_similarity:
+            return None
+        return self._keys[candidates[best]]
+
+class ResponseKey:
+    """Where an answer is cached; created by ResponseCache.key"""
+
+    def __init__(self, prompt_type: str, exact: str, partition: str, query: str):
+        self.prompt_type = prompt_type
+        self.exact = exact
+        self.partition = partition
+        self.query = query
+        # Embedding of query, computed on lookup and reused when the answer is stored
+        self.embedding: Optional[List[float]] = None
+
+def _history_text(messages: Iterable[Message]) -> str:
+    return "\n".join(f"{message.role}: {normalize_prompt(message.content)}" for message in messages)
+
+class ResponseCache:
+    """Exact and (optionally) semantic lookup of model answers, with per-type counters"""
+
+    def __init__(
+        self,
+        cache,
+        ttls: Dict[str, float],
+        max_temperature: float = 0.3,
+        index: Optional[VectorIndex] = None,
+        embed: Optional[Callable[[str], Awaitable[List[float]]]] = None,
+        min_similarity: float = 0.95
+    ):
+        # Any object with aget/aset, e.g. cache.LRUCache or cache.SQLiteCache
+        self.cache = cache
+        # Prompt type -> seconds an answer is reused; types without one are not cached
+        self.ttls = ttls
+        self.max_temperature = max_temperature
+        self.index = index if embed is not None else None
+        self.embed = embed
+        self.min_similarity = min_similarity
+        self.stats: Dict[str, Dict[str, int]] = {
+            prompt_type: {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stored": 0, "embedding_errors": 0}
+            for prompt_type in PROMPT_TYPES
+            if prompt_type != "image"
+        }
+
+    def key(
+        self,
+        prompt_type: str,
+        model: str,
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        messages: List[Message]
+    ) -> Optional[ResponseKey]:
+        """Cache key for a request, or None if its answer should not be cached"""
+        temperature = resolve_temperature(temperature)
+        if prompt_type not in self.stats or prompt_type not in self.ttls or temperature > self.max_temperature or not messages:
+            return None
+        if messages[-1].role != "user":
+            return None
+        settings = f"{prompt_type}|{model}|{temperature}|{max_tokens}"
+        partition = f"{settings}\n{_history_text(messages[:-1])}"
+        query = normalize_prompt(messages[-1].content)
+        exact = hashlib.sha256(f"{partition}\nuser: {query}".encode("utf-8")).hexdigest()
+        return ResponseKey(prompt_type, exact, partition, query)
+
+    async def get(self, key: ResponseKey) -> Optional[str]:
+        stats = self.stats[key.prompt_type]
+        content = await self.cache.aget(key.exact)
+        if content is not None:
+            stats["exact_hits"] += 1
+            return content
+
+        if self.index is not None:
+            try:
+                key.embedding = await self.embed(key.query)
+            except Exception as e:
+                print(f"Response cache embedding error: {str(e)}")
+                stats["embedding_errors"] += 1
+            if key.embedding is not None:
+                similar = self.index.nearest(key.partition, key.embedding, self.min_similarity)
+                # The answer itself may have expired or been evicted since
+                content = await self.cache.aget(similar) if similar else None
+                if content is not None:
+                    stats["semantic_hits"] += 1
+                    return content
+
+        stats["misses"] += 1
+        return None
+
+    async def set(self, key: ResponseKey, content: str):
+        if not content:
+            return
+        await self.cache.aset(key.exact, content, ttl=self.ttls[key.prompt_type])
+        if self.index is not None and key.embedding is not None:
+            self.index.add(key.partition, key.embedding, key.exact)
+        self.stats[key.prompt_type]["stored"] += 1
+
+    def metrics(self) -> Dict[str, Dict]:
+        by_type = {}
+        for prompt_type, counts in self.stats.items():
+            lookups = counts["exact_hits"] + counts["semantic_hits"] + counts["misses"]
+            hits = counts["exact_hits"] + counts["semantic_hits"]
+            by_type[prompt_type] = {**counts, "hit_rate": hits / lookups if lookups else None}
+        return {
+            "types": by_type,
+            "cache": self.cache.stats(),
+            "vectors": self.index.size if self.index is not None else None
+        }
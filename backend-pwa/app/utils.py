@@ -2,39 +2,12 @@
 Utility functions for the application
 """
 import os
-import base64
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 from .models import Message
+from .image_store import StoredBlob, get_image_store
 from langchain.schema import HumanMessage, AIMessage, SystemMessage
 
-# Class to track image context
-class ImageContext:
-    last_image_id: str = None
-    last_prompt: str = None
-    revision_count: int = 0
-    history: List[Dict[str, str]] = []  # Track all image generations
-
-    def add_image(self, image_id: str, prompt: str, is_modification: bool = False):
-        """Add an image to the history"""
-        self.last_image_id = image_id
-        self.last_prompt = prompt
-        if is_modification:
-            self.revision_count += 1
-        else:
-            self.revision_count = 0
-
-        # Add to history
-        from datetime import datetime
-        self.history.append({
-            "image_id": image_id,
-            "prompt": prompt,
-            "is_modification": is_modification,
-            "created_at": datetime.now().isoformat()
-        })
-
-
-
 def convert_to_langchain_messages(messages: List[Message]):
     """Convert our Message objects to LangChain message objects"""
     lc_messages = []
@@ -47,16 +20,47 @@ def convert_to_langchain_messages(messages: List[Message]):
             lc_messages.append(SystemMessage(content=msg.content))
     return lc_messages
 
-async def save_image(image_data: str, image_id: str) -> str:
-    """Save base64 image data to a file and return the path"""
-    if "base64," in image_data:
-        image_data = image_data.split("base64,")[1]
+async def record_image(
+    blob: StoredBlob,
+    image_id: str,
+    user_id: str,
+    prompt: str,
+    conversation_id: Optional[str] = None,
+    is_modification: bool = False,
+    original_image_id: Optional[str] = None,
+    revision: int = 0
+) -> str:
+    """Record an image already in the store under image_id and return the blob path"""
+    from .database import get_image_blob, save_image_record
+    from .image_variants import schedule_variants
 
-    image_bytes = base64.b64decode(image_data)
+    store = get_image_store()
+    image_path = store.path(blob.content_hash)
+    if original_image_id and await get_image_blob(original_image_id) is None:
+        # Images from before the store have no row to refer to
+        original_image_id = None
+    await save_image_record(
+        image_id, user_id, prompt, os.path.relpath(image_path, store.root), blob.content_hash,
+        blob.mime_type, blob.size_bytes, conversation_id, is_modification, original_image_id, revision
+    )
+    schedule_variants(blob.content_hash)
+    return image_path
+
+async def find_image(image_id: str) -> Optional[Tuple[str, str, Optional[str]]]:
+    """(file path, MIME type, content hash) of an image, or None if there is no such image.
+
+    Images saved before the content-addressed store are still read from
+    their flat {image_id}.png files, and have no content hash.
+    """
     from .config import IMAGES_PATH
-    image_path = os.path.join(IMAGES_PATH, f"{image_id}.png")
+    from .database import get_image_blob
 
-    with open(image_path, "wb") as image_file:
-        image_file.write(image_bytes)
+    blob = await get_image_blob(image_id)
+    if blob is not None:
+        content_hash, mime_type = blob
+        return get_image_store().path(content_hash), mime_type or "image/png", content_hash
 
-    return image_path
+    legacy_path = os.path.join(IMAGES_PATH, f"{os.path.basename(image_id)}.png")
+    if os.path.exists(legacy_path):
+        return legacy_path, "image/png", None
+    return None
@@ -0,0 +1,86 @@
+"""
+Benchmark the local prompt classification stages
+
+Trains the hashed n-gram model on half of the labelled fixture set and
+evaluates rules + model on the other half, then on a held-out set written
+separately from the rules: near misses that mention an image or the news
+without asking for one, and replies whose meaning depends on the previous
+message. Prompts the local stages are not confident about count as
+deferred to the remote classifier:
+
+    python benchmarks/bench_classifier.py
+"""
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.classifier import ClassificationPipeline, HashedNgramClassifier, RuleClassifier, load_decisions
+from app.models import Message
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "classifier_prompts.jsonl")
+HELD_OUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "classifier_heldout.jsonl")
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def never_called(prompt, context):
+    raise AssertionError("remote classifier is not used in this benchmark")
+
+def load_held_out(path):
+    """(prompt, label, context) triples; context is the messages before the prompt"""
+    cases = []
+    with open(path) as fixture_file:
+        for line in fixture_file:
+            if line.strip():
+                record = json.loads(line)
+                context = [Message(**message) for message in record.get("context", [])]
+                cases.append((record["prompt"], record["label"], context))
+    return cases
+
+def evaluate(name, local_stages, cases):
+    pipeline = ClassificationPipeline(local_stages, never_called)
+    answered = correct = 0
+    latencies = []
+    for prompt, label, context in cases:
+        start = time.perf_counter()
+        result = pipeline.classify_local(prompt, context)
+        latencies.append((time.perf_counter() - start) * 1e6)
+        if result:
+            answered += 1
+            correct += result[0] == label
+    accuracy = correct / answered if answered else 0.0
+    print(f"{name:>12} {answered / len(cases):>9.0%} {accuracy:>9.1%} "
+          f"{statistics.median(latencies):>8.0f} {percentile(latencies, 99):>8.0f}")
+
+def main():
+    examples = load_decisions(FIXTURES)
+    random.Random(42).shuffle(examples)
+    train, test = examples[:len(examples) // 2], examples[len(examples) // 2:]
+
+    model = HashedNgramClassifier().train(train)
+    stages = {
+        "rules": [RuleClassifier()],
+        "model": [model],
+        "rules+model": [RuleClassifier(), model],
+    }
+
+    header = f"{'stages':>12} {'answered':>9} {'accuracy':>9} {'p50 us':>8} {'p99 us':>8}"
+    print(f"trained on {len(train)}, evaluating {len(test)} prompts")
+    print(header)
+    for name, local_stages in stages.items():
+        evaluate(name, local_stages, [(prompt, label, None) for prompt, label in test])
+
+    held_out = load_held_out(HELD_OUT)
+    print(f"\nheld-out set, {len(held_out)} prompts")
+    print(header)
+    for name, local_stages in stages.items():
+        evaluate(name, local_stages, held_out)
+
+if __name__ == "__main__":
+    main()
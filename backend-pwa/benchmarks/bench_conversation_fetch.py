@@ -0,0 +1,102 @@
+"""
+Benchmark loading a conversation as its history grows
+
+Compares the single joined, column-only query used by get_conversation_by_id
+against the old path (header query, then message ORM objects copied into
+schemas). Runs against DATABASE_URL, or a temporary SQLite file if it is not set.
+BENCH_QUERY_LATENCY_MS adds a delay per statement to stand in for a network
+round trip to the database:
+
+    BENCH_QUERY_LATENCY_MS=1 python benchmarks/bench_conversation_fetch.py
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from sqlalchemy import event
+
+from app.models import Message, Conversation, User
+from app.db import models
+from app.db.crud import create_or_update_user, create_conversation, get_conversation_by_id, mark_persisted
+from app.db.database import engine, SessionLocal
+from app.db.migrations import migrate
+
+HISTORY_SIZES = [10, 100, 1000]
+ROUNDS = 50
+QUERY_LATENCY = float(os.getenv("BENCH_QUERY_LATENCY_MS", "0")) / 1000
+
+statements = 0
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    global statements
+    statements += 1
+    if QUERY_LATENCY:
+        time.sleep(QUERY_LATENCY)
+
+def legacy_fetch(db, conversation_id: str) -> Conversation:
+    """The old read path"""
+    db_conversation = db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
+    db_messages = db.query(models.Message).filter(
+        models.Message.conversation_id == conversation_id
+    ).order_by(models.Message.sequence_number).all()
+    messages = [
+        Message(role=msg.role, content=msg.content, name=msg.name, content_type=msg.content_type, image_url=msg.image_url)
+        for msg in db_messages
+    ]
+    conversation = Conversation(
+        id=db_conversation.id,
+        user_id=db_conversation.user_id,
+        title=db_conversation.title,
+        messages=messages,
+        created_at=db_conversation.created_at.isoformat(),
+        updated_at=db_conversation.updated_at.isoformat()
+    )
+    mark_persisted(conversation)
+    return conversation
+
+def seed_conversation(db, user_id: str, size: int) -> str:
+    now = datetime.now().isoformat()
+    conversation = Conversation(id=str(uuid.uuid4()), user_id=user_id, messages=[], created_at=now, updated_at=now)
+    for i in range(size):
+        role = "user" if i % 2 == 0 else "assistant"
+        conversation.messages.append(Message(role=role, content=f"message {i} " * 20))
+    create_conversation(db, conversation)
+    return conversation.id
+
+def measure(fetch, conversation_id: str) -> tuple:
+    """Median milliseconds per fetch and statements per fetch"""
+    global statements
+    timings = []
+    statements = 0
+    for _ in range(ROUNDS):
+        db = SessionLocal()
+        start = time.perf_counter()
+        fetch(db, conversation_id)
+        timings.append((time.perf_counter() - start) * 1000)
+        db.close()
+    return statistics.median(timings), statements / ROUNDS
+
+def main():
+    migrate(engine)
+    db = SessionLocal()
+    user_id = f"bench-{uuid.uuid4()}"
+    create_or_update_user(db, User(user_id=user_id, name="Bench", email=f"{user_id}@example.com"))
+
+    print(f"{'history':>8} {'joined ms':>10} {'queries':>8} {'legacy ms':>10} {'queries':>8}")
+    for size in HISTORY_SIZES:
+        conversation_id = seed_conversation(db, user_id, size)
+        joined_ms, joined_queries = measure(get_conversation_by_id, conversation_id)
+        legacy_ms, legacy_queries = measure(legacy_fetch, conversation_id)
+        print(f"{size:>8} {joined_ms:>10.2f} {joined_queries:>8.0f} {legacy_ms:>10.2f} {legacy_queries:>8.0f}")
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark chat-turn throughput with slow database round trips
+
+Every statement gets an artificial delay (as a remote database would add).
+Concurrent fake chat turns - load the conversation, wait on the "model",
+save the turn - are run once with the CRUD calls made directly on the
+event loop and once through the database thread pool:
+
+    python benchmarks/bench_db_offload.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from sqlalchemy import event
+
+from app.models import Message, Conversation
+from app.database import save_user, save_conversation, get_conversation, _save_conversation, SessionLocal
+from app.db.crud import get_conversation_by_id
+from app.db.database import engine
+
+QUERY_LATENCY = 0.005
+MODEL_LATENCY = 0.2
+CONCURRENCY = [1, 10, 50]
+
+@event.listens_for(engine, "before_cursor_execute")
+def slow_round_trip(conn, cursor, statement, parameters, context, executemany):
+    time.sleep(QUERY_LATENCY)
+
+async def blocking_turn(conversation_id: str):
+    """The old way: synchronous CRUD calls straight from the coroutine"""
+    db = SessionLocal()
+    try:
+        conversation = get_conversation_by_id(db, conversation_id)
+    finally:
+        db.close()
+    await asyncio.sleep(MODEL_LATENCY)
+    conversation.messages.append(Message(role="user", content="question"))
+    conversation.messages.append(Message(role="assistant", content="answer"))
+    db = SessionLocal()
+    try:
+        _save_conversation(db, conversation)
+    finally:
+        db.close()
+
+async def offloaded_turn(conversation_id: str):
+    conversation = await get_conversation(conversation_id)
+    await asyncio.sleep(MODEL_LATENCY)
+    conversation.messages.append(Message(role="user", content="question"))
+    conversation.messages.append(Message(role="assistant", content="answer"))
+    await save_conversation(conversation)
+
+async def event_loop_lag(stop: asyncio.Event) -> float:
+    """Worst delay seen by a 10ms ticker while the turns run"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time.perf_counter() - start - 0.01)
+    return worst
+
+async def run(turn, conversation_ids) -> tuple:
+    stop = asyncio.Event()
+    lag = asyncio.create_task(event_loop_lag(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(turn(conversation_id) for conversation_id in conversation_ids))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return len(conversation_ids) / elapsed, await lag
+
+async def seed(user_id: str, count: int):
+    ids = []
+    for _ in range(count):
+        now = datetime.now().isoformat()
+        conversation = Conversation(id=str(uuid.uuid4()), user_id=user_id, messages=[], created_at=now, updated_at=now)
+        conversation.messages.append(Message(role="user", content="hello"))
+        await save_conversation(conversation)
+        ids.append(conversation.id)
+    return ids
+
+async def main():
+    user_id = f"bench-{uuid.uuid4()}"
+    await save_user({"user_id": user_id, "name": "Bench", "email": f"{user_id}@example.com"})
+
+    print(f"query latency {QUERY_LATENCY * 1000:.0f}ms, model latency {MODEL_LATENCY * 1000:.0f}ms")
+    print(f"{'turns':>6} {'blocking turns/s':>17} {'max lag ms':>11} {'offloaded turns/s':>18} {'max lag ms':>11}")
+    for concurrency in CONCURRENCY:
+        blocking_rate, blocking_lag = await run(blocking_turn, await seed(user_id, concurrency))
+        offloaded_rate, offloaded_lag = await run(offloaded_turn, await seed(user_id, concurrency))
+        print(f"{concurrency:>6} {blocking_rate:>17.1f} {blocking_lag * 1000:>11.0f} "
+              f"{offloaded_rate:>18.1f} {offloaded_lag * 1000:>11.0f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Exercise the image generation client against a local fake images endpoint
+
+Sends a burst of concurrent requests at an endpoint that is slow and
+sometimes fails, then reports how many were served, retried and rejected
+with 429:
+
+    python benchmarks/bench_image_client.py
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.image_client import ImageGenerationClient, ImageQueueFull
+from stub_openai import StubOpenAIServer
+
+BURST = 30
+FAILURE_RATE = 0.2
+FAKE_IMAGE = base64.b64encode(os.urandom(256 * 1024)).decode("ascii")
+
+def fake_images_endpoint(body: bytes):
+    """Fail a fraction of requests with 503, answer the rest with a fake image"""
+    if random.random() < FAILURE_RATE:
+        return 503, {}, b'{"error": {"message": "overloaded"}}'
+    return 200, {}, json.dumps({"created": int(time.time()), "data": [{"b64_json": FAKE_IMAGE}]}).encode()
+
+async def main():
+    server = await StubOpenAIServer(latency=0.2).start()
+    server.handlers["/v1/images/generations"] = fake_images_endpoint
+    client = ImageGenerationClient(api_key="stub", base_url=server.base_url, max_concurrency=4, max_queue=8, retry_base_delay=0.05)
+
+    peak_in_flight = 0
+    outcomes = {"ok": 0, "rejected": 0, "error": 0}
+
+    async def one_request():
+        nonlocal peak_in_flight
+        try:
+            task = asyncio.ensure_future(client.generate({"prompt": "a cat"}))
+            await asyncio.sleep(0)
+            peak_in_flight = max(peak_in_flight, client.in_flight)
+            await task
+            outcomes["ok"] += 1
+        except ImageQueueFull:
+            outcomes["rejected"] += 1
+        except Exception:
+            outcomes["error"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(BURST)))
+    elapsed = time.perf_counter() - start
+
+    print(f"burst of {BURST} in {elapsed:.2f}s: {outcomes}, peak in-flight {peak_in_flight}")
+    print(f"client metrics: {client.metrics()}")
+    print(f"connections opened: {server.connections_opened}")
+
+    await client.aclose()
+    await server.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
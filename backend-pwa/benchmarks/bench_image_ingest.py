@@ -0,0 +1,111 @@
+"""
+Benchmark event-loop lag while generated images are saved
+
+A fake images endpoint (on its own thread, so it does not load the loop
+being measured) answers with a DALL-E sized b64_json payload. Concurrent
+generations are saved once the old way - whole JSON parsed, base64 decoded
+and file written on the event loop - and once streamed into the image store.
+A 1ms ticker records how late the loop wakes up, and tracemalloc the peak
+memory of saving one image (both include the fake server's send buffer):
+
+    python benchmarks/bench_image_ingest.py
+"""
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.image_client import ImageGenerationClient, iter_b64_json
+from app.image_store import ImageStore, PNG_SIGNATURE, store_base64_stream
+from stub_openai import StubOpenAIServer
+
+IMAGE_BYTES = int(os.getenv("INGEST_IMAGE_BYTES", str(1536 * 1024)))
+CONCURRENCY = [1, 4, 16]
+ROUNDS = 3
+FAKE_RESPONSE = json.dumps({
+    "created": int(time.time()),
+    "data": [{
+        "revised_prompt": "a cat",
+        # Random bytes compress about as badly as a PNG does
+        "b64_json": base64.b64encode(PNG_SIGNATURE + os.urandom(IMAGE_BYTES)).decode("ascii")
+    }]
+}).encode()
+
+def start_server() -> StubOpenAIServer:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(StubOpenAIServer().start(), loop).result()
+    server.handlers["/v1/images/generations"] = lambda body: (200, {}, FAKE_RESPONSE)
+    return server
+
+async def buffered_save(client: ImageGenerationClient, directory: str):
+    """The old way: parse the whole response, then decode and write on the event loop"""
+    data = await client.generate({"prompt": "a cat"})
+    image_bytes = base64.b64decode(data["data"][0]["b64_json"])
+    with open(os.path.join(directory, f"{uuid.uuid4()}.png"), "wb") as image_file:
+        image_file.write(image_bytes)
+
+async def streamed_save(client: ImageGenerationClient, store: ImageStore):
+    await client.generate({"prompt": "a cat"}, lambda response: store_base64_stream(iter_b64_json(response), store))
+
+async def loop_lag(stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append(time.perf_counter() - start - 0.001)
+
+async def run(save, concurrency: int) -> tuple:
+    stop, samples = asyncio.Event(), []
+    ticker = asyncio.create_task(loop_lag(stop, samples))
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await asyncio.gather(*(save() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    samples.sort()
+    return ROUNDS * concurrency / elapsed, samples[int(len(samples) * 0.99)], samples[-1]
+
+async def peak_memory(save) -> float:
+    tracemalloc.start()
+    await save()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+async def main():
+    server = start_server()
+    client = ImageGenerationClient(api_key="stub", base_url=server.base_url, max_concurrency=max(CONCURRENCY))
+    directory = tempfile.mkdtemp()
+    store = ImageStore(os.path.join(directory, "store"))
+
+    def buffered():
+        return buffered_save(client, directory)
+
+    def streamed():
+        return streamed_save(client, store)
+
+    # Warm up the connection pool and the thread pool
+    await buffered()
+    await streamed()
+
+    print(f"image {IMAGE_BYTES / 1024 / 1024:.1f} MB, response {len(FAKE_RESPONSE) / 1024 / 1024:.1f} MB")
+    print(f"peak memory per save: buffered {await peak_memory(buffered):.1f} MB, streamed {await peak_memory(streamed):.1f} MB")
+    print(f"{'concurrent':>10} {'mode':>9} {'saves/s':>8} {'p99 lag ms':>11} {'max lag ms':>11}")
+    for concurrency in CONCURRENCY:
+        for name, save in (("buffered", buffered), ("streamed", streamed)):
+            rate, p99, worst = await run(save, concurrency)
+            print(f"{concurrency:>10} {name:>9} {rate:>8.1f} {p99 * 1000:>11.1f} {worst * 1000:>11.1f}")
+
+    await client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
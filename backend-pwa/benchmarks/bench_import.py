@@ -0,0 +1,101 @@
+"""
+Benchmark importing many conversations at once
+
+Compares the old create path (conversation row, commit, refresh, one INSERT
+per message, commit), create_conversation as it is now (one transaction,
+one multi-row message INSERT) and bulk_create_conversations at a few batch
+sizes. Runs against DATABASE_URL, or a temporary SQLite file if it is not set:
+
+    python benchmarks/bench_import.py
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from app.models import Message, Conversation, User
+from app.database import get_session
+from app.db import crud, models
+
+CONVERSATIONS = int(os.getenv("IMPORT_CONVERSATIONS", "2000"))
+MESSAGES_PER_CONVERSATION = 10
+BATCH_SIZES = [100, 1000]
+
+def make_conversations(user_id: str, count: int) -> List[Conversation]:
+    now = datetime.now().isoformat()
+    return [
+        Conversation(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            title=f"Imported {i}",
+            messages=[
+                Message(role="user" if j % 2 == 0 else "assistant", content=f"message {j} of conversation {i} " * 10)
+                for j in range(MESSAGES_PER_CONVERSATION)
+            ],
+            created_at=now,
+            updated_at=now
+        )
+        for i in range(count)
+    ]
+
+def legacy_create(conversations: List[Conversation]):
+    """The old create_conversation, once per conversation"""
+    with get_session() as db:
+        for conversation in conversations:
+            db_conversation = models.Conversation(
+                id=conversation.id,
+                user_id=conversation.user_id,
+                title=conversation.title,
+                message_count=len(conversation.messages)
+            )
+            db.add(db_conversation)
+            db.commit()
+            db.refresh(db_conversation)
+            for i, message in enumerate(conversation.messages):
+                db.add(models.Message(
+                    conversation_id=db_conversation.id,
+                    role=message.role,
+                    content=message.content,
+                    content_type=message.content_type,
+                    sequence_number=i
+                ))
+            db.commit()
+
+def single_create(conversations: List[Conversation]):
+    with get_session() as db:
+        for conversation in conversations:
+            crud.create_conversation(db, conversation)
+
+def bulk_create(batch_size: int) -> Callable[[List[Conversation]], None]:
+    def create(conversations: List[Conversation]):
+        with get_session() as db:
+            for start in range(0, len(conversations), batch_size):
+                crud.bulk_create_conversations(db, conversations[start:start + batch_size])
+    return create
+
+def main():
+    user_id = f"bench-{uuid.uuid4()}"
+    with get_session() as db:
+        crud.create_or_update_user(db, User(user_id=user_id, name="Bench", email=f"{user_id}@example.com"))
+
+    modes = [("old per-row", legacy_create), ("create_conversation", single_create)]
+    modes += [(f"bulk x{batch_size}", bulk_create(batch_size)) for batch_size in BATCH_SIZES]
+
+    print(f"{CONVERSATIONS} conversations of {MESSAGES_PER_CONVERSATION} messages")
+    print(f"{'mode':>20} {'seconds':>8} {'conversations/s':>16} {'messages/s':>11}")
+    for name, create in modes:
+        conversations = make_conversations(user_id, CONVERSATIONS)
+        start = time.perf_counter()
+        create(conversations)
+        elapsed = time.perf_counter() - start
+        rate = CONVERSATIONS / elapsed
+        print(f"{name:>20} {elapsed:>8.2f} {rate:>16.0f} {rate * MESSAGES_PER_CONVERSATION:>11.0f}")
+
+if __name__ == "__main__":
+    main()
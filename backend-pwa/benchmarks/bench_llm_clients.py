@@ -0,0 +1,50 @@
+"""
+Benchmark chat model calls with per-request clients vs the pooled registry
+
+Runs against a local stub OpenAI server and reports latency and how many
+connections each approach opened:
+
+    python benchmarks/bench_llm_clients.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from langchain_core.messages import HumanMessage
+from langchain_openai import ChatOpenAI
+
+from app.llm_clients import LLMClientRegistry
+from stub_openai import StubOpenAIServer
+
+TURNS = 200
+CONCURRENCY = 10
+
+async def run_turns(get_model) -> float:
+    """Run TURNS chat calls, CONCURRENCY at a time; returns average ms per call"""
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def one_turn():
+        async with semaphore:
+            await get_model().ainvoke([HumanMessage(content="hello")])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_turn() for _ in range(TURNS)))
+    return (time.perf_counter() - start) * 1000 / TURNS
+
+async def main():
+    for name in ("per-request", "registry"):
+        server = await StubOpenAIServer(latency=0.005).start()
+        if name == "per-request":
+            ms = await run_turns(lambda: ChatOpenAI(model_name="gpt-4o", openai_api_key="stub", openai_api_base=server.base_url))
+        else:
+            registry = LLMClientRegistry(api_key="stub", base_url=server.base_url)
+            ms = await run_turns(lambda: registry.get("gpt-4o", 0.7))
+            await registry.aclose()
+        print(f"{name:>12}: {ms:6.2f} ms/call, {server.connections_opened} connections for {server.requests} requests")
+        await server.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""
+Benchmark per-turn write cost of save_conversation as history grows
+
+Compares the append-only path against the old delete-and-reinsert rewrite.
+Runs against DATABASE_URL, or a temporary SQLite file if it is not set:
+
+    python benchmarks/bench_save_conversation.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from app.models import Message, Conversation
+from app.database import save_user, save_conversation, get_conversation, get_session
+from app.db import models
+
+HISTORY_SIZES = [10, 100, 1000, 5000]
+TURNS = 20
+
+async def legacy_rewrite(conversation: Conversation):
+    """The old update path: delete every message and insert them all again"""
+    with get_session() as db:
+        db.query(models.Message).filter(models.Message.conversation_id == conversation.id).delete()
+        for i, message in enumerate(conversation.messages):
+            db.add(models.Message(
+                conversation_id=conversation.id,
+                role=message.role,
+                content=message.content,
+                content_type=message.content_type,
+                sequence_number=i
+            ))
+        db.commit()
+
+async def seed_conversation(user_id: str, size: int) -> Conversation:
+    now = datetime.now().isoformat()
+    conversation = Conversation(id=str(uuid.uuid4()), user_id=user_id, messages=[], created_at=now, updated_at=now)
+    for i in range(size):
+        role = "user" if i % 2 == 0 else "assistant"
+        conversation.messages.append(Message(role=role, content=f"message {i} " * 20))
+    await save_conversation(conversation)
+    return await get_conversation(conversation.id)
+
+async def time_turns(conversation: Conversation, write) -> float:
+    """Average milliseconds to persist one user/assistant turn"""
+    start = time.perf_counter()
+    for turn in range(TURNS):
+        conversation.messages.append(Message(role="user", content=f"question {turn}"))
+        conversation.messages.append(Message(role="assistant", content=f"answer {turn} " * 40))
+        await write(conversation)
+    return (time.perf_counter() - start) * 1000 / TURNS
+
+async def main():
+    user_id = f"bench-{uuid.uuid4()}"
+    await save_user({"user_id": user_id, "name": "Bench", "email": f"{user_id}@example.com"})
+
+    print(f"{'history':>8} {'append ms/turn':>15} {'rewrite ms/turn':>16}")
+    for size in HISTORY_SIZES:
+        append_ms = await time_turns(await seed_conversation(user_id, size), save_conversation)
+        rewrite_ms = await time_turns(await seed_conversation(user_id, size), legacy_rewrite)
+        print(f"{size:>8} {append_ms:>15.2f} {rewrite_ms:>16.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
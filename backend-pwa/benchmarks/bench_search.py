@@ -0,0 +1,101 @@
+"""
+Benchmark full-text search over one user's history
+
+Seeds a user with SEARCH_MESSAGES messages (plus another user's messages
+of the same size, which must not slow the search down) and times first
+and next-page searches. Runs against DATABASE_URL, or a temporary SQLite
+file (FTS5) if it is not set:
+
+    python benchmarks/bench_search.py
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from sqlalchemy import insert
+
+from app.db import models
+from app.db.crud import search_messages
+from app.db.database import engine, SessionLocal
+from app.db.migrations import migrate
+
+MESSAGES = int(os.getenv("SEARCH_MESSAGES", "100000"))
+MESSAGES_PER_CONVERSATION = 50
+ROUNDS = 30
+QUERIES = ["sourdough starter", "kubernetes deployment", "quarterly revenue report", "python", "zebra migration"]
+
+VOCABULARY = (
+    "the a of to and in is it you that for on with as this be at by from or have an they which one "
+    "would all there their what so up out if about who get go me when make can like time no just "
+    "him know take people into year your good some could them see other than then now look only "
+    "come its over think also back after use two how our work first well way even new want because "
+    "any these give day most us python code error deploy server database query index cache request "
+    "image picture weather recipe bread travel budget meeting report revenue kubernetes container"
+).split()
+# Rare words, so some queries match a handful of messages and some match many
+RARE = ["sourdough", "starter", "zebra", "migration", "quarterly", "deployment"]
+
+def sentence(rng: random.Random) -> str:
+    words = rng.choices(VOCABULARY, k=rng.randint(8, 60))
+    if rng.random() < 0.02:
+        words.insert(rng.randrange(len(words)), rng.choice(RARE))
+    return " ".join(words)
+
+def seed(db, user_id: str, count: int, rng: random.Random):
+    db.add(models.User(user_id=user_id, name="Bench", email=f"{user_id}@example.com"))
+    db.commit()
+    for start in range(0, count, MESSAGES_PER_CONVERSATION):
+        conversation_id = str(uuid.uuid4())
+        db.add(models.Conversation(id=conversation_id, user_id=user_id, title="Bench"))
+        db.flush()
+        db.execute(insert(models.Message), [
+            {
+                "conversation_id": conversation_id,
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": sentence(rng),
+                "sequence_number": i
+            }
+            for i in range(min(MESSAGES_PER_CONVERSATION, count - start))
+        ])
+        db.commit()
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def main():
+    migrate(engine)
+    rng = random.Random(7)
+    db = SessionLocal()
+    user_id, other_id = f"bench-{uuid.uuid4()}", f"bench-{uuid.uuid4()}"
+
+    start = time.perf_counter()
+    seed(db, user_id, MESSAGES, rng)
+    seed(db, other_id, MESSAGES, rng)
+    print(f"seeded 2 x {MESSAGES} messages in {time.perf_counter() - start:.1f}s")
+
+    print(f"{'query':>26} {'hits/page':>9} {'p50 ms':>8} {'p99 ms':>8} {'next p50':>9}")
+    for query in QUERIES:
+        first, following = [], []
+        results = []
+        for _ in range(ROUNDS):
+            started = time.perf_counter()
+            results, cursor = search_messages(db, user_id, query, 20)
+            first.append((time.perf_counter() - started) * 1000)
+            if cursor:
+                started = time.perf_counter()
+                search_messages(db, user_id, query, 20, cursor)
+                following.append((time.perf_counter() - started) * 1000)
+        next_p50 = f"{statistics.median(following):>9.1f}" if following else f"{'-':>9}"
+        print(f"{query:>26} {len(results):>9} {statistics.median(first):>8.1f} {percentile(first, 99):>8.1f} {next_p50}")
+    db.close()
+
+if __name__ == "__main__":
+    main()
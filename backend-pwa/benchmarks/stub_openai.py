@@ -0,0 +1,83 @@
+"""
+Minimal OpenAI-compatible HTTP/1.1 server for benchmarks
+
+Answers every POST with a canned response for the endpoint it was sent to
+and counts how many TCP connections clients opened.
+"""
+import asyncio
+import json
+import time
+
+def chat_completion(content: str = "chat") -> dict:
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "stub",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+    }
+
+class StubOpenAIServer:
+    """Serve canned responses on 127.0.0.1; use base_url as the client's API base"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.connections_opened = 0
+        self.requests = 0
+        # Optional hook: path -> (status, headers, body bytes)
+        self.handlers = {}
+        self._server = None
+        self._writers = set()
+
+    @property
+    def base_url(self) -> str:
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections_opened += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                self.requests += 1
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                path = request_line.split(" ")[1]
+                handler = self.handlers.get(path)
+                if handler:
+                    status, extra_headers, payload = handler(body)
+                else:
+                    status, extra_headers, payload = 200, {}, json.dumps(chat_completion()).encode()
+
+                response_headers = {"content-type": "application/json", "content-length": str(len(payload)), **extra_headers}
+                writer.write(f"HTTP/1.1 {status} OK\r\n".encode())
+                writer.write("".join(f"{k}: {v}\r\n" for k, v in response_headers.items()).encode())
+                writer.write(b"\r\n")
+                writer.write(payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
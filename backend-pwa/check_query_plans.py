@@ -0,0 +1,134 @@
+"""
+Check that the hot queries in app/db/crud.py are served by indexes
+
+Runs the CRUD read and update paths against DATABASE_URL inside a
+transaction that is rolled back, records every statement they issue and
+EXPLAINs it. A full table scan fails the check; sorts that no index
+provides are reported as warnings. On PostgreSQL sequential scans are
+disabled for the check, so a tiny table still shows whether an index
+could be used:
+
+    python check_query_plans.py
+"""
+import re
+import sys
+import uuid
+from datetime import datetime
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from app.db import crud
+from app.db.database import engine
+from app.db.migrations import migrate
+from app.models import Conversation, Message, User
+
+# Full-text indexes are virtual tables, scanned through their own index
+SQLITE_SCAN = re.compile(r"^SCAN (\w+)\b(?! USING| VIRTUAL TABLE)")
+POSTGRES_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+def exercise(db: Session, user_id: str, conversation: Conversation):
+    """The queries the API runs on every request"""
+    crud.get_user_by_id(db, user_id)
+    crud.get_user_conversations_count(db, user_id)
+    crud.get_conversation_by_id(db, conversation.id)
+    _, cursor = crud.get_user_conversation_summaries(db, user_id, limit=1)
+    crud.get_user_conversation_summaries(db, user_id, limit=1, cursor=cursor)
+    crud.get_user_conversations(db, user_id, limit=1, cursor=cursor)
+    crud.get_context_summary(db, conversation.id)
+    # An export, and its resumption
+    _, cursor = next(crud.iter_user_conversations(db, user_id))
+    list(crud.iter_user_conversations(db, user_id, cursor))
+    crud.search_messages(db, user_id, "hello")
+    crud.get_latest_image(db, conversation_id=conversation.id)
+    crud.get_latest_image(db, user_id=user_id)
+    # A keyed request, and its retry
+    crud.claim_idempotency_key(db, user_id, "plan-check", "0" * 64, datetime(2000, 1, 1))
+    crud.claim_idempotency_key(db, user_id, "plan-check", "0" * 64, datetime(2000, 1, 1))
+    crud.complete_idempotency_key(db, user_id, "plan-check", "{}")
+    crud.release_idempotency_key(db, user_id, "plan-check")
+
+    conversation.messages.append(Message(role="user", content="one more"))
+    crud.append_messages(db, conversation, len(conversation.messages) - 1)
+    conversation.messages[0].content = "edited"
+    crud.update_conversation(db, conversation)
+    crud.delete_conversation(db, conversation.id, user_id)
+
+def seed(db: Session, user_id: str) -> Conversation:
+    crud.create_or_update_user(db, User(user_id=user_id, name="Plan check", email=f"{user_id}@example.com"))
+    conversation = None
+    for _ in range(2):
+        now = datetime.now().isoformat()
+        conversation = Conversation(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            messages=[Message(role="user", content="hello"), Message(role="assistant", content="hi")],
+            created_at=now,
+            updated_at=now
+        )
+        crud.create_conversation(db, conversation)
+    crud.save_context_summary(db, conversation.id, 1, "summary", 1)
+    return crud.get_conversation_by_id(db, conversation.id)
+
+def explain(connection, statement: str, parameters) -> list:
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+        return [row[-1] for row in rows]
+    return [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters).all()]
+
+def problems(dialect: str, plan: list) -> tuple:
+    """(full scans, sorts) found in a plan"""
+    if dialect == "sqlite":
+        scans = [m.group(1) for m in (SQLITE_SCAN.match(line.strip()) for line in plan) if m]
+        sorts = [line for line in plan if "TEMP B-TREE" in line]
+    else:
+        scans = [m.group(1) for m in (POSTGRES_SCAN.search(line) for line in plan) if m]
+        sorts = [line for line in plan if line.strip().startswith("Sort") or "-> Sort" in line]
+    return scans, sorts
+
+def check_query_plans() -> bool:
+    migrate(engine)
+    connection = engine.connect()
+    transaction = connection.begin()
+    # CRUD commits become savepoints, so everything is rolled back at the end
+    db = Session(bind=connection, join_transaction_mode="create_savepoint")
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb in ("SELECT", "UPDATE", "DELETE") and not executemany:
+            statements.append((statement, parameters))
+
+    try:
+        user_id = f"plan-check-{uuid.uuid4()}"
+        conversation = seed(db, user_id)
+        event.listen(connection, "before_cursor_execute", record)
+        exercise(db, user_id, conversation)
+        event.remove(connection, "before_cursor_execute", record)
+
+        ok = True
+        seen = set()
+        for statement, parameters in statements:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            plan = explain(connection, statement, parameters)
+            scans, sorts = problems(connection.dialect.name, plan)
+            status = "FAIL" if scans else ("WARN" if sorts else "ok")
+            ok = ok and not scans
+            print(f"[{status}] {' '.join(statement.split())[:120]}")
+            if scans or sorts:
+                for line in plan:
+                    print(f"        {line}")
+        print(f"{len(seen)} statements checked: {'all use indexes' if ok else 'full table scans found'}")
+        return ok
+    finally:
+        db.close()
+        transaction.rollback()
+        connection.close()
+
+if __name__ == "__main__":
+    sys.exit(0 if check_query_plans() else 1)
@@ -0,0 +1,28 @@
+"""
+Remove image blobs that no row in the images table refers to
+
+Blobs written within the last IMAGE_GC_GRACE_SECONDS are kept, since the
+rows for images being generated right now may not be committed yet:
+
+    python gc_images.py [--dry-run]
+"""
+import sys
+
+from app.config import IMAGE_GC_GRACE_SECONDS
+from app.db.crud import get_referenced_image_hashes
+from app.db.database import SessionLocal
+from app.image_store import get_image_store
+
+def main():
+    dry_run = "--dry-run" in sys.argv[1:]
+    db = SessionLocal()
+    try:
+        referenced = get_referenced_image_hashes(db)
+    finally:
+        db.close()
+    stats = get_image_store().collect_garbage(referenced, IMAGE_GC_GRACE_SECONDS, dry_run)
+    action = "Would remove" if dry_run else "Removed"
+    print(f"{action} {stats['removed']} blobs ({stats['bytes_freed']} bytes), kept {stats['kept']}")
+
+if __name__ == "__main__":
+    main()
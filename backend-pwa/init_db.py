@@ -1,13 +1,16 @@
 """
-Initialize the database tables
+Initialize the database tables, or upgrade them to the latest schema version
 """
-from app.db.database import Base, engine
+import sys
+
+from app.db.database import engine
+from app.db.migrations import migrate
 from app.config import DATABASE_URL
 
-def init_db():
+def init_db(target=None):
     print(f"Initializing database at {DATABASE_URL}")
-    Base.metadata.create_all(bind=engine)
-    print("Database tables created successfully")
+    version = migrate(engine, target)
+    print(f"Database schema is at version {version}")
 
 if __name__ == "__main__":
-    init_db()
+    init_db(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -6,20 +6,43 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 # Import routers
-from app.endpoint.chat import router as chat_router
+from app.endpoint.chat import router as chat_router, idempotent_requests
 from app.endpoint.conversation import router as conversation_router
 from app.endpoint.images import router as images_router
 
 # Import user endpoints
 from app.models import User, UserResponse
-from app.database import save_user, get_user, get_user_conversations_count
+from app.database import (
+    save_user,
+    get_user,
+    RequestDbQueueMiddleware,
+    database_pool_metrics,
+    conversation_cache_metrics,
+    image_cache_metrics,
+    start_cache_invalidation,
+    stop_cache_invalidation
+)
+from app.llm_clients import init_llm_clients, close_llm_clients
+from app.image_client import init_image_client, close_image_client, get_image_client
+from app.image_variants import init_variant_pool, close_variant_pool, variant_metrics
+from app.ai_service import get_classification_pipeline, get_response_cache, model_calls, speculation_stats
 
 # Context manager to initialize resources
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # This is where we would initialize any global resources
+    # Shared, connection-pooled model clients
+    init_llm_clients()
+    init_image_client()
+    # Worker processes that resize and re-encode images
+    init_variant_pool()
+    # Drop cached conversations written by other workers
+    start_cache_invalidation()
     yield
-    # Clean up resources if needed
+    stop_cache_invalidation()
+    # Close pooled connections
+    await close_llm_clients()
+    await close_image_client()
+    close_variant_pool()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -30,8 +53,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+# A request's database calls run one at a time, each in its own transaction
+app.add_middleware(RequestDbQueueMiddleware)
+
 # Include routers
 app.include_router(chat_router)
 app.include_router(conversation_router)
@@ -40,21 +67,31 @@ app.include_router(images_router)
 # User endpoints
 @app.post("/users", response_model=UserResponse)
 async def create_or_update_user(user: User):
-    saved_user = save_user(user.model_dump())
-    # Add conversations count to response
-    saved_user["conversations_count"] = get_user_conversations_count(user.user_id)
-    return saved_user
+    return await save_user(user.model_dump())
 
 @app.get("/users/{user_id}", response_model=UserResponse)
 async def get_user_endpoint(user_id: str):
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-
-    # Add conversations count to response
-    user["conversations_count"] = get_user_conversations_count(user_id)
     return user
 
+# Monitoring
+@app.get("/metrics")
+async def metrics_endpoint():
+    return {
+        "image_generation": get_image_client().metrics(),
+        "classification": get_classification_pipeline().stats,
+        "classification_cache": get_classification_pipeline().cache.stats(),
+        "speculation": speculation_stats,
+        "response_cache": get_response_cache().metrics() if get_response_cache() else None,
+        "single_flight": {"model_calls": model_calls.stats, "idempotent_requests": idempotent_requests.stats},
+        "database_pool": database_pool_metrics(),
+        "conversation_cache": conversation_cache_metrics(),
+        "image_index_cache": image_cache_metrics(),
+        "image_variants": variant_metrics()
+    }
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""
+Recompute the denormalized conversation and message counters
+"""
+from app.db.crud import repair_counters
+from app.db.database import SessionLocal
+
+def main():
+    db = SessionLocal()
+    try:
+        fixed = repair_counters(db)
+    finally:
+        db.close()
+    print(f"Repaired counters for {fixed['users']} users and {fixed['conversations']} conversations")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Local classification rules against the held-out fixture set
+
+The rules may leave any prompt to the later stages, but a prompt they do
+answer must get its labelled type:
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.classifier import ClassificationPipeline, RuleClassifier
+from app.models import Message
+
+HELD_OUT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "fixtures", "classifier_heldout.jsonl"
+)
+
+async def never_called(prompt, context):
+    raise AssertionError("remote classifier is not used in this test")
+
+def test_rules_never_misclassify_held_out_prompts():
+    pipeline = ClassificationPipeline([RuleClassifier()], never_called)
+    wrong = []
+    with open(HELD_OUT) as fixture_file:
+        for line in fixture_file:
+            record = json.loads(line)
+            context = [Message(**message) for message in record.get("context", [])]
+            result = pipeline.classify_local(record["prompt"], context)
+            if result and result[0] != record["label"]:
+                wrong.append((record["prompt"], result[0], record["label"]))
+    assert wrong == []
@@ -0,0 +1,42 @@
+"""
+Idempotency-Key handling in /unified-chat
+
+Runs against DATABASE_URL, or a temporary SQLite file if it is not set:
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from app.database import claim_idempotency_key
+from app.endpoint import chat
+from app.models import ChatRequest, Message
+
+def test_cancelled_request_releases_key(monkeypatch):
+    started = asyncio.Event()
+
+    async def never_answers(request):
+        started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(chat, "_unified_chat", never_answers)
+    request = ChatRequest(user_id="idempotency-test", messages=[Message(role="user", content="hello")])
+
+    async def cancel_mid_request():
+        task = asyncio.create_task(chat._idempotent_chat(request, "cancelled", "0" * 64))
+        await started.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # Free again: claiming it returns no earlier claim
+        return await claim_idempotency_key(request.user_id, "cancelled", "0" * 64)
+
+    assert asyncio.run(cancel_mid_request()) is None
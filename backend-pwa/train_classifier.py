@@ -0,0 +1,16 @@
+"""
+Train the local prompt classifier from logged remote decisions
+"""
+import sys
+
+from app.classifier import HashedNgramClassifier, load_decisions
+from app.config import CLASSIFIER_LOG_PATH, CLASSIFIER_MODEL_PATH
+
+def train_classifier(log_path: str = CLASSIFIER_LOG_PATH, model_path: str = CLASSIFIER_MODEL_PATH):
+    examples = load_decisions(log_path)
+    print(f"Training on {len(examples)} logged decisions from {log_path}")
+    HashedNgramClassifier().train(examples).save(model_path)
+    print(f"Saved classifier to {model_path}")
+
+if __name__ == "__main__":
+    train_classifier(*sys.argv[1:3])
@@ -74,7 +74,15 @@ const ChatMessage = ({ message }) => {
         {message.content_type === 'image' && (
           <>
             <p>{message.content}</p>
-            {message.image_url && <img src={"http://localhost:8000"+message.image_url} alt="Generated image" />}
+            {message.image_url && (
+              <img
+                src={"http://localhost:8000"+message.image_url}
+                srcSet={[256, 512, 1024].map(width => `http://localhost:8000${message.image_url}?w=${width} ${width}w`).join(', ')}
+                sizes="(max-width: 600px) 70vw, 512px"
+                loading="lazy"
+                alt="Generated image"
+              />
+            )}
           </>
         )}
       </MessageContent>
@@ -489,11 +489,8 @@ const Sidebar = ({ activeConversationId }) => {
   };
 
   const getConversationTitle = (conversation) => {
-    const firstUserMessage = conversation.messages.find(msg => msg.role === 'user');
-    if (firstUserMessage) {
-      return firstUserMessage.content.substring(0, 30) + (firstUserMessage.content.length > 30 ? '...' : '');
-    }
-    return 'New Conversation';
+    const title = conversation.title || 'New Conversation';
+    return title.substring(0, 30) + (title.length > 30 ? '...' : '');
   };
 
   const getCalendarWarningMessage = () => {
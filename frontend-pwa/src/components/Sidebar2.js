@@ -776,13 +776,10 @@ const Sidebar = ({ activeConversationId }) => {
     return `${date}, ${startTime} - ${endTime}`;
   };
 
-  // Get first user message for each conversation as title
+  // Conversation summaries carry the title stored by the backend
   const getConversationTitle = (conversation) => {
-    const firstUserMessage = conversation.messages.find(msg => msg.role === 'user');
-    if (firstUserMessage) {
-      return firstUserMessage.content.substring(0, 30) + (firstUserMessage.content.length > 30 ? '...' : '');
-    }
-    return 'New Conversation';
+    const title = conversation.title || 'New Conversation';
+    return title.substring(0, 30) + (title.length > 30 ? '...' : '');
   };
 
   // Show warning if connected with different email
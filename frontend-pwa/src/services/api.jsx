@@ -45,7 +45,7 @@ const chatApi = {
       console.error('No user_id found in local storage');
       return Promise.reject(new Error('No user_id found'));
     }
-    return api.get(`/conversations?user_id=${user.user_id}`);
+    return api.get(`/conversations?user_id=${user.user_id}&summary=true`);
   },
   
   getConversation: (conversationId) => {
@@ -64,6 +64,18 @@ const chatApi = {
       return Promise.reject(new Error('No user_id found'));
     }
     return api.delete(`/conversations/${conversationId}?user_id=${user.user_id}`);
+  },
+  
+  searchConversations: (query, cursor) => {
+    const user = JSON.parse(localStorage.getItem('user') || '{}');
+    if (!user.user_id) {
+      console.error('No user_id found in local storage');
+      return Promise.reject(new Error('No user_id found'));
+    }
+    // The next page's cursor comes back in the X-Next-Cursor header
+    return api.get('/conversations/search', {
+      params: { user_id: user.user_id, q: query, ...(cursor ? { cursor } : {}) }
+    });
   }
 };
 
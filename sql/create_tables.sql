@@ -6,6 +6,7 @@ CREATE TABLE users (
     picture VARCHAR(1024),
     given_name VARCHAR(255),
     family_name VARCHAR(255),
+    conversations_count INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
@@ -15,6 +16,8 @@ CREATE TABLE conversations (
     id VARCHAR(255) PRIMARY KEY,
     user_id VARCHAR(255) NOT NULL,
     title VARCHAR(255) DEFAULT 'New Conversation',
+    message_count INTEGER NOT NULL DEFAULT 0,
+    last_message_at TIMESTAMP WITH TIME ZONE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
@@ -31,18 +34,80 @@ CREATE TABLE messages (
     image_url VARCHAR(1024),
     sequence_number INTEGER NOT NULL,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
     FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
 );
 
+-- Create Context Summaries table (rolling summaries of older messages)
+CREATE TABLE context_summaries (
+    conversation_id VARCHAR(255) PRIMARY KEY,
+    covered_messages INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    token_count INTEGER NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+);
+
+-- Create Images table (ids mapped to content-addressed blobs)
+CREATE TABLE images (
+    id VARCHAR(255) PRIMARY KEY,
+    user_id VARCHAR(255) NOT NULL,
+    prompt TEXT NOT NULL,
+    image_path VARCHAR(1024) NOT NULL,
+    content_hash VARCHAR(64),
+    mime_type VARCHAR(100),
+    size_bytes INTEGER,
+    conversation_id VARCHAR(255),
+    is_modification BOOLEAN DEFAULT FALSE,
+    original_image_id VARCHAR(255),
+    revision INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (original_image_id) REFERENCES images(id) ON DELETE SET NULL
+);
+
+-- Create Idempotency Keys table (responses to replay for retried chat requests)
+CREATE TABLE idempotency_keys (
+    user_id VARCHAR(255) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    response TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, idempotency_key)
+);
+
 -- Create necessary indexes
-CREATE INDEX idx_conversations_user_id ON conversations(user_id);
-CREATE INDEX idx_messages_conversation_id ON messages(conversation_id);
-CREATE INDEX idx_messages_sequence ON messages(conversation_id, sequence_number);
+CREATE INDEX idx_conversations_user_updated ON conversations(user_id, updated_at DESC, id DESC) INCLUDE (title, created_at);
+CREATE INDEX idx_conversations_user_created ON conversations(user_id, created_at, id);
+CREATE UNIQUE INDEX uq_messages_conversation_sequence ON messages(conversation_id, sequence_number);
+CREATE INDEX idx_messages_content_tsv ON messages USING GIN (content_tsv);
+CREATE INDEX idx_images_content_hash ON images(content_hash);
+CREATE INDEX idx_images_conversation_created ON images(conversation_id, created_at DESC);
+CREATE INDEX idx_images_user_created ON images(user_id, created_at DESC);
+CREATE INDEX idx_idempotency_keys_created ON idempotency_keys(created_at);
+
+-- Schema version, see backend-pwa/app/db/migrations.py
+CREATE TABLE schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO schema_migrations (version, description) VALUES (9, 'Created from create_tables.sql');
 
 -- Create updated_at trigger function
+-- Keeps an updated_at the statement sets, and leaves it alone when only the
+-- denormalized counters change (see migration 9)
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
 BEGIN
+    IF NEW.updated_at IS DISTINCT FROM OLD.updated_at THEN
+        RETURN NEW;
+    END IF;
+    IF to_jsonb(NEW) - ARRAY['updated_at', 'conversations_count', 'message_count', 'last_message_at']
+        IS NOT DISTINCT FROM
+        to_jsonb(OLD) - ARRAY['updated_at', 'conversations_count', 'message_count', 'last_message_at'] THEN
+        RETURN NEW;
+    END IF;
     NEW.updated_at = CURRENT_TIMESTAMP;
     RETURN NEW;
 END;
@@ -57,4 +122,9 @@ CREATE TRIGGER update_users_updated_at
 CREATE TRIGGER update_conversations_updated_at
     BEFORE UPDATE ON conversations
     FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_context_summaries_updated_at
+    BEFORE UPDATE ON context_summaries
+    FOR EACH ROW
     EXECUTE FUNCTION update_updated_at_column();
\ No newline at end of file